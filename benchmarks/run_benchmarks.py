@@ -0,0 +1,297 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Throughput/latency benchmarks of the inference stages on synthetic scans
+
+Every stage is timed on its own:
+    ply_load            open3d read of a scan written by synthetic_scans.write_ply()
+    adjust_pointcloud   kitti_bev_utils.adjust_pointcloud
+    removePoints        kitti_bev_utils.removePoints
+    makeBVFeature       kitti_bev_utils.makeBVFeature
+    voxel_downsample    kitti_bev_utils.voxel_downsample, then makeBVFeature of the kept points with their counts
+    bev_transport       prepare_bev_input() of the dense map and of the sparse map (makeBVFeatureSparse) of a scan,
+                        per transport dtype; the bytes per sample which go through the dataloader and to the device
+                        are in the params
+    forward             the darknet of each cfg in src/config/cfg, per batch size
+    post_processing, post_processing_v2, nms_cpu
+                        on synthetic model outputs with a given number of confident boxes
+The results are written as JSON (see --output); --compare prints the ratio of the timings to a previous result file.
+
+Usage (from the repo root):
+    python benchmarks/run_benchmarks.py --num_points 20000 60000 120000 --batch_sizes 1 4 --output bench.json
+    python benchmarks/run_benchmarks.py --stages forward --cfgs complex_yolov4_tiny.cfg --compare bench.json
+-----------------------------------------------------------------------------------
+"""
+
+import argparse
+import sys
+import os
+import time
+import json
+import glob
+import platform
+import subprocess
+import tempfile
+
+import numpy as np
+import torch
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.join(os.path.dirname(bench_dir), 'src')
+sys.path.insert(0, src_dir)
+
+import config.kitti_config as cnf
+from data_process import kitti_bev_utils
+from models.darknet2pytorch import Darknet
+from utils.evaluation_utils import post_processing, post_processing_v2, nms_cpu
+from utils.torch_utils import BEV_DTYPES, to_bev_dtype, SparseBevBatch, prepare_bev_input
+from synthetic_scans import make_scan, write_ply, make_predictions
+
+STAGES = ['ply_load', 'adjust_pointcloud', 'removePoints', 'makeBVFeature', 'voxel_downsample', 'bev_transport',
+          'forward', 'post_processing', 'post_processing_v2', 'nms_cpu']
+
+
+def time_stage(fn, repeats, warmup, sync=False):
+    """Return the statistics (in ms) of `repeats` calls of fn, after `warmup` calls"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if sync:
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        fn()
+        if sync:
+            torch.cuda.synchronize()
+        times.append(1000. * (time.perf_counter() - start_time))
+    times = np.array(times)
+    return {
+        'mean': float(times.mean()),
+        'median': float(np.median(times)),
+        'min': float(times.min()),
+        'max': float(times.max()),
+        'std': float(times.std()),
+        'repeats': repeats,
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=bench_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_point_stages(configs, stages, results):
+    for num_points in configs.num_points:
+        scan = make_scan(num_points, seed=configs.seed)
+        params = {'num_points': num_points}
+
+        if 'ply_load' in stages:
+            try:
+                import open3d as o3d
+            except ImportError:
+                print('open3d is not installed, skip ply_load')
+            else:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    ply_path = os.path.join(tmp_dir, 'scan.ply')
+                    write_ply(ply_path, scan)
+
+                    def load_ply():
+                        pcd = o3d.io.read_point_cloud(ply_path)
+                        return np.array(pcd.points), np.array(pcd.colors)[:, 0]
+
+                    results.append(record('ply_load', params, time_stage(load_ply, configs.repeats, configs.warmup)))
+
+        xyz, intensity = scan[:, :3], scan[:, 3]
+        if 'adjust_pointcloud' in stages:
+            results.append(record('adjust_pointcloud', params,
+                                  time_stage(lambda: kitti_bev_utils.adjust_pointcloud(xyz), configs.repeats,
+                                             configs.warmup)))
+
+        adjusted_pcd, _ = kitti_bev_utils.adjust_pointcloud(xyz)
+        lidar_data = np.concatenate([adjusted_pcd, intensity[:, None]], axis=1).astype(np.float32)
+        if 'removePoints' in stages:
+            results.append(record('removePoints', params,
+                                  time_stage(lambda: kitti_bev_utils.removePoints(lidar_data, cnf.boundary),
+                                             configs.repeats, configs.warmup)))
+
+        b = kitti_bev_utils.removePoints(lidar_data, cnf.boundary)
+        if 'makeBVFeature' in stages:
+            params_bev = dict(params, num_points_in_boundary=len(b))
+            results.append(record('makeBVFeature', params_bev,
+                                  time_stage(lambda: kitti_bev_utils.makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary),
+                                             configs.repeats, configs.warmup)))
+
+        if 'voxel_downsample' in stages:
+            def downsampled_bev():
+                points, counts = kitti_bev_utils.voxel_downsample(b, cnf.DISCRETIZATION, z_bin_size=cnf.DISCRETIZATION)
+                return kitti_bev_utils.makeBVFeature(points, cnf.DISCRETIZATION, cnf.boundary, counts=counts)
+
+            params_bev = dict(params, num_points_in_boundary=len(b))
+            results.append(record('voxel_downsample', params_bev,
+                                  time_stage(downsampled_bev, configs.repeats, configs.warmup)))
+
+        if 'bev_transport' in stages:
+            bench_bev_transport(configs, b, params, results)
+
+
+def bench_bev_transport(configs, b, params, results):
+    """The dense and the sparse maps of a scan, from the host to the float32 input on the device"""
+    sync = configs.device.type == 'cuda'
+    dense_map = torch.from_numpy(kitti_bev_utils.makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary))
+    cells, features = kitti_bev_utils.makeBVFeatureSparse(b, cnf.DISCRETIZATION, cnf.boundary)
+    cells, features = torch.from_numpy(cells), torch.from_numpy(features)
+    for bev_dtype in BEV_DTYPES:
+        dense_imgs = to_bev_dtype(dense_map, bev_dtype).unsqueeze(0)
+        sparse_imgs = SparseBevBatch.from_samples([(cells, to_bev_dtype(features, bev_dtype),
+                                                    (cnf.BEV_HEIGHT, cnf.BEV_WIDTH))])
+        if sync:
+            dense_imgs, sparse_imgs = dense_imgs.pin_memory(), sparse_imgs.pin_memory()
+        for sparse, imgs, nbytes in [(False, dense_imgs, dense_imgs.numel() * dense_imgs.element_size()),
+                                     (True, sparse_imgs, sparse_imgs.nbytes)]:
+            params_transport = dict(params, bev_dtype=bev_dtype, sparse=sparse, occupied_cells=len(cells),
+                                    bytes_per_sample=nbytes)
+            results.append(record('bev_transport', params_transport,
+                                  time_stage(lambda: prepare_bev_input(imgs, configs.device), configs.repeats,
+                                             configs.warmup, sync=sync)))
+
+
+def bench_forward(configs, results):
+    sync = configs.device.type == 'cuda'
+    for cfgfile in configs.cfgfiles:
+        model = Darknet(cfgfile=cfgfile, use_giou_loss=False).to(configs.device)
+        model.eval()
+        for batch_size in configs.batch_sizes:
+            imgs = torch.rand(batch_size, 3, model.height, model.width, device=configs.device)
+
+            def forward():
+                with torch.no_grad():
+                    model(imgs)
+
+            params = {'cfg': os.path.basename(cfgfile), 'batch_size': batch_size, 'img_size': model.width,
+                      'device': str(configs.device)}
+            results.append(record('forward', params, time_stage(forward, configs.repeats, configs.warmup, sync=sync)))
+        del model
+
+
+def bench_post_processing(configs, stages, results):
+    num_classes = len(cnf.class_list)
+    for batch_size in configs.batch_sizes:
+        for num_candidates in configs.num_candidates:
+            outputs = make_predictions(batch_size, configs.num_preds, num_candidates, num_classes, seed=configs.seed)
+            params = {'batch_size': batch_size, 'num_preds': configs.num_preds, 'num_candidates': num_candidates}
+            if 'post_processing' in stages:
+                results.append(record('post_processing', params,
+                                      time_stage(lambda: post_processing(outputs, conf_thresh=0.5, nms_thresh=0.5),
+                                                 configs.repeats, configs.warmup)))
+            if 'post_processing_v2' in stages:
+                outputs_tensor = torch.from_numpy(outputs)
+                results.append(record('post_processing_v2', params,
+                                      time_stage(lambda: post_processing_v2(outputs_tensor, conf_thresh=0.5,
+                                                                            nms_thresh=0.5),
+                                                 configs.repeats, configs.warmup)))
+            if 'nms_cpu' in stages:
+                # nms_cpu works on the confident boxes of one image
+                boxes = outputs[0, :num_candidates, :6]
+                confs = outputs[0, :num_candidates, 6] * outputs[0, :num_candidates, 7:].max(axis=1)
+                results.append(record('nms_cpu', dict(params, batch_size=1),
+                                      time_stage(lambda: nms_cpu(boxes, confs, nms_thresh=0.5), configs.repeats,
+                                                 configs.warmup)))
+
+
+def record(stage, params, stats):
+    print('{:<20s} {:<70s} mean {:9.2f}ms  median {:9.2f}ms'.format(stage, json.dumps(params), stats['mean'],
+                                                                       stats['median']))
+    return {'stage': stage, 'params': params, 'ms': stats}
+
+
+def result_key(result):
+    return result['stage'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, previous_path):
+    with open(previous_path, 'r') as f:
+        previous = {result_key(result): result for result in json.load(f)['results']}
+    print('\nCompared to {} (median, new / old):'.format(previous_path))
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        print('{:<20s} {:<70s} {:9.2f}ms / {:9.2f}ms  x{:.2f}'.format(
+            result['stage'], json.dumps(result['params']), result['ms']['median'], old['ms']['median'],
+            result['ms']['median'] / max(old['ms']['median'], 1e-9)))
+
+
+def parse_bench_configs():
+    parser = argparse.ArgumentParser(description='Benchmark the inference stages on synthetic scans')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES,
+                        help='The stages to benchmark')
+    parser.add_argument('--num_points', nargs='+', type=int, default=[20000, 60000, 120000],
+                        help='The sizes of the synthetic scans')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 4],
+                        help='The batch sizes of the forward and post-processing stages')
+    parser.add_argument('--cfgs', nargs='+', default=None,
+                        help='The cfg files (in src/config/cfg) to benchmark, default: all of them')
+    parser.add_argument('--num_preds', type=int, default=22743,
+                        help='The number of predictions per image of the synthetic model outputs')
+    parser.add_argument('--num_candidates', nargs='+', type=int, default=[50, 200],
+                        help='The number of confident boxes per image of the synthetic model outputs')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='The number of timed runs of every stage')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='The number of untimed runs before the timed ones')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the synthetic data')
+    parser.add_argument('--no_cuda', action='store_true',
+                        help='If true, cuda is not used.')
+    parser.add_argument('--gpu_idx', default=None, type=int,
+                        help='GPU index to use.')
+    parser.add_argument('--output', type=str, default=None, metavar='PATH',
+                        help='The JSON file of the results')
+    parser.add_argument('--compare', type=str, default=None, metavar='PATH',
+                        help='A previous JSON result file to compare with')
+    configs = parser.parse_args()
+
+    if configs.no_cuda or (not torch.cuda.is_available()):
+        configs.device = torch.device('cpu')
+    else:
+        configs.device = torch.device('cuda' if configs.gpu_idx is None else 'cuda:{}'.format(configs.gpu_idx))
+    cfg_dir = os.path.join(src_dir, 'config', 'cfg')
+    if configs.cfgs is None:
+        configs.cfgfiles = sorted(glob.glob(os.path.join(cfg_dir, '*.cfg')))
+    else:
+        configs.cfgfiles = [os.path.join(cfg_dir, cfg) for cfg in configs.cfgs]
+
+    return configs
+
+
+if __name__ == '__main__':
+    configs = parse_bench_configs()
+    stages = set(configs.stages)
+
+    results = []
+    bench_point_stages(configs, stages, results)
+    if 'forward' in stages:
+        bench_forward(configs, results)
+    bench_post_processing(configs, stages, results)
+
+    if configs.output is not None:
+        meta = {
+            'git_commit': get_git_commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'num_threads': torch.get_num_threads(),
+            'device': str(configs.device),
+            'args': {key: value for key, value in vars(configs).items() if key not in ('device', 'cfgfiles')},
+        }
+        with open(configs.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print('Results written to {}'.format(configs.output))
+
+    if configs.compare is not None:
+        compare(results, configs.compare)
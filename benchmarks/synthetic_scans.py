@@ -0,0 +1,67 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Reproducible synthetic scans and model outputs for the benchmarks (no dataset needed)
+-----------------------------------------------------------------------------------
+"""
+
+import numpy as np
+
+
+def make_scan(num_points, seed=0, num_objects=20, object_ratio=0.3):
+    """Return an (N, 4) float64 x, y, z, intensity scan: a noisy ground plane plus box shaped objects standing on it.
+    The same (num_points, seed) always gives the same scan.
+    """
+    rng = np.random.RandomState([num_points, seed])
+    num_object_points = int(num_points * object_ratio)
+    num_ground_points = num_points - num_object_points
+
+    ground = np.stack([rng.uniform(0., 50., num_ground_points),
+                       rng.uniform(-25., 25., num_ground_points),
+                       rng.normal(-1.73, 0.03, num_ground_points)], axis=1)
+
+    centers = np.stack([rng.uniform(5., 45., num_objects),
+                        rng.uniform(-20., 20., num_objects),
+                        np.full(num_objects, -1.73)], axis=1)
+    # length, width, height
+    sizes = rng.uniform([0.5, 0.5, 0.5], [4.5, 2., 2.], size=(num_objects, 3))
+    owners = rng.randint(0, num_objects, num_object_points)
+    objects = centers[owners] + rng.uniform(-0.5, 0.5, size=(num_object_points, 3)) * sizes[owners]
+    objects[:, 2] += sizes[owners, 2] / 2.
+
+    xyz = np.concatenate([ground, objects], axis=0)
+    intensity = rng.uniform(0., 1., num_points)
+
+    return np.concatenate([xyz, intensity[:, None]], axis=1)
+
+
+def write_ply(path, scan):
+    """Write a scan as the dataset stores it: the intensity is in the color channels"""
+    import open3d as o3d
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(scan[:, :3])
+    pcd.colors = o3d.utility.Vector3dVector(np.repeat(scan[:, 3:4], 3, axis=1))
+    o3d.io.write_point_cloud(path, pcd)
+
+
+def make_predictions(batch_size, num_preds, num_candidates, num_classes, img_size=608, seed=0):
+    """Return a (batch_size, num_preds, 7 + num_classes) float32 array shaped like the darknet outputs, with
+    num_candidates confident boxes per image (above a conf_thresh of 0.5) and low confidence everywhere else
+    """
+    rng = np.random.RandomState([batch_size, num_preds, num_candidates, seed])
+    outputs = np.zeros((batch_size, num_preds, 7 + num_classes), dtype=np.float32)
+    outputs[:, :, 0:2] = rng.uniform(0., img_size, size=(batch_size, num_preds, 2))
+    outputs[:, :, 2:4] = rng.uniform(5., 40., size=(batch_size, num_preds, 2))
+    yaw = rng.uniform(-np.pi, np.pi, size=(batch_size, num_preds))
+    outputs[:, :, 4] = np.sin(yaw)
+    outputs[:, :, 5] = np.cos(yaw)
+    outputs[:, :, 6] = rng.uniform(0., 0.1, size=(batch_size, num_preds))
+    outputs[:, :num_candidates, 6] = rng.uniform(0.75, 1., size=(batch_size, num_candidates))
+    class_probs = rng.uniform(0., 0.2, size=(batch_size, num_preds, num_classes))
+    class_ids = rng.randint(0, num_classes, size=(batch_size, num_preds))
+    np.put_along_axis(class_probs, class_ids[:, :, None], rng.uniform(0.7, 1., size=(batch_size, num_preds, 1)),
+                      axis=2)
+    outputs[:, :, 7:] = class_probs
+
+    return outputs
@@ -1,6 +1,9 @@
+import argparse
 import json
 import os
-import numpy as np
+from multiprocessing import Pool
+
+MANIFEST_NAME = '.convert_manifest.json'
 
 
 def importJson(filename,filepath=''):
@@ -9,7 +12,7 @@ def importJson(filename,filepath=''):
         filename = os.path.join(filepath,filename)
     else:
         os.path.dirname(os.path.realpath(__file__))
-    # 
+    #
     filename = "{}".format(filename)
     # import the json data categories
     with open(filename, 'r+') as f:
@@ -17,8 +20,6 @@ def importJson(filename,filepath=''):
     return data
 
 def create_str(jsonFile):
-    #  
-    filename = jsonFile['filename'].replace('.ply','')
     #
     strAllObjs, objClass_list = '', []
     # loop throught objects
@@ -29,10 +30,8 @@ def create_str(jsonFile):
         strAllObjs += objToAdd
         # add the class to the list
         objClass_list.append(objClass)
-    # ad t the file
-    to_txt(filename, strAllObjs)
-    # return obj class
-    return objClass_list
+    # return the label file content and obj classes
+    return strAllObjs, objClass_list
 
 def objectToStr(objSon):
     # get the data from the object
@@ -46,7 +45,7 @@ def objectToStr(objSon):
     # add to the str
     for elements in objList:
         objStr += ' ' + str(elements)
-    # add return 
+    # add return
     objStr+='\n'
     # return the str
     return objStr, objSon['name']
@@ -55,44 +54,119 @@ def to_txt(filename, objectStr,filepath='labels_converted/'):
     # svae the ew labels to txt file
     act_path = os.path.dirname(os.path.realpath(__file__))
     newPath = os.path.join(act_path,filepath)
-    with open('{}{}.txt'.format(newPath,filename), 'w') as f:
+    with open(os.path.join(newPath, '{}.txt'.format(filename)), 'w') as f:
         f.write(objectStr)
 
-def add_labels(objLabels, labelList):
-    #   
-    [labelList.append(objClass) for objClass in objLabels if objClass not in labelList]
-    #
-    return labelList
-
 def convertList(LabelList):
-    # replace str
-    labelSTR = str(LabelList)
-    labelSTR = labelSTR.replace('[','')
-    labelSTR = labelSTR.replace(']','')
-    labelSTR = labelSTR.replace(',','\n')
-    labelSTR = labelSTR.replace('\'','')
-    labelSTR = labelSTR.replace(' ','')
-    return labelSTR
-
-def convertFiles():
+    # one class per line, as in dataset/kitti/classes_names.txt
+    return '\n'.join(LabelList)
+
+def read_classes(classes_file):
+    # the existing classes keep their order (and so their ids)
+    if not os.path.isfile(classes_file):
+        return []
+    return [line.rstrip() for line in open(classes_file) if line.rstrip() != '']
+
+def merge_classes(old_classes, new_classes):
+    # new classes are appended in a stable order
+    known = set(old_classes)
+    return list(old_classes) + sorted(set(new_classes) - known)
+
+def convert_file(task):
+    # convert one labelCloud json
+    json_path, json_mtime, output_dir = task
+    jsonbject = importJson(json_path)
+    # the txt is named after the point cloud of the json, which may differ from the json name
+    txt_name = jsonbject['filename'].replace('.ply', '')
+    strAllObjs, objClass_list = create_str(jsonbject)
+    to_txt(txt_name, strAllObjs, filepath=output_dir)
+    return json_path, json_mtime, txt_name, strAllObjs.splitlines(), sorted(set(objClass_list))
+
+def read_manifest(manifest_path):
+    # {json_path: [json mtime, txt name, classes]} of the previous conversions
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_json(path, data):
+    # write through a temporary file, a failed run keeps the previous file
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def update_label_index(label_index_path, labels):
+    # write the converted labels into the label index of a packed dataset (see src/data_process/kitti_shards.py)
+    label_index = {}
+    if os.path.isfile(label_index_path):
+        with open(label_index_path, 'r') as f:
+            label_index = json.load(f)
+    label_index.update(labels)
+    write_json(label_index_path, label_index)
+
+def convertFiles(input_dir, output_dir, classes_file, num_workers=None, force=False, label_index_path=None):
     # loop througt files
     print('Start converting')
-    path_json = os.path.join(os.path.dirname(os.path.realpath(__file__)),'labels')
-    # creta e a counter for the feedback
-    count_files = 0
-    # create a label list
-    label_list = []
-    # loop throught files
-    for root, dirs, files in os.walk(path_json):
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # the jsons whose mtime is the one of their last conversion are skipped without being opened (incremental mode)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    old_manifest = {} if force else read_manifest(manifest_path)
+    class_set, labels, tasks, manifest, count_files = set(), {}, [], {}, 0
+    for root, dirs, files in os.walk(input_dir):
         for file in files:
             if file.endswith(".json"):
-                jsonbject = importJson(file, filepath=path_json)
-                label_list = add_labels(create_str(jsonbject), label_list)
-                count_files += 1
+                json_path = os.path.abspath(os.path.join(root, file))
+                json_mtime = os.path.getmtime(json_path)
+                entry = old_manifest.get(json_path)
+                txt_path = None if entry is None else os.path.join(output_dir, '{}.txt'.format(entry[1]))
+                if (entry is not None) and (entry[0] == json_mtime) and os.path.isfile(txt_path):
+                    manifest[json_path] = entry
+                    class_set |= set(entry[2])
+                    if label_index_path is not None:
+                        labels[entry[1]] = [line.rstrip() for line in open(txt_path) if line.rstrip() != '']
+                    continue
+                tasks.append((json_path, json_mtime, output_dir))
+    # convert on a process pool
+    with Pool(num_workers) as pool:
+        for json_path, json_mtime, txt_name, lines, obj_classes in pool.imap_unordered(convert_file, tasks,
+                                                                                        chunksize=16):
+            class_set |= set(obj_classes)
+            labels[txt_name] = lines
+            manifest[json_path] = [json_mtime, txt_name, obj_classes]
+            count_files += 1
+    write_json(manifest_path, manifest)
     # save labels
-    to_txt('classes_names', convertList(label_list))
+    label_list = merge_classes(read_classes(classes_file), class_set)
+    with open(classes_file, 'w') as f:
+        f.write(convertList(label_list))
+    if label_index_path is not None:
+        update_label_index(label_index_path, labels)
     # Print the final state
-    print('Sucessfully converted {} file(s)'.format(count_files))
-    
-  
-convertFiles()
+    print('Sucessfully converted {} file(s), {} up to date, {} classes'.format(count_files, len(manifest) - count_files,
+                                                                                len(label_list)))
+
+
+if __name__ == '__main__':
+    act_path = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description='Convert labelCloud json labels to the txt labels of the dataset')
+    parser.add_argument('--input_dir', type=str, default=os.path.join(act_path, 'labels'),
+                        help='The directory of the labelCloud json files')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(act_path, 'labels_converted'),
+                        help='The directory of the converted txt files')
+    parser.add_argument('--classes_file', type=str, default=None,
+                        help='The classes_names.txt to merge the classes into, default: <output_dir>/classes_names.txt')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of conversion processes, default: number of CPUs')
+    parser.add_argument('--force', action='store_true',
+                        help='If true, convert all the files, even the jsons unchanged since their last conversion')
+    parser.add_argument('--label_index', type=str, default=None,
+                        help='If set, also write the labels into this label_index.json of a packed dataset')
+    args = parser.parse_args()
+
+    classes_file = args.classes_file if args.classes_file is not None else os.path.join(args.output_dir,
+                                                                                        'classes_names.txt')
+    convertFiles(args.input_dir, args.output_dir, classes_file, num_workers=args.num_workers, force=args.force,
+                 label_index_path=args.label_index)
@@ -57,10 +57,39 @@ def parse_train_configs():
                         help='If true, compose training samples as mosaics')
     parser.add_argument('--random-padding', action='store_true',
                         help='If true, random padding if using mosaic augmentation')
+    parser.add_argument('--device_augment', action='store_true',
+                        help='If true, compose mosaics and multiscale batches on the training device instead of in '
+                             'the dataloader workers (each sample is loaded once instead of four times), needed '
+                             'by --multiscale_training with a --seed')
     parser.add_argument('--no-val', action='store_true',
                         help='If true, dont evaluate the model on the val set')
+    parser.add_argument('--val_freq', type=int, default=1, metavar='N',
+                        help='Evaluate the model on the whole val set every N epochs (and at the last epoch)')
+    parser.add_argument('--proxy_val_samples', type=int, default=0, metavar='N',
+                        help='Evaluate the model on a fixed subset of N val samples (stratified by class) in the '
+                             'epochs without a full validation (default: 0, disabled)')
+    parser.add_argument('--early_stop_patience', type=int, default=0, metavar='N',
+                        help='Stop the training when the last N full validations did not improve the best mAP '
+                             '(default: 0, disabled)')
+    parser.add_argument('--early_stop_min_delta', type=float, default=0.,
+                        help='The min mAP improvement that resets the early stopping patience')
     parser.add_argument('--num_samples', type=int, default=None,
                         help='Take a subset of the dataset to run and debug')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='If set, read the packed dataset (see data_process/kitti_shards.py) from this directory')
+    parser.add_argument('--voxel_downsample', action='store_true',
+                        help='If true, merge the points of every BEV voxel before the rasterization (same BEV maps)')
+    parser.add_argument('--bev_store_dir', type=str, default=None, metavar='PATH',
+                        help='If set, the BEV maps are built once into a memory-mapped store in this directory, '
+                             'shared by the processes of the host (see data_process/bev_store.py)')
+    parser.add_argument('--bev_store_dtype', type=str, default='uint8', choices=['uint8', 'float16'],
+                        help='The dtype of the stored BEV maps')
+    parser.add_argument('--bev_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='The dtype of the BEV maps between the dataloader workers and the device, they are '
+                             'converted to float on the device (uint8: 1/255 steps)')
+    parser.add_argument('--sparse_bev', action='store_true',
+                        help='If true, only the occupied cells of the BEV maps (and their features) go through the '
+                             'dataloader, the maps are densified on the device (for mostly empty grids)')
     parser.add_argument('--num_workers', type=int, default=4,
                         help='Number of threads for loading data')
     parser.add_argument('--batch_size', type=int, default=4,
@@ -68,11 +97,22 @@ def parse_train_configs():
                              'batch size of all GPUs on the current node when using'
                              'Data Parallel or Distributed Data Parallel')
     parser.add_argument('--print_freq', type=int, default=50, metavar='N',
-                        help='print frequency (default: 50)')
+                        help='print frequency, in optimizer steps (default: 50)')
     parser.add_argument('--tensorboard_freq', type=int, default=50, metavar='N',
-                        help='frequency of saving tensorboard (default: 50)')
+                        help='frequency of saving tensorboard, in optimizer steps (default: 50)')
     parser.add_argument('--checkpoint_freq', type=int, default=5, metavar='N',
                         help='frequency of saving checkpoints (default: 5)')
+    parser.add_argument('--keep_last_checkpoints', type=int, default=0, metavar='N',
+                        help='Keep only the N latest checkpoints, plus the one with the best mAP (default: 0, keep all)')
+    parser.add_argument('--profile', action='store_true',
+                        help='If true, time the dataset, model and post-processing spans (see utils/profiling.py) '
+                             'and report them to the logger and tensorboard after every epoch')
+    parser.add_argument('--profile_trace', action='store_true',
+                        help='If true, also export the spans as a Chrome trace at the end of the training')
+    parser.add_argument('--profile_sync_cuda', action='store_true',
+                        help='If true, synchronize cuda at the edges of the spans (slower, exact model spans)')
+    parser.add_argument('--profile_torch_steps', type=int, default=0, metavar='N',
+                        help='Run the torch autograd profiler over the first N steps (0: disabled)')
     ####################################################################
     ##############     Training strategy            ####################
     ####################################################################
@@ -93,10 +133,23 @@ def parse_train_configs():
                         help='weight decay (default: 5e-4)')
     parser.add_argument('--optimizer_type', type=str, default='adam', metavar='OPTIMIZER',
                         help='the type of optimizer, it can be sgd or adam')
+    parser.add_argument('--accumulate_batch_size', type=int, default=64, metavar='N',
+                        help='The effective batch size of an optimizer step over all the processes, the gradients of '
+                             'the micro-batches are accumulated (default: 64)')
     parser.add_argument('--burn_in', type=int, default=50, metavar='N',
                         help='number of burn in step')
     parser.add_argument('--steps', nargs='*', default=[1500, 4000],
                         help='number of burn in step')
+    parser.add_argument('--bn_sparsity', type=float, default=0., metavar='S',
+                        help='L1 penalty on the BN gammas of the prunable convolutions, to train a model before '
+                             'pruning it with models/darknet_prune.py (e.g. 1e-4, default: 0. disabled)')
+    parser.add_argument('--ema', action='store_true',
+                        help='If true, keep an exponential moving average of the weights, evaluated and checkpointed '
+                             'instead of the raw weights')
+    parser.add_argument('--ema_decay', type=float, default=0.9999,
+                        help='The decay of the weights EMA')
+    parser.add_argument('--ema_tau', type=float, default=2000,
+                        help='The number of optimizer steps over which the EMA decay ramps up')
 
     ####################################################################
     ##############     Loss weight            ##########################
@@ -111,8 +164,8 @@ def parse_train_configs():
                         help='node rank for distributed training')
     parser.add_argument('--dist-url', default='tcp://127.0.0.1:29500', type=str,
                         help='url used to set up distributed training')
-    parser.add_argument('--dist-backend', default='nccl', type=str,
-                        help='distributed backend')
+    parser.add_argument('--dist-backend', default=None, type=str,
+                        help='distributed backend (default: nccl, gloo with --no_cuda)')
     parser.add_argument('--gpu_idx', default=None, type=int,
                         help='GPU index to use.')
     parser.add_argument('--no_cuda', action='store_true',
@@ -122,6 +175,11 @@ def parse_train_configs():
                              'N processes per node, which has N GPUs. This is the '
                              'fastest way to use PyTorch for either single node or '
                              'multi node data parallel training')
+    parser.add_argument('--cpu_procs_per_node', type=int, default=1, metavar='N',
+                        help='With --no_cuda --multiprocessing-distributed, the number of training processes per node')
+    parser.add_argument('--num_threads', type=int, default=None, metavar='N',
+                        help='The number of torch threads of every training process on cpu '
+                             '(default: the cpu count divided by the processes per node)')
     ####################################################################
     ##############     Evaluation configurations     ###################
     ####################################################################
@@ -142,9 +200,19 @@ def parse_train_configs():
     ############## Hardware configurations #############################
     ####################################################################
     configs.device = torch.device('cpu' if configs.no_cuda else 'cuda')
-    configs.ngpus_per_node = torch.cuda.device_count()
+    if configs.no_cuda:
+        # The processes of a node, each one is given its share of the batch and of the dataloader workers
+        configs.ngpus_per_node = configs.cpu_procs_per_node
+        configs.gpu_idx = None
+    else:
+        configs.ngpus_per_node = torch.cuda.device_count()
+    if configs.dist_backend is None:
+        configs.dist_backend = 'gloo' if configs.no_cuda else 'nccl'
+    if configs.no_cuda and (configs.num_threads is None):
+        configs.num_threads = max(1, (os.cpu_count() or 1) // configs.cpu_procs_per_node)
 
-    configs.pin_memory = True
+    # Pinned memory only speeds up the copies to a GPU
+    configs.pin_memory = not configs.no_cuda
 
     ####################################################################
     ############## Dataset, logs, Checkpoints dir ######################
@@ -0,0 +1,27 @@
+#!/usr/bin/env bash
+# Scaling test of the CPU DDP training (gloo) on one machine: the same epoch on a subset of the training set, with a
+# growing number of processes. --batch_size is the batch of the node, it is split between the processes, so every run
+# trains with the same total batch. Usage: ./cpu_ddp_scaling.sh [NUM_SAMPLES] [PROCS...]
+NUM_SAMPLES=${1:-256}
+shift
+PROCS=${@:-1 2 4 8}
+
+for NUM_PROCS in ${PROCS}; do
+  START_TIME=$(date +%s)
+  python train.py \
+    --saved_fn "cpu_ddp_scaling_${NUM_PROCS}" \
+    --no_cuda \
+    --multiprocessing-distributed \
+    --world-size 1 \
+    --rank 0 \
+    --dist-url 'tcp://127.0.0.1:29511' \
+    --cpu_procs_per_node "${NUM_PROCS}" \
+    --batch_size 16 \
+    --num_workers 8 \
+    --num_samples "${NUM_SAMPLES}" \
+    --num_epochs 1 \
+    --checkpoint_freq 1000 \
+    --no-val || exit 1
+  END_TIME=$(date +%s)
+  echo "${NUM_PROCS} process(es): $((END_TIME - START_TIME)) s for ${NUM_SAMPLES} samples"
+done
@@ -0,0 +1,223 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Memory-mapped BEV maps of a split, shared by the processes of a host
+
+The BEV maps of the samples of a KittiDataset are materialized once into
+    <bev_store_dir>/<mode>_<key>_<dtype>.npy     (num_samples, 3, BEV_HEIGHT, BEV_WIDTH) maps, uint8 or float16
+    <bev_store_dir>/<mode>_<key>_<dtype>.json    sample ids and pcd_ratio_vars of the rows, written last
+and every dataset (of every training/evaluation process and of their dataloader workers) maps the .npy read-only, so
+the page cache holds a single copy of the maps. The key is a hash of the sample ids, of the (mtime, size) of their scans
+and of the BEV settings, a changed scan gives a new store. The uint8 maps are the [0, 1] maps quantized to 1/255
+steps, the float16 ones keep ~3 significant digits.
+
+Concurrent builders: the first process creates <name>.lock (O_EXCL) and builds the store into temporary files, which
+are renamed once complete; the others wait for the .json. The builder touches the lock while it works, a lock which
+has not been touched for STALE_LOCK_SECONDS (or whose builder process died, on the same host) is taken over. The lock
+holds a unique token of its owner, a builder only touches and removes its own lock.
+-----------------------------------------------------------------------------------
+"""
+
+import sys
+import os
+import json
+import time
+import socket
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append('../')
+
+from data_process import pcd_metadata
+import config.kitti_config as cnf
+
+BEV_STORE_DTYPES = ['uint8', 'float16']
+STALE_LOCK_SECONDS = 120.
+POLL_SECONDS = 1.
+
+
+def quantize_bev(rgb_map, dtype):
+    """Store a [0, 1] map as uint8 (1/255 steps) or float16"""
+    if dtype == 'uint8':
+        return np.rint(np.clip(rgb_map, 0., 1.) * 255.).astype(np.uint8)
+    return rgb_map.astype(np.float16)
+
+
+def dequantize_bev(stored_map):
+    """The float32 [0, 1] map of a stored map (a new array)"""
+    if stored_map.dtype == np.uint8:
+        return stored_map.astype(np.float32) * np.float32(1. / 255.)
+    return stored_map.astype(np.float32)
+
+
+def get_store_name(dataset, dtype):
+    sample_ids = [int(sample_id) for sample_id in dataset.sample_id_list]
+    sources = pcd_metadata.get_source_paths(dataset, sample_ids)
+    key_data = {
+        'sample_ids': sample_ids,
+        'stamps': [pcd_metadata.get_stamp(sources[sample_id]) for sample_id in sample_ids],
+        'boundary': cnf.boundary,
+        'bev_size': [cnf.BEV_HEIGHT, cnf.BEV_WIDTH],
+    }
+    key = hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return '{}_{}_{}'.format(dataset.mode, key, dtype)
+
+
+def try_lock(lock_path):
+    """Create the lock, returns its owner token or None if it exists"""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'token': token}, f)
+    return token
+
+
+def owns_lock(lock_path, token):
+    try:
+        with open(lock_path, 'r') as f:
+            return json.load(f).get('token') == token
+    except (OSError, ValueError):
+        return False
+
+
+def touch_lock(lock_path, token):
+    """Heartbeat of the owner, a lock taken over by another builder is left alone"""
+    if owns_lock(lock_path, token):
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def release_lock(lock_path, token):
+    if owns_lock(lock_path, token):
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def is_stale_lock(lock_path):
+    try:
+        if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+            return True
+        with open(lock_path, 'r') as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        # Removed meanwhile, or being written
+        return False
+    if owner['host'] != socket.gethostname():
+        return False
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def build_store(dataset, store_path, dtype, lock_path, lock_token, num_threads=None):
+    """Write the maps of the dataset (computed from the scans) into store_path and its index. The temporary files are
+    removed if the build fails"""
+    sample_ids = [int(sample_id) for sample_id in dataset.sample_id_list]
+    tmp_path = '{}.tmp{}.npy'.format(store_path[:-len('.npy')], os.getpid())
+    index_path = '{}.json'.format(store_path[:-len('.npy')])
+    tmp_index_path = '{}.tmp{}'.format(index_path, os.getpid())
+    ratio_vars_list = [None] * len(sample_ids)
+
+    try:
+        maps = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                         shape=(len(sample_ids), 3, cnf.BEV_HEIGHT, cnf.BEV_WIDTH))
+
+        def build_row(row):
+            rgb_map, pcd_ratio_vars = dataset.compute_bev_map(sample_ids[row])
+            maps[row] = quantize_bev(rgb_map, dtype)
+            ratio_vars_list[row] = [float(v) for v in pcd_ratio_vars]
+
+        last_touch = time.time()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for _ in executor.map(build_row, range(len(sample_ids))):
+                if time.time() - last_touch > STALE_LOCK_SECONDS / 4:
+                    # heartbeat, the lock is not stale
+                    touch_lock(lock_path, lock_token)
+                    last_touch = time.time()
+        maps.flush()
+        del maps
+        os.replace(tmp_path, store_path)
+
+        with open(tmp_index_path, 'w') as f:
+            json.dump({'sample_ids': sample_ids, 'pcd_ratio_vars': ratio_vars_list, 'dtype': dtype}, f)
+        os.replace(tmp_index_path, index_path)
+    except BaseException:
+        for path in [tmp_path, tmp_index_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+class BevStore(object):
+    """Read-only view of the stored maps of a split. The memmap is opened lazily, so the store can be pickled to the
+    dataloader workers (spawn) without copying the maps"""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open('{}.json'.format(store_path[:-len('.npy')]), 'r') as f:
+            index = json.load(f)
+        self.rows = {sample_id: row for row, sample_id in enumerate(index['sample_ids'])}
+        self.pcd_ratio_vars = index['pcd_ratio_vars']
+        self.maps = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['maps'] = None
+        return state
+
+    def __contains__(self, sample_id):
+        return int(sample_id) in self.rows
+
+    def get(self, sample_id):
+        """The stored map of a sample (a read-only view of the memmap) and its ratio variables"""
+        if self.maps is None:
+            self.maps = np.load(self.store_path, mmap_mode='r')
+        row = self.rows[int(sample_id)]
+        return self.maps[row], self.pcd_ratio_vars[row]
+
+
+def open_store(dataset, bev_store_dir, dtype='uint8', num_threads=None):
+    """Return the BevStore of the samples of a KittiDataset, built by this process if no other one is building it"""
+    assert dtype in BEV_STORE_DTYPES, 'Invalid BEV store dtype: {}'.format(dtype)
+    if not os.path.isdir(bev_store_dir):
+        os.makedirs(bev_store_dir, exist_ok=True)
+    name = get_store_name(dataset, dtype)
+    store_path = os.path.join(bev_store_dir, '{}.npy'.format(name))
+    index_path = os.path.join(bev_store_dir, '{}.json'.format(name))
+    lock_path = os.path.join(bev_store_dir, '{}.lock'.format(name))
+
+    while not os.path.isfile(index_path):
+        lock_token = try_lock(lock_path)
+        if lock_token is not None:
+            try:
+                # Another builder may have completed the store between the check and the lock
+                if not os.path.isfile(index_path):
+                    print('Building the BEV store {} ({} samples)'.format(store_path, len(dataset.sample_id_list)))
+                    build_store(dataset, store_path, dtype, lock_path, lock_token, num_threads=num_threads)
+            finally:
+                release_lock(lock_path, lock_token)
+        elif is_stale_lock(lock_path):
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+        else:
+            time.sleep(POLL_SECONDS)
+
+    return BevStore(store_path)
@@ -13,8 +13,11 @@ import numpy as np
 sys.path.append('../')
 
 import config.kitti_config as cnf
+from data_process import pcd_metadata
+from utils import profiling
 
 
+@profiling.profiled('removePoints')
 def removePoints(PointCloud, BoundaryCond):
     minX = BoundaryCond['minX']
     maxX = BoundaryCond['maxX']
@@ -33,9 +36,42 @@ def removePoints(PointCloud, BoundaryCond):
     return PointCloud
 
 
-def makeBVFeature(PointCloud_, Discretization, bc):
+@profiling.profiled('voxel_downsample')
+def voxel_downsample(PointCloud, Discretization, z_bin_size=None):
+    """Merge the points (output of removePoints) of every (x, y, z bin) voxel of the BEV grid into its top point.
+    Returns the kept points, in their original order, and the number of points each of them stands for: with
+    makeBVFeature(points, ..., counts=counts) the height, intensity and density maps are the ones of the full scan.
+    :param z_bin_size: the height of the voxels, None for one voxel per BEV cell
+    """
+    Width = cnf.BEV_WIDTH + 1
+
+    # Same cells as makeBVFeature
+    x_cells = np.int_(np.floor(PointCloud[:, 0] / Discretization))
+    y_cells = np.int_(np.floor(PointCloud[:, 1] / Discretization) + Width / 2)
+    keys = x_cells * Width + y_cells
+    if z_bin_size is not None:
+        z_bins = np.int_(np.floor(PointCloud[:, 2] / z_bin_size))
+        keys = keys * (z_bins.max(initial=0) + 1) + z_bins
+
+    # The top point of a voxel is its first one once sorted by -z (stable, as in makeBVFeature)
+    order = np.lexsort((-PointCloud[:, 2], keys))
+    sorted_keys = keys[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, len(order)))
+
+    kept = order[starts]
+    kept_order = np.argsort(kept)
+    return PointCloud[kept[kept_order]], counts[kept_order]
+
+
+def get_bev_cells(PointCloud_, Discretization, bc, counts=None):
+    """The occupied cells of the BEV grid: their rows, columns and (intensity, height, density) features, computed
+    from the top point of every cell.
+    :param counts: the number of points every point stands for (see voxel_downsample()), None for 1
+    """
 
-    Height = cnf.BEV_HEIGHT + 1
     Width = cnf.BEV_WIDTH + 1
 
     # Discretize Feature Map
@@ -46,36 +82,108 @@ def makeBVFeature(PointCloud_, Discretization, bc):
     # sort-3times
     indices = np.lexsort((-PointCloud[:, 2], PointCloud[:, 1], PointCloud[:, 0]))   #ok
     PointCloud = PointCloud[indices]    #ok
+    if counts is not None:
+        counts = counts[indices]
 
-    # Height Map
-    heightMap = np.zeros((Height, Width))
+    if counts is None:
+        _, indices, counts = np.unique(PointCloud[:, 0:2], axis=0, return_index=True, return_counts=True)
+    else:
+        _, indices = np.unique(PointCloud[:, 0:2], axis=0, return_index=True)
+        # the points of a cell are contiguous once sorted
+        counts = np.add.reduceat(counts, indices)
+    PointCloud_top = PointCloud[indices]
 
-    _, indices = np.unique(PointCloud[:, 0:2], axis=0, return_index=True)
-    PointCloud_frac = PointCloud[indices]
     # some important problem is image coordinate is (y,x), not (x,y)
     max_height = float(np.abs(bc['maxZ'] - bc['minZ']))
-    heightMap[np.int_(PointCloud_frac[:, 0]), np.int_(PointCloud_frac[:, 1])] = PointCloud_frac[:, 2] / max_height
+    heights = PointCloud_top[:, 2] / max_height
+    normalizedCounts = np.minimum(1.0, np.log(counts + 1) / np.log(64))
 
-    # Intensity Map & DensityMap
-    intensityMap = np.zeros((Height, Width))
-    densityMap = np.zeros((Height, Width))
+    rows = np.int_(PointCloud_top[:, 0])
+    cols = np.int_(PointCloud_top[:, 1])
+    # the grid is cropped to BEV_HEIGHT x BEV_WIDTH
+    inside = (rows < cnf.BEV_HEIGHT) & (cols < cnf.BEV_WIDTH)
+    # b_map, g_map, r_map
+    features = np.stack([PointCloud_top[:, 3], heights, normalizedCounts], axis=1)
 
-    _, indices, counts = np.unique(PointCloud[:, 0:2], axis=0, return_index=True, return_counts=True)
-    PointCloud_top = PointCloud[indices]
+    return rows[inside], cols[inside], features[inside]
 
-    normalizedCounts = np.minimum(1.0, np.log(counts + 1) / np.log(64))
 
-    intensityMap[np.int_(PointCloud_top[:, 0]), np.int_(PointCloud_top[:, 1])] = PointCloud_top[:, 3]
-    densityMap[np.int_(PointCloud_top[:, 0]), np.int_(PointCloud_top[:, 1])] = normalizedCounts
+@profiling.profiled('makeBVFeature')
+def makeBVFeature(PointCloud_, Discretization, bc, counts=None):
+    """
+    :param counts: the number of points every point stands for (see voxel_downsample()), None for 1
+    """
+    rows, cols, features = get_bev_cells(PointCloud_, Discretization, bc, counts=counts)
 
-    RGB_Map = np.zeros((3, Height - 1, Width - 1))
-    RGB_Map[2, :, :] = densityMap[:cnf.BEV_HEIGHT, :cnf.BEV_WIDTH]  # r_map
-    RGB_Map[1, :, :] = heightMap[:cnf.BEV_HEIGHT, :cnf.BEV_WIDTH]  # g_map
-    RGB_Map[0, :, :] = intensityMap[:cnf.BEV_HEIGHT, :cnf.BEV_WIDTH]  # b_map
+    RGB_Map = np.zeros((3, cnf.BEV_HEIGHT, cnf.BEV_WIDTH))
+    RGB_Map[:, rows, cols] = features.T
 
     return RGB_Map
 
 
+@profiling.profiled('makeBVFeature')
+def makeBVFeatureSparse(PointCloud_, Discretization, bc, counts=None):
+    """The sparse BEV map, without the dense grid: the flat indices (int32, row * BEV_WIDTH + col) of the occupied
+    cells and their (num_cells, 3) features, the channels of makeBVFeature()
+    """
+    rows, cols, features = get_bev_cells(PointCloud_, Discretization, bc, counts=counts)
+
+    return (rows * cnf.BEV_WIDTH + cols).astype(np.int32), features
+
+
+@profiling.profiled('adjust_pointcloud')
+def adjust_pointcloud(pcd_data, pcd_ratio_vars=None, out=None):
+    """Scale the x, y of a scan (ratio kept) and offset x, y, z so that it fits into the boundary.
+    Returns the adjusted points and the [pcd_ratio, x_offset, y_offset, z_offset] variables, which are also
+    applied to the labels of the scan.
+    :param pcd_ratio_vars: the cached variables of the scan (see pcd_metadata.py), its min/max are then skipped
+    :param out: the array of the adjusted points, out=pcd_data adjusts the scan in place
+    """
+    if pcd_ratio_vars is None:
+        pcd_ratio_vars = pcd_metadata.get_pcd_ratio_vars(pcd_metadata.compute_extents(pcd_data))
+    pcd_ratio, x_offset, y_offset, z_offset = pcd_ratio_vars
+    if out is None:
+        out = np.empty_like(pcd_data[:, :3])
+
+    # resize the x, y and offset x, y, z (bypassing the ratio)
+    np.multiply(pcd_data[:, :2], pcd_ratio, out=out[:, :2])
+    out[:, 0] += x_offset
+    out[:, 1] += y_offset
+    np.add(pcd_data[:, 2], z_offset, out=out[:, 2])
+
+    return out, pcd_ratio_vars
+
+
+def check_scan(points):
+    """Raise a ValueError if a raw scan is not an (N, 4+) x, y, z, intensity array that adjust_pointcloud() can fit
+    into the boundary (at least 2 points and a non-zero x or y extent)"""
+    if not isinstance(points, np.ndarray):
+        raise ValueError('Expected a numpy array, got {}'.format(type(points).__name__))
+    if (points.ndim != 2) or (points.shape[1] < 4):
+        raise ValueError('Expected an (N, 4) array, got {}'.format(points.shape))
+    if len(points) < 2:
+        raise ValueError('Expected at least 2 points, got {}'.format(len(points)))
+    xy = points[:, :2]
+    if not np.any(xy.max(axis=0) > xy.min(axis=0)):
+        raise ValueError('The points have no x or y extent')
+
+
+def pointcloud_to_bev(points, intensities, downsample=False):
+    """Rasterize a raw scan (xyz of shape (N, 3) and intensities of shape (N,)) as the dataset does.
+    Returns the 3 x BEV_HEIGHT x BEV_WIDTH map and the ratio variables of adjust_pointcloud()
+    :param downsample: merge the points of every voxel first (see voxel_downsample()), the map is the same
+    """
+    adjusted_pcd, pcd_ratio_vars = adjust_pointcloud(points)
+    lidarData = np.concatenate([adjusted_pcd, intensities[:, None]], axis=1).astype(np.float32)
+    b = removePoints(lidarData, cnf.boundary)
+    counts = None
+    if downsample:
+        b, counts = voxel_downsample(b, cnf.DISCRETIZATION, z_bin_size=cnf.DISCRETIZATION)
+    rgb_map = makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary, counts=counts)
+
+    return rgb_map, pcd_ratio_vars
+
+
 def read_labels_for_bevbox(objects):# WORK IN PRGRESS 22/06
     bbox_selected = []
     for obj in objects:
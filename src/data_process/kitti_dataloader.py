@@ -11,12 +11,55 @@
 import sys
 
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler
 
 sys.path.append('../')
 
 from data_process.kitti_dataset import KittiDataset
-from data_process.transformation import Compose, OneOf, Random_Rotation, Random_Scaling, Horizontal_Flip, Cutout
+from data_process.kitti_shards import KittiShardIterable
+from data_process.valid_samples import get_stratified_indices
+from utils import profiling
+from utils.torch_utils import prepare_bev_input
+from data_process.transformation import Compose, OneOf, Random_Rotation, Random_Scaling, Horizontal_Flip, Cutout, \
+    Batch_Mosaic, Batch_Multiscale
+
+
+class SeededRandomSampler(Sampler):
+    """Shuffle the samples with a permutation drawn from (seed, epoch), as DistributedSampler does for every rank,
+    so that a run resumed at a given epoch visits the samples in the same order"""
+
+    def __init__(self, data_source, seed):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator).tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class UnpaddedDistributedSampler(Sampler):
+    """Strided, unshuffled split of the samples between the ranks. Unlike DistributedSampler, the shards are not padded
+    to the same length, so every sample is evaluated exactly once"""
+
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        self.data_source = data_source
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_source), self.num_replicas))
 
 
 def create_train_dataloader(configs):
@@ -33,31 +76,80 @@ def create_train_dataloader(configs):
                p=configs.cutout_prob)
     ], p=1.)
 
+    # Mosaic and multiscale are applied batch-wise in the training step by create_train_batch_transforms()
+    on_workers = not configs.device_augment
+    if (configs.shards_dir is not None) and configs.mosaic and on_workers:
+        raise ValueError('Mosaics of random samples defeat the sequential shard reads, use --device_augment')
+    if (configs.seed is not None) and configs.multiscale_training and (not configs.mosaic) and on_workers:
+        # the workers draw the sizes from their own copy of a batch counter, which is not reproducible
+        raise ValueError('The multiscale resize of the workers cannot be seeded, use --device_augment')
+    if configs.sparse_bev and (configs.multiscale_training or configs.mosaic) and on_workers:
+        # the mosaics are filled with 0.5, all their cells would be sent
+        raise ValueError('The mosaics and the multiscale resize of the workers need the dense maps, use '
+                         '--device_augment')
     train_dataset = KittiDataset(configs.dataset_dir, mode='train', lidar_transforms=train_lidar_transforms,
-                                 aug_transforms=train_aug_transforms, multiscale=configs.multiscale_training,
-                                 num_samples=configs.num_samples, mosaic=configs.mosaic,
-                                 random_padding=configs.random_padding)
+                                 aug_transforms=train_aug_transforms,
+                                 multiscale=configs.multiscale_training and on_workers,
+                                 num_samples=configs.num_samples, mosaic=configs.mosaic and on_workers,
+                                 random_padding=configs.random_padding, seed=configs.seed,
+                                 shards_dir=configs.shards_dir, voxel_downsample=configs.voxel_downsample,
+                                 bev_store_dir=configs.bev_store_dir, bev_store_dtype=configs.bev_store_dtype,
+                                 bev_dtype=configs.bev_dtype, sparse_bev=configs.sparse_bev)
+    if configs.shards_dir is not None:
+        # The shards are split between the ranks and read sequentially, no sampler
+        rank, world_size = (configs.rank, configs.world_size) if configs.distributed else (0, 1)
+        shard_iterable = KittiShardIterable(train_dataset, configs.batch_size, seed=configs.seed, rank=rank,
+                                            world_size=world_size)
+        # The iterable yields collated batches, the same number on every rank
+        train_dataloader = DataLoader(shard_iterable, batch_size=None, pin_memory=configs.pin_memory,
+                                      num_workers=configs.num_workers, worker_init_fn=profiling.init_worker)
+        return train_dataloader, None
+
     train_sampler = None
     if configs.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-        
+    elif configs.seed is not None:
+        train_sampler = SeededRandomSampler(train_dataset, seed=configs.seed)
+
     train_dataloader = DataLoader(train_dataset, batch_size=configs.batch_size, shuffle=(train_sampler is None),
                                   pin_memory=configs.pin_memory, num_workers=configs.num_workers, sampler=train_sampler,
-                                  collate_fn=train_dataset.collate_fn)
+                                  collate_fn=train_dataset.collate_fn, worker_init_fn=profiling.init_worker)
 
     return train_dataloader, train_sampler
 
 
-def create_val_dataloader(configs):
-    """Create dataloader for validation"""
+def create_train_batch_transforms(configs):
+    """Create the mosaic or multiscale transform which runs on a whole batch in the training step"""
+    if not configs.device_augment:
+        return None
+
+    if configs.mosaic:
+        return Batch_Mosaic(img_size=configs.img_size, random_padding=configs.random_padding)
+    if configs.multiscale_training:
+        rank = max(configs.rank, 0) if configs.distributed else 0
+        return Batch_Multiscale(img_size=configs.img_size, seed=configs.seed, rank=rank)
+
+    return None
+
+
+def create_val_dataloader(configs, subset_size=None):
+    """Create dataloader for validation
+    :param subset_size: if set, only a fixed subset of subset_size samples, stratified by class (proxy validation)
+    """
     val_sampler = None
     val_dataset = KittiDataset(configs.dataset_dir, mode='val', lidar_transforms=None, aug_transforms=None,
-                               multiscale=False, num_samples=configs.num_samples, mosaic=False, random_padding=False)
+                               multiscale=False, num_samples=configs.num_samples, mosaic=False, random_padding=False,
+                               shards_dir=configs.shards_dir, voxel_downsample=configs.voxel_downsample,
+                               bev_store_dir=configs.bev_store_dir, bev_store_dtype=configs.bev_store_dtype,
+                               bev_dtype=configs.bev_dtype, sparse_bev=configs.sparse_bev)
+    if (subset_size is not None) and (subset_size < len(val_dataset)):
+        sample_classes = [val_dataset.get_label_classes(sample_id) for sample_id in val_dataset.sample_id_list]
+        val_dataset.select_samples(get_stratified_indices(sample_classes, subset_size, seed=0))
     if configs.distributed:
-        val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+        val_sampler = UnpaddedDistributedSampler(val_dataset)
     val_dataloader = DataLoader(val_dataset, batch_size=configs.batch_size, shuffle=False,
                                 pin_memory=configs.pin_memory, num_workers=configs.num_workers, sampler=val_sampler,
-                                collate_fn=val_dataset.collate_fn)
+                                collate_fn=val_dataset.collate_fn, worker_init_fn=profiling.init_worker)
 
     return val_dataloader
 
@@ -66,12 +158,16 @@ def create_test_dataloader(configs):
     """Create dataloader for testing phase"""
 
     test_dataset = KittiDataset(configs.dataset_dir, mode='test', lidar_transforms=None, aug_transforms=None,
-                                multiscale=False, num_samples=configs.num_samples, mosaic=False, random_padding=False)
+                                multiscale=False, num_samples=configs.num_samples, mosaic=False, random_padding=False,
+                                voxel_downsample=configs.voxel_downsample, bev_store_dir=configs.bev_store_dir,
+                                bev_store_dtype=configs.bev_store_dtype, bev_dtype=configs.bev_dtype,
+                                sparse_bev=configs.sparse_bev)
     test_sampler = None
     if configs.distributed:
         test_sampler = torch.utils.data.distributed.DistributedSampler(test_dataset)
     test_dataloader = DataLoader(test_dataset, batch_size=configs.batch_size, shuffle=False,
-                                 pin_memory=configs.pin_memory, num_workers=configs.num_workers, sampler=test_sampler)
+                                 pin_memory=configs.pin_memory, num_workers=configs.num_workers, sampler=test_sampler,
+                                 collate_fn=test_dataset.collate_test_fn, worker_init_fn=profiling.init_worker)
 
     return test_dataloader
 
@@ -115,6 +211,25 @@ if __name__ == '__main__':
                         help='If true, compose training samples as mosaics')
     parser.add_argument('--random-padding', action='store_true',
                         help='If true, random padding if using mosaic augmentation')
+    parser.add_argument('--device_augment', action='store_true',
+                        help='If true, compose mosaics and multiscale batches in the training step, not in the workers')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='If set, the augmentations of every (epoch, sample) are reproducible')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='If set, read the packed dataset (see data_process/kitti_shards.py) from this directory')
+    parser.add_argument('--voxel_downsample', action='store_true',
+                        help='If true, merge the points of every BEV voxel before the rasterization (same BEV maps)')
+    parser.add_argument('--bev_store_dir', type=str, default=None, metavar='PATH',
+                        help='If set, the BEV maps are built once into a memory-mapped store in this directory, '
+                             'shared by the processes of the host (see data_process/bev_store.py)')
+    parser.add_argument('--bev_store_dtype', type=str, default='uint8', choices=['uint8', 'float16'],
+                        help='The dtype of the stored BEV maps')
+    parser.add_argument('--bev_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='The dtype of the BEV maps between the dataloader workers and the device, they are '
+                             'converted to float on the device (uint8: 1/255 steps)')
+    parser.add_argument('--sparse_bev', action='store_true',
+                        help='If true, only the occupied cells of the BEV maps (and their features) go through the '
+                             'dataloader, the maps are densified on the device (for mostly empty grids)')
     parser.add_argument('--show-train-data', action='store_true',
                         help='If true, random padding if using mosaic augmentation')
     parser.add_argument('--debuggs', action='store_true',
@@ -135,8 +250,10 @@ if __name__ == '__main__':
         if not os.path.isdir(configs.saved_dir):
             os.makedirs(configs.saved_dir)
 
+    batch_transforms = None
     if configs.show_train_data:
         dataloader, _ = create_train_dataloader(configs)
+        batch_transforms = create_train_batch_transforms(configs)
         print('len train dataloader: {}'.format(len(dataloader)))
     else:
         dataloader = create_val_dataloader(configs)
@@ -145,6 +262,9 @@ if __name__ == '__main__':
     print('\n\nPress n to see the next sample >>> Press Esc to quit...')
     count_imgs = 0
     for batch_i, (img_files, imgs, targets) in enumerate(dataloader):
+        imgs = prepare_bev_input(imgs, torch.device('cpu'))
+        if batch_transforms is not None:
+            imgs, targets = batch_transforms(imgs, targets, batch_idx=batch_i)
         if not (configs.mosaic and configs.show_train_data):
             img_file = img_files[0]
             img_rgb = cv2.imread(img_file)
@@ -19,19 +19,20 @@ from torch.utils.data import Dataset
 import torch
 import torch.nn.functional as F
 import cv2
-# for pcd from poly reading 
-import open3d as o3d
-#   import etme to time during debugging
-import time
 sys.path.append('../')
 
-from data_process import transformation, kitti_bev_utils, kitti_data_utils, ply_data_utils
+from data_process import transformation, kitti_bev_utils, kitti_data_utils, ply_data_utils, kitti_shards, \
+    valid_samples, pcd_metadata, bev_store
 import config.kitti_config as cnf
+from utils import profiling
+from utils.torch_utils import BEV_DTYPES, to_bev_dtype, to_sparse_bev, SparseBevBatch, prepare_bev_input
 
 
 class KittiDataset(Dataset):
     def __init__(self, dataset_dir, mode='train', lidar_transforms=None, aug_transforms=None, multiscale=False,
-                 num_samples=None, mosaic=False, random_padding=False):
+                 num_samples=None, mosaic=False, random_padding=False, seed=None, shards_dir=None,
+                 voxel_downsample=False, bev_store_dir=None, bev_store_dtype='uint8', bev_dtype='float32',
+                 sparse_bev=False):
         self.dataset_dir = dataset_dir
         assert mode in ['train', 'val', 'test'], 'Invalid mode: {}'.format(mode)
         self.mode = mode
@@ -48,13 +49,25 @@ class KittiDataset(Dataset):
         self.mosaic = mosaic
         self.random_padding = random_padding
         self.mosaic_border = [-self.img_size // 2, -self.img_size // 2]
+        # Augmentations draw from a random state keyed by (seed, epoch, sample_id), see get_rng()
+        self.seed = seed
+        self.epoch = 0
+        # Merge the points of every BEV voxel before the rasterization, the BEV map is unchanged
+        self.voxel_downsample = voxel_downsample
 
         self.lidar_dir = os.path.join(self.dataset_dir, sub_folder, "velodyne")
         self.image_dir = os.path.join(self.dataset_dir, sub_folder, "image_2")
         self.calib_dir = os.path.join(self.dataset_dir, sub_folder, "calib")
         self.label_dir = os.path.join(self.dataset_dir, sub_folder, "label_2")
-        split_txt_path = os.path.join(self.dataset_dir, 'ImageSets', '{}.txt'.format(mode))
-        self.image_idx_list = [x.strip() for x in open(split_txt_path).readlines()]
+        # Packed dataset: points (and BEV maps) are read from shards, labels from the label index
+        self.shards_dir = shards_dir
+        self.shard_cache = None
+        if self.shards_dir is not None:
+            self.shard_index = kitti_shards.ShardIndex(self.shards_dir, mode)
+            self.image_idx_list = self.shard_index.sample_ids
+        else:
+            split_txt_path = os.path.join(self.dataset_dir, 'ImageSets', '{}.txt'.format(mode))
+            self.image_idx_list = [x.strip() for x in open(split_txt_path).readlines()]
 
         self.labels_list = self.read_all_label()
         if self.is_test:
@@ -65,7 +78,20 @@ class KittiDataset(Dataset):
         if num_samples is not None:
             self.sample_id_list = self.sample_id_list[:num_samples]
         self.num_samples = len(self.sample_id_list)
-
+        # Cached extents/ratio variables of the scans (see build_pcd_metadata()), the others are computed on the fly
+        self.scan_metadata = pcd_metadata.get_metadata(self, self.sample_id_list, read_missing=False)
+        # Quantized BEV maps shared through a memmap by the processes of the host, built by the first one
+        self.bev_store = None
+        if bev_store_dir is not None:
+            self.bev_store = bev_store.open_store(self, bev_store_dir, dtype=bev_store_dtype)
+        # dtype of the maps out of __getitem__, prepare_bev_input() makes them float on the device
+        assert bev_dtype in BEV_DTYPES, 'Invalid BEV dtype: {}'.format(bev_dtype)
+        self.bev_dtype = bev_dtype
+        # Only the occupied cells of the maps (and their features) go through the dataloader, see to_sparse_bev()
+        assert not (sparse_bev and (multiscale or mosaic)), 'The mosaics and the multiscale resize need the dense maps'
+        self.sparse_bev = sparse_bev
+
+    @profiling.profiled('load_sample')
     def __getitem__(self, index):
         if self.is_test:
             return self.load_img_only(index)
@@ -73,42 +99,79 @@ class KittiDataset(Dataset):
             if self.mosaic:
                 img_files, rgb_map, targets = self.load_mosaic(index)
 
-                return img_files[0], rgb_map, targets
+                return img_files[0], to_bev_dtype(rgb_map, self.bev_dtype), targets
+            elif self.sparse_bev and (self.aug_transforms is None):
+                return self.load_sparse_with_targets(index)
             else:
-                return self.load_img_with_targets(index)
+                img_file, rgb_map, targets = self.load_img_with_targets(index)
+                return img_file, self.to_transport(rgb_map), targets
+
+    def to_transport(self, rgb_map):
+        """A dense map as it goes through the dataloader: in bev_dtype, sparse with sparse_bev"""
+        rgb_map = to_bev_dtype(rgb_map, self.bev_dtype)
+        return to_sparse_bev(rgb_map) if self.sparse_bev else rgb_map
 
     def load_img_only(self, index):
         """Load only image for the testing phase"""
 
         sample_id = int(self.sample_id_list[index])
-        lidarData = self.get_lidar(sample_id)
-        b = kitti_bev_utils.removePoints(lidarData, cnf.boundary)
-        rgb_map = kitti_bev_utils.makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary)
         img_file = os.path.join(self.image_dir, '{:06d}.png'.format(sample_id))
+        if self.sparse_bev:
+            sparse_map, _ = self.get_sparse_bev_map(sample_id)
+            return img_file, sparse_map
+        rgb_map, _ = self.get_bev_map(sample_id)
 
-        return img_file, rgb_map
+        return img_file, self.to_transport(torch.from_numpy(rgb_map))
 
    
 
-    def load_img_with_targets(self, index):
+    def set_epoch(self, epoch):
+        """Select the augmentation stream of an epoch, must be called before iterating over the dataloader"""
+        self.epoch = epoch
+
+    def get_rng(self, index):
+        """Return the random state used to augment a sample.
+        With a seed, every (epoch, sample) pair gets its own stream, independent of the worker which loads it, so an
+        augmented sample can be reproduced (or cached) from its key and a resumed run continues the same stream.
+        """
+        if self.seed is None:
+            return np.random
+        sample_id = int(self.sample_id_list[index])
+        return np.random.RandomState([self.seed, self.epoch, sample_id])
+
+    def load_img_with_targets(self, index, rng=None):
         """Load images and targets for the training and validation phase"""
 
+        if rng is None:
+            rng = self.get_rng(index)
         sample_id = int(self.sample_id_list[index])
-        lidarData, pcd_ratio_vars = self.get_ply(sample_id)
+        rgb_map, pcd_ratio_vars = self.get_bev_map(sample_id)
+        img_file, targets = self.load_targets(sample_id, pcd_ratio_vars)
+
+        rgb_map = torch.from_numpy(rgb_map).float()
+
+        if self.aug_transforms is not None:
+            with profiling.span('aug_transforms'):
+                rgb_map, targets = self.aug_transforms(rgb_map, targets, rng=rng)
+
+        return img_file, rgb_map, targets
+
+    def load_sparse_with_targets(self, index):
+        """Load the sparse map and the targets of a sample which is not augmented"""
+
+        sample_id = int(self.sample_id_list[index])
+        sparse_map, pcd_ratio_vars = self.get_sparse_bev_map(sample_id)
+        img_file, targets = self.load_targets(sample_id, pcd_ratio_vars)
+
+        return img_file, sparse_map, targets
+
+    def load_targets(self, sample_id, pcd_ratio_vars):
+        """The image file and the targets of a sample, its labels go through the ratio variables of its scan"""
+
         objects = self.get_label(sample_id, pcd_ratio=pcd_ratio_vars)
-        calib = self.get_calib(sample_id)
-        labels, noObjectLabels = kitti_bev_utils.read_labels_for_bevbox_ply(objects)
-
-        if not noObjectLabels:
-            old_labels = np.array([[2,2],[3,3]])#transformation.camera_to_lidar_box(labels[:, 1:], calib.V2C, calib.R0,
-                                  #                             calib.P)  # convert rect cam to velo cord
-                                                               # return a label of shape x, y, z, h, w, l, rz
-
-        b = kitti_bev_utils.removePoints(lidarData, cnf.boundary)  # temporrary removed for testing purpose
-        rgb_map = kitti_bev_utils.makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary)
-        # check fr the labels(5, 8)
-        
-        target = kitti_bev_utils.build_yolo_target(labels) 
+        labels, _ = kitti_bev_utils.read_labels_for_bevbox_ply(objects)
+
+        target = kitti_bev_utils.build_yolo_target(labels)
         img_file = os.path.join(self.image_dir, '{:06d}.png'.format(sample_id))
 
         # on image space: targets are formatted as (box_idx, class, x, y, w, l, im, re)
@@ -117,12 +180,7 @@ class KittiDataset(Dataset):
         if n_target > 0:
             targets[:, 1:] = torch.from_numpy(target)
 
-        rgb_map = torch.from_numpy(rgb_map).float()
-
-        if self.aug_transforms is not None:
-            rgb_map, targets = self.aug_transforms(rgb_map, targets)
-
-        return img_file, rgb_map, targets
+        return img_file, targets
 
     def load_mosaic(self, index):
         """loads images in a mosaic
@@ -131,15 +189,16 @@ class KittiDataset(Dataset):
 
         targets_s4 = []
         img_file_s4 = []
+        rng = self.get_rng(index)
         if self.random_padding:
-            yc, xc = [int(random.uniform(-x, 2 * self.img_size + x)) for x in self.mosaic_border]  # mosaic center
+            yc, xc = [int(rng.uniform(-x, 2 * self.img_size + x)) for x in self.mosaic_border]  # mosaic center
         else:
             yc, xc = [self.img_size, self.img_size]  # mosaic center
 
-        indices = [index] + [random.randint(0, self.num_samples - 1) for _ in range(3)]  # 3 additional image indices
+        indices = [index] + [rng.randint(0, self.num_samples) for _ in range(3)]  # 3 additional image indices
         for i, index in enumerate(indices):
             
-            img_file, img, targets = self.load_img_with_targets(index)
+            img_file, img, targets = self.load_img_with_targets(index, rng=rng)
             img_file_s4.append(img_file)
 
             c, h, w = img.size()  # (3, 608, 608), torch tensor
@@ -181,31 +240,15 @@ class KittiDataset(Dataset):
         return len(self.sample_id_list)
 
     def remove_invalid_idx(self, image_idx_list):
-        """Discard samples which don't have current training class objects, which will not be used for training."""
-
-        sample_id_list = []
-        for sample_id in image_idx_list:
-            sample_id = int(sample_id)
-            objects = self.get_label(sample_id) # Get a list of 3D objects from data_utils
-            # Not used in purely 3D point cloud based training
-            # calib = self.get_calib(sample_id)
-            labels, noObjectLabels = kitti_bev_utils.read_labels_for_bevbox_ply(objects)
-            if not noObjectLabels:
-                old_labels = np.array([[2,2],[3,3]])
-                """not used because we don't have any camera data as the new
-                   dataset is purely 3D based """
-                # labels[:, 1:] = transformation.camera_to_lidar_box(labels[:, 1:], calib.V2C, calib.R0,
-                #                                                    calib.P)  # convert rect cam to velo cord
-                                                                    # return a label of shape x, y, z, h, w, l, rz
-
-            valid_list = []
-            for i in range(labels.shape[0]):
-                if int(labels[i, 0]) in np.arange(0,len(self.labels_list)):    #cnf.CLASS_NAME_TO_ID.values():
-                    # if self.check_point_cloud_range(labels[i, 1:4]):
-                    valid_list.append(labels[i, 0])
-            if len(valid_list) > 0:
-                sample_id_list.append(sample_id)
-        return sample_id_list
+        """Discard samples which don't have current training class objects, which will not be used for training.
+        Only the labels are read, and the scan is persisted in ImageSets/<mode>_valid.json to be reused.
+        """
+        if self.shards_dir is not None:
+            return valid_samples.get_valid_sample_ids_from_index(self.shard_index.label_index, image_idx_list,
+                                                                 self.labels_list)
+        manifest_path = os.path.join(self.dataset_dir, 'ImageSets', '{}_valid.json'.format(self.mode))
+        return valid_samples.get_valid_sample_ids(self.label_dir, image_idx_list, self.labels_list,
+                                                  manifest_path=manifest_path)
 
     def check_point_cloud_range(self, xyz):
         """
@@ -232,70 +275,129 @@ class KittiDataset(Dataset):
         # Selects new image size every tenth batch
         if (self.batch_count % 10 == 0) and self.multiscale and (not self.mosaic):
             self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
+        if self.sparse_bev:
+            self.batch_count += 1
+            return paths, SparseBevBatch.from_samples(imgs), targets
         # Resize images to input shape
         imgs = torch.stack(imgs)
         if self.img_size != cnf.BEV_WIDTH:
-            imgs = F.interpolate(imgs, size=self.img_size, mode="bilinear", align_corners=True)
+            imgs = F.interpolate(prepare_bev_input(imgs, imgs.device), size=self.img_size, mode="bilinear",
+                                 align_corners=True)
+            imgs = to_bev_dtype(imgs, self.bev_dtype)
         self.batch_count += 1
 
         return paths, imgs, targets
 
+    def collate_test_fn(self, batch):
+        paths, imgs = list(zip(*batch))
+        if self.sparse_bev:
+            return list(paths), SparseBevBatch.from_samples(imgs)
+        return list(paths), torch.stack(imgs)
+
     def get_image(self, idx):
         img_file = os.path.join(self.image_dir, '{:06d}.png'.format(idx))
         # assert os.path.isfile(img_file)
         return cv2.imread(img_file)  # (H, W, C) -> (H, W, 3) OpenCV reads in BGR mode
 
-    def adjust_pointcloud(self, pcd_data):
-        # get the max value of pcd
-        x_range = [cnf.boundary["minX"], cnf.boundary["maxX"]]
-        y_range = [cnf.boundary["minY"], cnf.boundary["maxY"]]
-        z_range = [cnf.boundary["minZ"], cnf.boundary["maxZ"]]
-
-        range_pcd_x = [np.amin(pcd_data[:,0]), np.amax(pcd_data[:,0])]
-        range_pcd_y = [np.amin(pcd_data[:,1]), np.amax(pcd_data[:,1])]
-        min_pcd_z = np.amin(pcd_data[:,2])
-
-        # the max range multiplied is
-        max_range = np.min([x_range[1] - x_range[0], y_range[1] - y_range[0]])
-        pcd_ratio = ((max_range)/np.amax([range_pcd_x[1] - range_pcd_x[0], 
-                                          range_pcd_y[1] - range_pcd_y[0]]))
-        # resize the x, y bypassing the z later
-        new_pcd = pcd_ratio * pcd_data
-
-        # calculate offset
-        x_offset = x_range[0] - np.amin(new_pcd[:,0])
-        y_offset = y_range[0] - np.amin(new_pcd[:,1]) 
-        z_offset = z_range[0] - min_pcd_z
-
-        # offset x, y (and z bypassing the ratio)
-        new_pcd[:,0] = new_pcd[:,0] + x_offset
-        new_pcd[:,1] = new_pcd[:,1] + y_offset
-        new_pcd[:,2] = pcd_data[:,2] + z_offset
-
-        range_pcd_x = [np.amin(new_pcd[:,0]), np.amax(new_pcd[:,0])]
-        range_pcd_y = [np.amin(new_pcd[:,1]), np.amax(new_pcd[:,1])]
-        range_pcd_z = [np.amin(new_pcd[:,2]), np.amax(new_pcd[:,2])]
-        print('X range ', range_pcd_x)
-        print('Y range ', range_pcd_y)
-        print('Z range ', range_pcd_z)
-
-        pcd_ratio_var = [pcd_ratio, x_offset, y_offset, z_offset]
-        return new_pcd, pcd_ratio_var
+    def adjust_pointcloud(self, pcd_data, idx=None, out=None):
+        """Fit a scan into the boundary, with the cached ratio variables of the sample idx if there are some"""
+        metadata = self.scan_metadata.get(idx)
+        pcd_ratio_vars = None if metadata is None else metadata['pcd_ratio_vars']
+        return kitti_bev_utils.adjust_pointcloud(pcd_data, pcd_ratio_vars=pcd_ratio_vars, out=out)
+
+    def build_pcd_metadata(self, num_threads=None):
+        """Read the scans missing from the metadata table (in parallel threads) and persist their metadata"""
+        self.scan_metadata = pcd_metadata.get_metadata(self, self.sample_id_list, num_threads=num_threads)
+
+    def get_pcd_ratio_vars(self, idx):
+        """The ratio variables of a sample, the scan is only read if they are not cached"""
+        metadata = self.scan_metadata.get(int(idx))
+        if metadata is not None:
+            return metadata['pcd_ratio_vars']
+        points, _ = self.read_ply(idx)
+        return pcd_metadata.get_pcd_ratio_vars(pcd_metadata.compute_extents(points))
+
+    def get_bev_map(self, idx):
+        """Return the BEV map of a sample and the ratio variables used to fit its point cloud into the boundary"""
+        if (self.bev_store is not None) and (idx in self.bev_store):
+            stored_map, pcd_ratio_vars = self.bev_store.get(idx)
+            # new float32 array, the augmentations modify the map in place
+            return bev_store.dequantize_bev(stored_map), pcd_ratio_vars
+        return self.compute_bev_map(idx)
+
+    def get_sparse_bev_map(self, idx):
+        """The sparse map of a sample (to_sparse_bev(), in bev_dtype) and its ratio variables. A scan is rasterized
+        straight into its occupied cells, without the dense grid"""
+        if ((self.bev_store is not None) and (idx in self.bev_store)) or \
+                ((self.shards_dir is not None) and self.shard_index.with_bev):
+            rgb_map, pcd_ratio_vars = self.get_bev_map(idx)
+            return self.to_transport(torch.from_numpy(rgb_map)), pcd_ratio_vars
+
+        lidarData, pcd_ratio_vars = self.get_ply(idx)
+        cells, features = self.make_bev_map(lidarData, sparse=True)
+        features = to_bev_dtype(torch.from_numpy(features), self.bev_dtype)
+        return (torch.from_numpy(cells), features, (cnf.BEV_HEIGHT, cnf.BEV_WIDTH)), pcd_ratio_vars
+
+    def compute_bev_map(self, idx):
+        """The BEV map of a sample (precomputed in its shard, or rasterized from its scan) and its ratio variables"""
+        if (self.shards_dir is not None) and self.shard_index.with_bev:
+            shard_idx, pos = self.shard_index.locate(idx)
+            shard = self.get_shard(shard_idx)
+            # copy, the augmentations modify the map in place
+            return np.array(shard['bev'][pos]), list(shard['pcd_ratio_vars'][pos])
+
+        lidarData, pcd_ratio_vars = self.get_ply(idx)
+        return self.make_bev_map(lidarData), pcd_ratio_vars
+
+    def make_bev_map(self, lidarData, sparse=False):
+        """Rasterize an adjusted scan (x, y, z, intensity), into (cells, features) if sparse"""
+        b = kitti_bev_utils.removePoints(lidarData, cnf.boundary)
+        counts = None
+        if self.voxel_downsample:
+            b, counts = kitti_bev_utils.voxel_downsample(b, cnf.DISCRETIZATION, z_bin_size=cnf.DISCRETIZATION)
+        if sparse:
+            return kitti_bev_utils.makeBVFeatureSparse(b, cnf.DISCRETIZATION, cnf.boundary, counts=counts)
+        return kitti_bev_utils.makeBVFeature(b, cnf.DISCRETIZATION, cnf.boundary, counts=counts)
+
+    def get_shard(self, shard_idx):
+        """Return a shard, the last one read is kept (KittiShardIterable fills it ahead of time)"""
+        shard_cache = self.shard_cache
+        if (shard_cache is None) or (shard_cache[0] != shard_idx):
+            # local reference, the BEV store builder threads share the cache
+            shard_cache = (shard_idx, self.shard_index.load_shard(shard_idx))
+            self.shard_cache = shard_cache
+        return shard_cache[1]
+
+    @profiling.profiled('read_ply')
+    def read_ply(self, idx):
+        """Read the raw xyz points and the intensities of a scan"""
+        if self.shards_dir is not None:
+            shard_idx, pos = self.shard_index.locate(idx)
+            shard = self.get_shard(shard_idx)
+            start, end = shard['point_offsets'][pos], shard['point_offsets'][pos + 1]
+            points = shard['points'][start:end]
+            return points[:, :3].astype(np.float64), points[:, 3].astype(np.float64)
+
+        import open3d as o3d
 
-    # Function to import Ply file as a scan
-    def get_ply(self, idx):
-        start = time.time()
         # open ply file
         poly_file = os.path.join(self.lidar_dir, '{:06d}.ply'.format(idx))
         # read with open 3d as pooint cloud
         pcd = o3d.io.read_point_cloud(poly_file)
         # get the intensity channels
-        intensities = np.array(pcd.colors)
-        adjusted_pcd, pcd_ratio_vars = self.adjust_pointcloud(np.array(pcd.points))
-        # fuse the intensity to the pcd xyz to obtain array of x, y, z, i 
-        pcd_reshaped = np.concatenate([adjusted_pcd, intensities[:, [0]]], axis=1)
-        # print('Pcd function took {} s'.format(round(time.time()-start,2)))
-        return np.array(pcd_reshaped, dtype=np.float32), pcd_ratio_vars
+        return np.array(pcd.points), np.array(pcd.colors)[:, 0]
+
+    # Function to import Ply file as a scan
+    @profiling.profiled('get_ply')
+    def get_ply(self, idx):
+        points, intensities = self.read_ply(idx)
+        # read_ply returns a new float64 array, adjusted in place
+        _, pcd_ratio_vars = self.adjust_pointcloud(points, idx=int(idx), out=points)
+        # fuse the intensity to the pcd xyz to obtain array of x, y, z, i
+        lidarData = np.empty((len(points), 4), dtype=np.float32)
+        lidarData[:, :3] = points
+        lidarData[:, 3] = intensities
+        return lidarData, pcd_ratio_vars
 
     def get_lidar(self, idx):
         lidar_file = os.path.join(self.lidar_dir, '{:06d}.bin'.format(idx))
@@ -313,7 +415,28 @@ class KittiDataset(Dataset):
         lines = [line.rstrip() for line in open(label_file)]
         return lines
 
-    def get_label(self, idx, pcd_ratio=[1,0,0,0]):
+    def get_label_classes(self, idx):
+        """The known class names of the objects of a sample, only the label file is read"""
+        if self.shards_dir is not None:
+            lines = self.shard_index.label_lines(idx)
+        else:
+            with open(os.path.join(self.label_dir, '{:06d}.txt'.format(idx)), 'r') as f:
+                lines = [line.rstrip() for line in f]
+        class_names = [line.split(' ')[0] for line in lines]
+        return [class_name for class_name in class_names if class_name in self.labels_list]
+
+    def select_samples(self, indices):
+        """Keep only the samples at the given indices of the dataset"""
+        self.sample_id_list = [self.sample_id_list[index] for index in indices]
+        self.num_samples = len(self.sample_id_list)
+
+    @profiling.profiled('get_label')
+    def get_label(self, idx, pcd_ratio=None):
+        if pcd_ratio is None:
+            pcd_ratio = self.get_pcd_ratio_vars(idx)
+        if self.shards_dir is not None:
+            return ply_data_utils.parse_label_lines(self.shard_index.label_lines(idx), labels_list=self.labels_list,
+                                                    pcd_ratio=pcd_ratio)
         label_file = os.path.join(self.label_dir, '{:06d}.txt'.format(idx))
         # assert os.path.isfile(label_file)
         # new data utils file for 3D ply labeled in 3D space
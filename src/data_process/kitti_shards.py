@@ -0,0 +1,270 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Packed (sharded) storage of a dataset split
+
+A split is written into a few large shard files instead of one velodyne/*.ply and one label_2/*.txt per sample:
+    <shards_dir>/<mode>_manifest.json       list of shards and of the sample ids they hold
+    <shards_dir>/<mode>_shard_00000.npz     sample_ids, point_offsets, points (x, y, z, intensity),
+                                            pcd_ratio_vars and optionally the precomputed BEV maps
+    <shards_dir>/label_index.json           the label lines of every sample, shared by all splits
+    <shards_dir>/pcd_metadata.json          the extents and ratio variables of every sample (see pcd_metadata.py)
+Labels are kept out of the shards so that a new labelling round only rewrites the label index.
+-----------------------------------------------------------------------------------
+"""
+
+import sys
+import os
+import json
+import math
+import threading
+import queue
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+sys.path.append('../')
+
+from data_process import pcd_metadata
+
+LABEL_INDEX_FN = 'label_index.json'
+
+
+def manifest_path(shards_dir, mode):
+    return os.path.join(shards_dir, '{}_manifest.json'.format(mode))
+
+
+def load_label_index(shards_dir):
+    label_index_path = os.path.join(shards_dir, LABEL_INDEX_FN)
+    if not os.path.isfile(label_index_path):
+        return {}
+    with open(label_index_path, 'r') as f:
+        return json.load(f)
+
+
+def save_label_index(shards_dir, label_index):
+    """Write the label index atomically, readers never see a partially written file"""
+    label_index_path = os.path.join(shards_dir, LABEL_INDEX_FN)
+    tmp_path = '{}.tmp{}'.format(label_index_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(label_index, f)
+    os.replace(tmp_path, label_index_path)
+
+
+class ShardIndex(object):
+    """Where every sample of a packed split lives, and its labels"""
+
+    def __init__(self, shards_dir, mode):
+        self.shards_dir = shards_dir
+        with open(manifest_path(shards_dir, mode), 'r') as f:
+            manifest = json.load(f)
+        self.with_bev = manifest['with_bev']
+        self.shard_files = [shard['file'] for shard in manifest['shards']]
+        self.shard_sample_ids = [shard['sample_ids'] for shard in manifest['shards']]
+        self.sample_ids = [sample_id for sample_ids in self.shard_sample_ids for sample_id in sample_ids]
+        self.locations = {}
+        for shard_idx, sample_ids in enumerate(self.shard_sample_ids):
+            for pos, sample_id in enumerate(sample_ids):
+                self.locations[sample_id] = (shard_idx, pos)
+        self.label_index = load_label_index(shards_dir)
+
+    def locate(self, sample_id):
+        return self.locations[int(sample_id)]
+
+    def label_lines(self, sample_id):
+        return self.label_index['{:06d}'.format(int(sample_id))]
+
+    def load_shard(self, shard_idx):
+        """Read a whole shard sequentially"""
+        with np.load(os.path.join(self.shards_dir, self.shard_files[shard_idx])) as shard:
+            return {key: shard[key] for key in shard.files}
+
+
+class ShardReader(object):
+    """Read shards in the given order on a background thread, `prefetch` shards ahead of the consumer"""
+
+    def __init__(self, shard_index, shard_order, prefetch=1):
+        self.shard_index = shard_index
+        self.shard_order = list(shard_order)
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        for shard_idx in self.shard_order:
+            self.queue.put((shard_idx, self.shard_index.load_shard(shard_idx)))
+
+    def __iter__(self):
+        for _ in range(len(self.shard_order)):
+            yield self.queue.get()
+
+
+class KittiShardIterable(IterableDataset):
+    """Iterate over a packed KittiDataset shard by shard, in collated batches (use it with DataLoader(batch_size=None)).
+    As with DistributedSampler, the shuffled sample list is padded to a multiple of world_size and every rank gets a
+    contiguous block of it, so a rank only reads its own shards (plus at most two partially shared ones). Samples are
+    shuffled within a shard. The block of a rank is cut into batches in reading order, and the dataloader workers get
+    contiguous runs of these batches: every rank yields the same number of batches (len()), whatever the number of
+    workers, so the DDP ranks run the same number of steps.
+    """
+
+    def __init__(self, dataset, batch_size, seed=None, rank=0, world_size=1, prefetch=1):
+        assert dataset.shards_dir is not None, 'The dataset has to be created with a shards_dir'
+        self.dataset = dataset
+        self.collate_fn = dataset.collate_fn
+        self.batch_size = batch_size
+        self.seed = 0 if seed is None else seed
+        self.rank = rank
+        self.world_size = world_size
+        self.prefetch = prefetch
+        self.epoch = 0
+        # Only the samples kept by the dataset (valid ids, num_samples) are visited
+        self.index_of_sample = {int(sample_id): index for index, sample_id in enumerate(dataset.sample_id_list)}
+        self.num_samples_per_rank = int(math.ceil(len(self.index_of_sample) / float(self.world_size)))
+        self.num_batches_per_rank = int(math.ceil(self.num_samples_per_rank / float(self.batch_size)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.dataset.set_epoch(epoch)
+
+    def __len__(self):
+        return self.num_batches_per_rank
+
+    def get_rank_samples(self):
+        """Return the (shard_idx, dataset index) of the samples of this rank, in reading order"""
+        rng = np.random.RandomState([self.seed, self.epoch])
+        shard_index = self.dataset.shard_index
+        samples = []
+        for shard_idx in rng.permutation(len(shard_index.shard_files)):
+            for sample_id in shard_index.shard_sample_ids[shard_idx]:
+                if sample_id in self.index_of_sample:
+                    samples.append((shard_idx, self.index_of_sample[sample_id]))
+        total_size = self.num_samples_per_rank * self.world_size
+        samples += samples[:(total_size - len(samples))]
+        samples = samples[self.rank * self.num_samples_per_rank:(self.rank + 1) * self.num_samples_per_rank]
+
+        # Shuffle within the runs of a shard
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank])
+        shuffled = []
+        start = 0
+        for end in range(1, len(samples) + 1):
+            if (end == len(samples)) or (samples[end][0] != samples[start][0]):
+                shuffled += [samples[start + i] for i in rng.permutation(end - start)]
+                start = end
+        return shuffled
+
+    def get_worker_batches(self, worker_id, num_workers):
+        """The batches (lists of (shard_idx, dataset index)) of a worker: a contiguous run of the batches of the rank"""
+        samples = self.get_rank_samples()
+        batches = [samples[start:start + self.batch_size] for start in range(0, len(samples), self.batch_size)]
+        num_batches, remainder = divmod(len(batches), num_workers)
+        first = worker_id * num_batches + min(worker_id, remainder)
+        return batches[first:first + num_batches + int(worker_id < remainder)]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            batches = self.get_worker_batches(worker_info.id, worker_info.num_workers)
+        else:
+            batches = self.get_worker_batches(0, 1)
+        shard_order = []
+        for batch in batches:
+            for shard_idx, _ in batch:
+                if (len(shard_order) == 0) or (shard_order[-1] != shard_idx):
+                    shard_order.append(shard_idx)
+        shards = iter(ShardReader(self.dataset.shard_index, shard_order, prefetch=self.prefetch))
+        current_shard_idx = None
+        for batch in batches:
+            samples = []
+            for shard_idx, index in batch:
+                if shard_idx != current_shard_idx:
+                    # the next shard of shard_order
+                    self.dataset.shard_cache = next(shards)
+                    current_shard_idx = shard_idx
+                samples.append(self.dataset[int(index)])
+            yield self.collate_fn(samples)
+
+
+def pack_split(dataset, shards_dir, samples_per_shard=256, with_bev=False, points_dtype='float64'):
+    """Pack the samples of a KittiDataset (read from velodyne/*.ply and label_2/*.txt) into shards"""
+    if not os.path.isdir(shards_dir):
+        os.makedirs(shards_dir)
+
+    label_index = load_label_index(shards_dir)
+    metadata_entries = {}
+    shards = []
+    sample_ids = [int(sample_id) for sample_id in dataset.sample_id_list]
+    for shard_idx, start in enumerate(range(0, len(sample_ids), samples_per_shard)):
+        shard_sample_ids = sample_ids[start:start + samples_per_shard]
+        points_list, ratio_vars_list, bev_list, metadata_rows = [], [], [], []
+        for sample_id in shard_sample_ids:
+            points, intensity = dataset.read_ply(sample_id)
+            adjusted_pcd, pcd_ratio_vars = dataset.adjust_pointcloud(points, idx=sample_id)
+            points_list.append(np.concatenate([points, intensity[:, None]], axis=1).astype(points_dtype))
+            ratio_vars_list.append(pcd_ratio_vars)
+            # The points as KittiDataset.read_ply() reads them back from the shard
+            metadata_rows.append(pcd_metadata.compute_row(points_list[-1][:, :3].astype(np.float64)))
+            if with_bev:
+                lidar_data = np.concatenate([adjusted_pcd, intensity[:, None]], axis=1).astype(np.float32)
+                bev_list.append(dataset.make_bev_map(lidar_data).astype(np.float32))
+            label_file = os.path.join(dataset.label_dir, '{:06d}.txt'.format(sample_id))
+            if os.path.isfile(label_file):
+                label_index['{:06d}'.format(sample_id)] = [line.rstrip() for line in open(label_file)]
+
+        shard = {
+            'sample_ids': np.array(shard_sample_ids, dtype=np.int64),
+            'point_offsets': np.cumsum([0] + [len(points) for points in points_list]).astype(np.int64),
+            'points': np.concatenate(points_list, axis=0),
+            'pcd_ratio_vars': np.array(ratio_vars_list, dtype=np.float64),
+        }
+        if with_bev:
+            shard['bev'] = np.stack(bev_list)
+        shard_fn = '{}_shard_{:05d}.npz'.format(dataset.mode, shard_idx)
+        np.savez(os.path.join(shards_dir, shard_fn), **shard)
+        stamp = pcd_metadata.get_stamp(os.path.join(shards_dir, shard_fn))
+        for sample_id, row in zip(shard_sample_ids, metadata_rows):
+            metadata_entries[sample_id] = stamp + row
+        shards.append({'file': shard_fn, 'sample_ids': shard_sample_ids})
+        print('Packed {} ({} samples)'.format(shard_fn, len(shard_sample_ids)))
+
+    save_label_index(shards_dir, label_index)
+    pcd_metadata.update_table(os.path.join(shards_dir, pcd_metadata.METADATA_FN), metadata_entries)
+    manifest = {
+        'mode': dataset.mode,
+        'num_samples': len(sample_ids),
+        'with_bev': with_bev,
+        'shards': shards
+    }
+    with open(manifest_path(shards_dir, dataset.mode), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from data_process.kitti_dataset import KittiDataset
+
+    parser = argparse.ArgumentParser(description='Pack the dataset splits into shards')
+    parser.add_argument('--dataset_dir', type=str, default='../../dataset/kitti', metavar='PATH',
+                        help='The dataset directory')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='The output directory, default: <dataset_dir>/shards')
+    parser.add_argument('--modes', nargs='+', default=['train', 'val'],
+                        help='The splits to pack')
+    parser.add_argument('--samples_per_shard', type=int, default=256,
+                        help='The number of samples in a shard')
+    parser.add_argument('--with_bev', action='store_true',
+                        help='If true, the BEV maps are precomputed and stored in the shards')
+    parser.add_argument('--voxel_downsample', action='store_true',
+                        help='If true, merge the points of every BEV voxel before computing the BEV maps (same maps)')
+    parser.add_argument('--points_dtype', type=str, default='float64',
+                        help='The dtype of the stored points (float64 keeps the ply coordinates exactly)')
+    configs = parser.parse_args()
+
+    shards_dir = configs.shards_dir if configs.shards_dir is not None else os.path.join(configs.dataset_dir, 'shards')
+    for mode in configs.modes:
+        dataset = KittiDataset(configs.dataset_dir, mode=mode, voxel_downsample=configs.voxel_downsample)
+        pack_split(dataset, shards_dir, samples_per_shard=configs.samples_per_shard, with_bev=configs.with_bev,
+                   points_dtype=configs.points_dtype)
@@ -0,0 +1,190 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Persisted per-sample metadata of the point clouds
+
+adjust_pointcloud() scales and offsets every scan by the extents (min/max of x, y, z) of its points, and the labels of
+the scan go through the same ratio variables. For every sample the table keeps:
+    extents         min_x, min_y, min_z, max_x, max_y, max_z
+    num_points      the number of points of the scan
+    pcd_ratio_vars  pcd_ratio, x_offset, y_offset, z_offset (see get_pcd_ratio_vars())
+so the label-only consumers (KittiDataset.get_label(), utils/find_anchors.py) never read the point clouds, and
+KittiDataset.get_ply() adjusts a scan in place without its min/max.
+
+The table is <dataset_dir>/<training|testing>/pcd_metadata.json, or <shards_dir>/pcd_metadata.json for a packed
+dataset (written by kitti_shards.pack_split()). It holds the (mtime, size) of the file the points of every sample were
+read from (the ply or the shard), so only the samples whose scan changed are read again. The ratio variables are
+recomputed from the extents when the boundary of config/kitti_config.py changes.
+
+Usage (build the tables at ingest, from src/data_process):
+    python pcd_metadata.py --dataset_dir ../../dataset/kitti --modes train val test
+-----------------------------------------------------------------------------------
+"""
+
+import sys
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append('../')
+
+import config.kitti_config as cnf
+
+METADATA_FN = 'pcd_metadata.json'
+COLUMNS = ['mtime_ns', 'size', 'min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z', 'num_points', 'pcd_ratio',
+           'x_offset', 'y_offset', 'z_offset']
+
+
+def compute_extents(points):
+    """[min_x, min_y, min_z, max_x, max_y, max_z] of the xyz points of a scan"""
+    xyz = points[:, :3]
+    return np.concatenate([xyz.min(axis=0), xyz.max(axis=0)]).tolist()
+
+
+def get_pcd_ratio_vars(extents, boundary=cnf.boundary):
+    """The [pcd_ratio, x_offset, y_offset, z_offset] that fit a scan of these extents into the boundary"""
+    min_x, min_y, min_z, max_x, max_y, max_z = extents
+    max_range = min(boundary["maxX"] - boundary["minX"], boundary["maxY"] - boundary["minY"])
+    pcd_ratio = max_range / max(max_x - min_x, max_y - min_y)
+    # pcd_ratio > 0, the min of the scaled coordinates is the scaled min
+    return [pcd_ratio, boundary["minX"] - pcd_ratio * min_x, boundary["minY"] - pcd_ratio * min_y,
+            boundary["minZ"] - min_z]
+
+
+def compute_row(points):
+    """The extents, num_points and pcd_ratio_vars columns of a scan"""
+    extents = compute_extents(points)
+    return extents + [len(points)] + get_pcd_ratio_vars(extents)
+
+
+def row_to_metadata(row):
+    return {'extents': row[0:6], 'num_points': row[6], 'pcd_ratio_vars': row[7:11]}
+
+
+def get_metadata_path(dataset):
+    if dataset.shards_dir is not None:
+        return os.path.join(dataset.shards_dir, METADATA_FN)
+    return os.path.join(os.path.dirname(dataset.lidar_dir), METADATA_FN)
+
+
+def get_source_paths(dataset, sample_ids):
+    """{sample_id: the file the points of the sample are read from} (its ply, or its shard for a packed dataset)"""
+    if dataset.shards_dir is not None:
+        shard_index = dataset.shard_index
+        return {int(sample_id): os.path.join(dataset.shards_dir,
+                                             shard_index.shard_files[shard_index.locate(sample_id)[0]])
+                for sample_id in sample_ids}
+    return {int(sample_id): os.path.join(dataset.lidar_dir, '{:06d}.ply'.format(int(sample_id)))
+            for sample_id in sample_ids}
+
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_table(metadata_path):
+    """Return the {sample key: [stamp + row]} of a table, an empty table if its columns are not the current ones"""
+    if not os.path.isfile(metadata_path):
+        return {}
+    try:
+        with open(metadata_path, 'r') as f:
+            table = json.load(f)
+    except ValueError:
+        return {}
+    if table.get('columns') != COLUMNS:
+        return {}
+    samples = table['samples']
+    if table.get('boundary') != cnf.boundary:
+        for entry in samples.values():
+            entry[9:13] = get_pcd_ratio_vars(entry[2:8])
+    return samples
+
+
+def save_table(metadata_path, samples):
+    tmp_path = '{}.tmp{}'.format(metadata_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'columns': COLUMNS, 'boundary': cnf.boundary, 'samples': samples}, f)
+        os.replace(tmp_path, metadata_path)
+    except OSError:
+        # Read-only dataset, the metadata is simply computed again next time
+        pass
+
+
+def update_table(metadata_path, entries):
+    """Add the {sample_id: [stamp + row]} entries to a table"""
+    samples = load_table(metadata_path)
+    for sample_id, entry in entries.items():
+        samples['{:06d}'.format(int(sample_id))] = entry
+    save_table(metadata_path, samples)
+
+
+def get_metadata(dataset, sample_ids, num_threads=None, read_missing=True):
+    """Return {sample_id: {'extents', 'num_points', 'pcd_ratio_vars'}} for the samples of a KittiDataset.
+    The scans missing from the table (or changed since) are read if read_missing, in parallel threads for the ply
+    files and shard by shard for a packed dataset, and the table is updated. Otherwise they are left out.
+    """
+    metadata_path = get_metadata_path(dataset)
+    samples = load_table(metadata_path)
+
+    sample_ids = [int(sample_id) for sample_id in sample_ids]
+    sources = get_source_paths(dataset, sample_ids)
+    stamps = {path: get_stamp(path) for path in set(sources.values()) if os.path.isfile(path)}
+
+    missing = []
+    for sample_id in sample_ids:
+        cached = samples.get('{:06d}'.format(sample_id))
+        if (cached is None) or (cached[:2] != stamps.get(sources[sample_id])):
+            missing.append(sample_id)
+    if not read_missing:
+        missing = set(missing)
+        return {sample_id: row_to_metadata(samples['{:06d}'.format(sample_id)][2:]) for sample_id in sample_ids
+                if sample_id not in missing}
+
+    if dataset.shards_dir is not None:
+        shard_positions = {}
+        for sample_id in missing:
+            shard_idx, pos = dataset.shard_index.locate(sample_id)
+            shard_positions.setdefault(shard_idx, []).append((sample_id, pos))
+        for shard_idx, positions in shard_positions.items():
+            shard = dataset.shard_index.load_shard(shard_idx)
+            for sample_id, pos in positions:
+                start, end = shard['point_offsets'][pos], shard['point_offsets'][pos + 1]
+                # Same dtype as KittiDataset.read_ply()
+                points = shard['points'][start:end, :3].astype(np.float64)
+                samples['{:06d}'.format(sample_id)] = stamps[sources[sample_id]] + compute_row(points)
+    elif len(missing) > 0:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            rows = list(executor.map(lambda sample_id: compute_row(dataset.read_ply(sample_id)[0]), missing))
+        for sample_id, row in zip(missing, rows):
+            samples['{:06d}'.format(sample_id)] = stamps[sources[sample_id]] + row
+
+    if len(missing) > 0:
+        save_table(metadata_path, samples)
+
+    return {sample_id: row_to_metadata(samples['{:06d}'.format(sample_id)][2:]) for sample_id in sample_ids}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from data_process.kitti_dataset import KittiDataset
+
+    parser = argparse.ArgumentParser(description='Build the point cloud metadata tables of the dataset splits')
+    parser.add_argument('--dataset_dir', type=str, default='../../dataset/kitti', metavar='PATH',
+                        help='The dataset directory')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='If set, build the table of the packed dataset')
+    parser.add_argument('--modes', nargs='+', default=['train', 'val'],
+                        help='The splits whose scans are added to the tables')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='The number of threads reading the scans')
+    configs = parser.parse_args()
+
+    for mode in configs.modes:
+        dataset = KittiDataset(configs.dataset_dir, mode=mode, shards_dir=configs.shards_dir)
+        metadata = get_metadata(dataset, dataset.sample_id_list, num_threads=configs.num_threads)
+        print('{}: metadata of {} samples in {}'.format(mode, len(metadata), get_metadata_path(dataset)))
@@ -58,5 +58,9 @@ class Object3d(object):
     
 def read_label(label_filename, labels_list,pcd_ratio=[1,0,0,0]):
     lines = [line.rstrip() for line in open(label_filename)]
+    return parse_label_lines(lines, labels_list, pcd_ratio=pcd_ratio)
+
+def parse_label_lines(lines, labels_list, pcd_ratio=[1,0,0,0]):
+    # the lines of a label file, e.g. from the label index of a packed dataset
     objects = [Object3d(line, labels_list=labels_list, pcd_ratio=pcd_ratio) for line in lines]
     return objects
\ No newline at end of file
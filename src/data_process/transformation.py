@@ -9,6 +9,7 @@ import math
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 sys.path.append('../')
 
@@ -317,10 +318,10 @@ class Compose(object):
         self.transforms = transforms
         self.p = p
 
-    def __call__(self, lidar, labels):
-        if np.random.random() <= self.p:
+    def __call__(self, lidar, labels, rng=np.random):
+        if rng.random() <= self.p:
             for t in self.transforms:
-                lidar, labels = t(lidar, labels)
+                lidar, labels = t(lidar, labels, rng=rng)
         return lidar, labels
 
 
@@ -329,10 +330,10 @@ class OneOf(object):
         self.transforms = transforms
         self.p = p
 
-    def __call__(self, lidar, labels):
-        if np.random.random() <= self.p:
-            choice = np.random.randint(low=0, high=len(self.transforms))
-            lidar, labels = self.transforms[choice](lidar, labels)
+    def __call__(self, lidar, labels, rng=np.random):
+        if rng.random() <= self.p:
+            choice = rng.randint(low=0, high=len(self.transforms))
+            lidar, labels = self.transforms[choice](lidar, labels, rng=rng)
 
         return lidar, labels
 
@@ -342,13 +343,13 @@ class Random_Rotation(object):
         self.limit_angle = limit_angle / 180. * np.pi
         self.p = p
 
-    def __call__(self, lidar, labels):
+    def __call__(self, lidar, labels, rng=np.random):
         """
         :param labels: # (N', 7) x, y, z, h, w, l, r
         :return:
         """
-        if np.random.random() <= self.p:
-            angle = np.random.uniform(-self.limit_angle, self.limit_angle)
+        if rng.random() <= self.p:
+            angle = rng.uniform(-self.limit_angle, self.limit_angle)
             lidar[:, 0:3] = point_transform(lidar[:, 0:3], 0, 0, 0, rz=angle)
             labels = box_transform(labels, 0, 0, 0, r=angle, coordinate='lidar')
 
@@ -360,13 +361,13 @@ class Random_Scaling(object):
         self.scaling_range = scaling_range
         self.p = p
 
-    def __call__(self, lidar, labels):
+    def __call__(self, lidar, labels, rng=np.random):
         """
         :param labels: # (N', 7) x, y, z, h, w, l, r
         :return:
         """
-        if np.random.random() <= self.p:
-            factor = np.random.uniform(self.scaling_range[0], self.scaling_range[0])
+        if rng.random() <= self.p:
+            factor = rng.uniform(self.scaling_range[0], self.scaling_range[0])
             lidar[:, 0:3] = lidar[:, 0:3] * factor
             labels[:, 0:6] = labels[:, 0:6] * factor
 
@@ -377,8 +378,8 @@ class Horizontal_Flip(object):
     def __init__(self, p=0.5):
         self.p = p
 
-    def __call__(self, img, targets):
-        if np.random.random() <= self.p:
+    def __call__(self, img, targets, rng=np.random):
+        if rng.random() <= self.p:
             img = torch.flip(img, [-1])
             targets[:, 2] = 1 - targets[:, 2]  # horizontal flip
             targets[:, 6] = - targets[:, 6]  # yaw angle flip
@@ -401,14 +402,15 @@ class Cutout(object):
         self.fill_value = fill_value
         self.p = p
 
-    def __call__(self, img, targets):
+    def __call__(self, img, targets, rng=np.random):
         """
         Args:
             img (Tensor): Tensor image of size (C, H, W).
+            rng: the random state (np.random or a np.random.RandomState) used to draw the holes
         Returns:
             Tensor: Image with n_holes of dimension length x length cut out of it.
         """
-        if np.random.random() <= self.p:
+        if rng.random() <= self.p:
             h = img.size(1)
             w = img.size(2)
 
@@ -416,8 +418,8 @@ class Cutout(object):
             w_cutout = int(self.ratio * w)
 
             for n in range(self.n_holes):
-                y = np.random.randint(h)
-                x = np.random.randint(w)
+                y = rng.randint(h)
+                x = rng.randint(w)
 
                 y1 = np.clip(y - h_cutout // 2, 0, h)
                 y2 = np.clip(y + h_cutout // 2, 0, h)
@@ -435,3 +437,104 @@ class Cutout(object):
                 targets = targets[keep_target]
 
         return img, targets
+
+
+class Batch_Mosaic(object):
+    """Compose a whole batch of BEV maps into mosaics on the device holding the batch.
+    Each output image is built from 4 samples of the same batch (the sample itself and 3 random permutations of the
+    batch), so the dataloader only has to load every sample once.
+    Refer: https://github.com/ultralytics/yolov5/blob/master/utils/datasets.py
+    """
+
+    def __init__(self, img_size, random_padding=False, fill_value=0.5):
+        self.img_size = img_size
+        self.random_padding = random_padding
+        self.fill_value = fill_value
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+
+    def __call__(self, imgs, targets, rng=np.random, epoch=0, batch_idx=0):
+        """
+        :param imgs: [batch_size, 3, H, W]
+        :param targets: [num_boxes, 8] (box_idx, class, x, y, w, l, sin(yaw), cos(yaw))
+        :param rng: the per-batch random state, the epoch and batch_idx are not used
+        :return: mosaics of size [batch_size, 3, 2 * img_size, 2 * img_size] and their targets
+        """
+        batch_size, c, h, w = imgs.size()
+        s = self.img_size
+        if self.random_padding:
+            yc, xc = [int(rng.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center
+        else:
+            yc, xc = [s, s]  # mosaic center
+
+        imgs_s4 = torch.full((batch_size, c, s * 2, s * 2), self.fill_value, dtype=imgs.dtype, device=imgs.device)
+        targets_s4 = []
+        for i in range(4):
+            if i == 0:  # top left
+                perm = torch.arange(batch_size, device=imgs.device)
+                x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
+                x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
+            else:
+                perm = torch.from_numpy(rng.permutation(batch_size)).to(imgs.device)
+                if i == 1:  # top right
+                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+                    x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+                elif i == 2:  # bottom left
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+                else:  # bottom right
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+
+            imgs_s4[:, :, y1a:y2a, x1a:x2a] = imgs[perm, :, y1b:y2b, x1b:x2b]
+            padw = x1a - x1b
+            padh = y1a - y1b
+
+            if targets.size(0) > 0:
+                # Boxes of the sample perm[j] are moved to the output image j
+                inv_perm = torch.empty_like(perm)
+                inv_perm[perm] = torch.arange(batch_size, device=perm.device)
+                quarter_targets = targets.clone()
+                quarter_targets[:, 0] = inv_perm[targets[:, 0].long()].to(targets.dtype)
+                quarter_targets[:, 2] = (targets[:, 2] * w + padw) / (2 * s)
+                quarter_targets[:, 3] = (targets[:, 3] * h + padh) / (2 * s)
+                quarter_targets[:, 4] = targets[:, 4] * w / (2 * s)
+                quarter_targets[:, 5] = targets[:, 5] * h / (2 * s)
+                targets_s4.append(quarter_targets)
+
+        if len(targets_s4) > 0:
+            targets_s4 = torch.cat(targets_s4, 0)
+            torch.clamp(targets_s4[:, 2:4], min=0., max=(1. - 0.5 / s), out=targets_s4[:, 2:4])
+        else:
+            targets_s4 = targets
+
+        return imgs_s4, targets_s4
+
+
+class Batch_Multiscale(object):
+    """Resize a whole batch to a randomly selected input size, a new size is drawn every `interval` batches.
+    With a seed, the size is a function of (seed, epoch, rank, batch_idx // interval), so that a resumed or repeated
+    training sees the same sizes; without a seed, it is drawn from `rng` at the first batch of every interval.
+    """
+
+    def __init__(self, img_size, interval=10, seed=None, rank=0):
+        self.min_size = img_size - 3 * 32
+        self.max_size = img_size + 3 * 32
+        self.interval = interval
+        self.seed = seed
+        self.rank = rank
+        self.img_size = img_size
+
+    def get_img_size(self, epoch, batch_idx, rng=np.random):
+        if self.seed is not None:
+            rng = np.random.RandomState([self.seed, epoch, self.rank, batch_idx // self.interval])
+        elif batch_idx % self.interval != 0:
+            return self.img_size
+        self.img_size = int(rng.choice(range(self.min_size, self.max_size + 1, 32)))
+        return self.img_size
+
+    def __call__(self, imgs, targets, rng=np.random, epoch=0, batch_idx=0):
+        img_size = self.get_img_size(epoch, batch_idx, rng=rng)
+        if img_size != imgs.size(-1):
+            imgs = F.interpolate(imgs, size=img_size, mode="bilinear", align_corners=True)
+
+        return imgs, targets
@@ -0,0 +1,148 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Label-only scan of the samples which contain at least one object of a known class
+
+get_stratified_indices() draws a fixed subset of a split with the same mix of classes, for the proxy validation.
+
+The result of a split is persisted next to its ImageSets/<mode>.txt as ImageSets/<mode>_valid.json. The manifest is
+keyed by the content of classes_names.txt and holds the (mtime, size) of every label file, so only the label files
+which changed since the last scan are read again.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def classes_key(labels_list):
+    return hashlib.sha1('\n'.join(labels_list).encode('utf-8')).hexdigest()
+
+
+def has_known_object(lines, labels_set):
+    """A sample is valid if one of its label lines starts with a known class name"""
+    for line in lines:
+        if line.split(' ')[0] in labels_set:
+            return True
+    return False
+
+
+def load_manifest(manifest_path, key):
+    if (manifest_path is None) or (not os.path.isfile(manifest_path)):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        return {}
+    if manifest.get('classes_key') != key:
+        return {}
+    return manifest['samples']
+
+
+def save_manifest(manifest_path, key, samples):
+    tmp_path = '{}.tmp{}'.format(manifest_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'classes_key': key, 'samples': samples}, f)
+        os.replace(tmp_path, manifest_path)
+    except OSError:
+        # Read-only dataset, the scan is simply redone next time
+        pass
+
+
+def get_valid_sample_ids(label_dir, image_idx_list, labels_list, manifest_path=None):
+    """Return the ids of the samples of image_idx_list which have current training class objects.
+
+    :param label_dir: the directory of the <sample_id>.txt label files
+    :param image_idx_list: the sample ids of the split
+    :param labels_list: the class names (content of classes_names.txt)
+    :param manifest_path: where the scan is persisted, None to disable it
+    """
+    key = classes_key(labels_list)
+    labels_set = set(labels_list)
+    cached_samples = load_manifest(manifest_path, key)
+
+    samples = {}
+    sample_id_list = []
+    num_scanned = 0
+    for sample_id in image_idx_list:
+        sample_id = int(sample_id)
+        sample_key = '{:06d}'.format(sample_id)
+        label_file = os.path.join(label_dir, '{}.txt'.format(sample_key))
+        stat = os.stat(label_file)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        cached = cached_samples.get(sample_key)
+        if (cached is not None) and (cached[:2] == stamp):
+            is_valid = cached[2]
+        else:
+            with open(label_file, 'r') as f:
+                is_valid = has_known_object([line.rstrip() for line in f], labels_set)
+            num_scanned += 1
+        samples[sample_key] = stamp + [is_valid]
+        if is_valid:
+            sample_id_list.append(sample_id)
+
+    if (manifest_path is not None) and ((num_scanned > 0) or (len(samples) != len(cached_samples))):
+        save_manifest(manifest_path, key, samples)
+
+    return sample_id_list
+
+
+def get_valid_sample_ids_from_index(label_index, image_idx_list, labels_list):
+    """Same as get_valid_sample_ids() for a packed dataset, whose labels are already in memory"""
+    labels_set = set(labels_list)
+    return [int(sample_id) for sample_id in image_idx_list
+            if has_known_object(label_index['{:06d}'.format(int(sample_id))], labels_set)]
+
+
+def get_stratified_indices(sample_classes, num_samples, seed=0):
+    """Return the sorted indices of a subset of num_samples samples, stratified by the rarest class of every sample
+    (the number of samples of every stratum is proportional to its size, at least 1 while there are fewer strata than
+    num_samples), so that the rare classes are represented in the subset.
+
+    :param sample_classes: the class names of the objects of every sample
+    :param num_samples: the size of the subset
+    :param seed: the same seed always gives the same subset
+    """
+    num_total = len(sample_classes)
+    if num_samples >= num_total:
+        return list(range(num_total))
+
+    class_counts = {}
+    for classes in sample_classes:
+        for class_name in set(classes):
+            class_counts[class_name] = class_counts.get(class_name, 0) + 1
+    strata = {}
+    for index, classes in enumerate(sample_classes):
+        key = min(set(classes), key=lambda class_name: (class_counts[class_name], class_name)) if classes else ''
+        strata.setdefault(key, []).append(index)
+
+    # Largest remainder allocation, at least one sample per stratum
+    keys = sorted(strata.keys())
+    quotas = np.array([num_samples * len(strata[key]) / num_total for key in keys])
+    counts = np.maximum(np.floor(quotas).astype(np.int64), 1)
+    remainders = quotas - np.floor(quotas)
+    for key_idx in np.argsort(-remainders, kind='stable'):
+        if counts.sum() >= num_samples:
+            break
+        if counts[key_idx] < len(strata[keys[key_idx]]):
+            counts[key_idx] += 1
+    # The one sample per stratum may exceed num_samples: take back from the most over-allocated strata, and with more
+    # strata than samples, drop the largest strata (their classes are the most common ones)
+    while counts.sum() > num_samples:
+        excess = np.where(counts > 1, counts - quotas, -np.inf)
+        if np.isfinite(excess).any():
+            counts[np.argmax(excess)] -= 1
+        else:
+            counts[np.argmax(np.where(counts > 0, quotas, -np.inf))] -= 1
+
+    rng = np.random.RandomState(seed)
+    indices = []
+    for key, count in zip(keys, counts):
+        indices += rng.choice(strata[key], size=min(count, len(strata[key])), replace=False).tolist()
+
+    return sorted(indices)
@@ -8,6 +8,7 @@ import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 import torch
+import torch.distributed as dist
 import torch.utils.data.distributed
 from tqdm import tqdm
 from easydict import EasyDict as edict
@@ -15,12 +16,21 @@ from easydict import EasyDict as edict
 sys.path.append('./')
 
 from data_process.kitti_dataloader import create_val_dataloader
-from models.model_utils import create_model
+from models.model_utils import load_inference_model
 from utils.misc import AverageMeter, ProgressMeter
+from utils.train_utils import all_gather_objects, broadcast_object
+from utils.torch_utils import prepare_bev_input
 from utils.evaluation_utils import post_processing, get_batch_statistics_rotated_bbox, ap_per_class, load_classes, post_processing_v2
 
 
 def evaluate_mAP(val_loader, model, configs, logger):
+    """Evaluate the model on the val set. In a distributed run, every rank evaluates its shard of the val set
+    (see UnpaddedDistributedSampler), the statistics are gathered and the AP is computed on rank 0, then broadcast, so
+    all the ranks return the same metrics.
+    """
+    if configs.distributed and hasattr(model, 'module'):
+        # The ranks run different numbers of batches, the DDP forward would wait for the others to broadcast the buffers
+        model = model.module
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
 
@@ -39,7 +49,7 @@ def evaluate_mAP(val_loader, model, configs, logger):
             labels += targets[:, 1].tolist()
             # Rescale x, y, w, h of targets ((box_idx, class, x, y, w, l, im, re))
             targets[:, 2:6] *= configs.img_size
-            imgs = imgs.to(configs.device, non_blocking=True)
+            imgs = prepare_bev_input(imgs, configs.device)
 
             outputs = model(imgs)
             outputs = post_processing_v2(outputs, conf_thresh=configs.conf_thresh, nms_thresh=configs.nms_thresh)
@@ -58,8 +68,21 @@ def evaluate_mAP(val_loader, model, configs, logger):
             start_time = time.time()
 
         # Concatenate sample statistics
-        true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-        precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+        if len(sample_metrics) > 0:
+            sample_metrics = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
+        if configs.distributed:
+            rank_stats = all_gather_objects((sample_metrics, labels))
+            sample_metrics = [rank_metrics for rank_metrics, _ in rank_stats if len(rank_metrics) > 0]
+            sample_metrics = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
+            labels = [label for _, rank_labels in rank_stats for label in rank_labels]
+
+        metrics = None
+        if (not configs.distributed) or (dist.get_rank() == 0):
+            true_positives, pred_scores, pred_labels = sample_metrics
+            metrics = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+        if configs.distributed:
+            metrics = broadcast_object(metrics, src=0)
+        precision, recall, AP, f1, ap_class = metrics
 
     return precision, recall, AP, f1, ap_class
 
@@ -76,6 +99,8 @@ def parse_eval_configs():
                         help='the path of the pretrained checkpoint')
     parser.add_argument('--use_giou_loss', action='store_true',
                         help='If true, use GIoU loss during training. If false, use MSE loss for training')
+    parser.add_argument('--jit_cache_dir', type=str, default=None, metavar='PATH',
+                        help='If set, cache the traced model in this directory, later runs skip building the model')
 
     parser.add_argument('--no_cuda', action='store_true',
                         help='If true, cuda is not used.')
@@ -86,6 +111,21 @@ def parse_eval_configs():
                         help='the size of input image')
     parser.add_argument('--num_samples', type=int, default=None,
                         help='Take a subset of the dataset to run and debug')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='If set, read the packed dataset (see data_process/kitti_shards.py) from this directory')
+    parser.add_argument('--voxel_downsample', action='store_true',
+                        help='If true, merge the points of every BEV voxel before the rasterization (same BEV maps)')
+    parser.add_argument('--bev_store_dir', type=str, default=None, metavar='PATH',
+                        help='If set, the BEV maps are built once into a memory-mapped store in this directory, '
+                             'shared by the processes of the host (see data_process/bev_store.py)')
+    parser.add_argument('--bev_store_dtype', type=str, default='uint8', choices=['uint8', 'float16'],
+                        help='The dtype of the stored BEV maps')
+    parser.add_argument('--bev_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='The dtype of the BEV maps between the dataloader workers and the device, they are '
+                             'converted to float on the device (uint8: 1/255 steps)')
+    parser.add_argument('--sparse_bev', action='store_true',
+                        help='If true, only the occupied cells of the BEV maps (and their features) go through the '
+                             'dataloader, the maps are densified on the device (for mostly empty grids)')
     parser.add_argument('--num_workers', type=int, default=4,
                         help='Number of threads for loading data')
     parser.add_argument('--batch_size', type=int, default=4,
@@ -112,27 +152,32 @@ def parse_eval_configs():
 
 if __name__ == '__main__':
     configs = parse_eval_configs()
-    configs.distributed = False  # For evaluation
+    # Distributed evaluation when started by a launcher which sets the env variables (torchrun,
+    # python -m torch.distributed.launch --use_env)
+    configs.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if configs.distributed:
+        if not configs.no_cuda:
+            configs.gpu_idx = int(os.environ.get('LOCAL_RANK', 0))
+            torch.cuda.set_device(configs.gpu_idx)
+        dist.init_process_group(backend='gloo' if configs.no_cuda else 'nccl', init_method='env://')
+    is_master = (not configs.distributed) or (dist.get_rank() == 0)
     class_names = load_classes(configs.classnames_infor_path)
 
-    model = create_model(configs)
-    # model.print_network()
     print('\n\n' + '-*=' * 30 + '\n\n')
     assert os.path.isfile(configs.pretrained_path), "No file at {}".format(configs.pretrained_path)
-    model.load_state_dict(torch.load(configs.pretrained_path))
-
     configs.device = torch.device('cpu' if configs.no_cuda else 'cuda:{}'.format(configs.gpu_idx))
-    model = model.to(device=configs.device)
-
-    model.eval()
+    model = load_inference_model(configs)
     print('Create the validation dataloader')
     val_dataloader = create_val_dataloader(configs)
 
     print("\nStart computing mAP...\n")
     precision, recall, AP, f1, ap_class = evaluate_mAP(val_dataloader, model, configs, None)
-    print("\nDone computing mAP...\n")
-    for idx, cls in enumerate(ap_class):
-        print("\t>>>\t Class {} ({}): precision = {:.4f}, recall = {:.4f}, AP = {:.4f}, f1: {:.4f}".format(cls, \
-                class_names[cls][:3], precision[idx], recall[idx], AP[idx], f1[idx]))
-
-    print("\nmAP: {}\n".format(AP.mean()))
+    if is_master:
+        print("\nDone computing mAP...\n")
+        for idx, cls in enumerate(ap_class):
+            print("\t>>>\t Class {} ({}): precision = {:.4f}, recall = {:.4f}, AP = {:.4f}, f1: {:.4f}".format(cls, \
+                    class_names[cls][:3], precision[idx], recall[idx], AP[idx], f1[idx]))
+
+        print("\nmAP: {}\n".format(AP.mean()))
+    if configs.distributed:
+        dist.destroy_process_group()
@@ -0,0 +1,308 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Local inference server shared by several clients, with request micro-batching
+
+A minimal asyncio HTTP/1.1 server (standard library only):
+    POST /detect    body: an (N, 4) x, y, z, intensity scan in the .npy format, optional header X-Frame-Id
+                    response: {"frame_id", "detections", "pcd_ratio_vars", "batch_size", "latency_ms"}
+    GET /stats      the latency histograms and the batch size counts
+The scans are rasterized on a thread pool, then the concurrent requests are gathered into micro-batches: a batch is
+forwarded once it holds max_batch_size scans or once its first scan waited max_wait_ms. The batched forward and
+post_processing_v2 run on a single executor thread, the results are scattered back to the waiting requests.
+
+Run with --load_test to start a load generator against a running server instead.
+-----------------------------------------------------------------------------------
+"""
+
+import argparse
+import sys
+import os
+import io
+import time
+import json
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from easydict import EasyDict as edict
+import numpy as np
+import torch
+
+sys.path.append('./')
+
+import config.kitti_config as cnf
+from data_process import kitti_bev_utils
+from models.model_utils import create_model, load_model_weights
+from utils.evaluation_utils import post_processing_v2, detections_to_dicts
+from utils.misc import LatencyHistogram
+
+STAGES = ['rasterize', 'batch_wait', 'forward', 'end_to_end']
+
+
+class MicroBatcher(object):
+    """Gather the rasterized scans of concurrent requests into batches and run them through the model"""
+
+    def __init__(self, model, configs):
+        self.model = model
+        self.device = configs.device
+        self.conf_thresh = configs.conf_thresh
+        self.nms_thresh = configs.nms_thresh
+        self.max_batch_size = configs.max_batch_size
+        self.max_wait = configs.max_wait_ms / 1000.
+        self.class_names = cnf.class_list
+
+        self.queue = asyncio.Queue()
+        self.rasterize_executor = ThreadPoolExecutor(max_workers=configs.num_rasterize_workers)
+        # One forward at a time, the next batch fills up meanwhile
+        self.forward_executor = ThreadPoolExecutor(max_workers=1)
+        self.histograms = {name: LatencyHistogram(name) for name in STAGES}
+        self.batch_sizes = Counter()
+
+    async def detect(self, points):
+        """Return the detections of one scan, the (detections, pcd_ratio_vars, batch_size) of post_processing_v2"""
+        loop = asyncio.get_event_loop()
+        start_time = time.time()
+        rgb_map, pcd_ratio_vars = await loop.run_in_executor(self.rasterize_executor, kitti_bev_utils.pointcloud_to_bev,
+                                                             points[:, :3].astype(np.float64), points[:, 3])
+        self.histograms['rasterize'].update(time.time() - start_time)
+        future = loop.create_future()
+        await self.queue.put((torch.from_numpy(rgb_map).float(), time.time(), future))
+        detections, batch_size = await future
+        self.histograms['end_to_end'].update(time.time() - start_time)
+        return detections, pcd_ratio_vars, batch_size
+
+    def forward(self, bev_maps):
+        imgs = torch.stack(bev_maps).to(self.device, non_blocking=True)
+        with torch.no_grad():
+            outputs = self.model(imgs)
+        return post_processing_v2(outputs, conf_thresh=self.conf_thresh, nms_thresh=self.nms_thresh)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][1] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start_time = time.time()
+            for _, t_queued, _ in batch:
+                self.histograms['batch_wait'].update(start_time - t_queued)
+            try:
+                detections = await loop.run_in_executor(self.forward_executor, self.forward,
+                                                        [bev_map for bev_map, _, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.histograms['forward'].update(time.time() - start_time)
+            self.batch_sizes[len(batch)] += 1
+            for (_, _, future), image_detections in zip(batch, detections):
+                # The client may be gone
+                if future.done():
+                    continue
+                # a failing request must not stop the batching task
+                try:
+                    future.set_result((detections_to_dicts(image_detections, self.class_names), len(batch)))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def stats(self):
+        return {
+            'latency_ms': {name: self.histograms[name].summary() for name in STAGES},
+            'batch_sizes': {str(batch_size): count for batch_size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+async def read_http_request(reader):
+    """Return the (method, path, headers, body) of the next request of a connection, None once it is closed"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_http_response(writer, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, len(body)).encode('latin-1') + body)
+
+
+class InferenceServer(object):
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle_connection(self, reader, writer):
+        # keep-alive: serve the requests of the connection until the client closes it
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if (method == 'POST') and (path == '/detect'):
+                    status, payload = await self.detect(headers, body)
+                elif (method == 'GET') and (path == '/stats'):
+                    status, payload = '200 OK', self.batcher.stats()
+                else:
+                    status, payload = '404 Not Found', {'error': 'Unknown route {} {}'.format(method, path)}
+                write_http_response(writer, status, payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def detect(self, headers, body):
+        start_time = time.time()
+        try:
+            points = np.load(io.BytesIO(body), allow_pickle=False)
+            # an .npz body loads as an NpzFile, too few points or a flat scan can't be rasterized
+            kitti_bev_utils.check_scan(points)
+        except (ValueError, EOFError, OSError) as e:
+            # malformed, empty or truncated body
+            return '400 Bad Request', {'error': str(e)}
+        try:
+            detections, pcd_ratio_vars, batch_size = await self.batcher.detect(points)
+        except Exception as e:
+            return '500 Internal Server Error', {'error': repr(e)}
+        return '200 OK', {
+            'frame_id': headers.get('x-frame-id'),
+            'detections': detections,
+            'pcd_ratio_vars': [float(v) for v in pcd_ratio_vars],
+            'batch_size': batch_size,
+            'latency_ms': round(1000. * (time.time() - start_time), 2),
+        }
+
+
+async def serve(model, configs):
+    batcher = MicroBatcher(model, configs)
+    server = InferenceServer(batcher)
+    batch_task = asyncio.ensure_future(batcher.run())
+    tcp_server = await asyncio.start_server(server.handle_connection, configs.host, configs.port)
+    print('Serving on {}:{} (max_batch_size: {}, max_wait: {}ms)'.format(configs.host, configs.port,
+                                                                        configs.max_batch_size, configs.max_wait_ms))
+    try:
+        await tcp_server.serve_forever()
+    finally:
+        batch_task.cancel()
+        print(json.dumps(batcher.stats(), indent=2))
+
+
+async def load_test_client(configs, client_idx, histogram, num_requests):
+    """Send num_requests synthetic scans one after the other over a keep-alive connection"""
+    rng = np.random.RandomState([configs.seed, client_idx])
+    reader, writer = await asyncio.open_connection(configs.host, configs.port)
+    for request_idx in range(num_requests):
+        points = rng.uniform(-1., 1., size=(configs.num_points, 4)) * [40., 40., 2., 1.]
+        payload = io.BytesIO()
+        np.save(payload, points.astype(np.float32), allow_pickle=False)
+        body = payload.getvalue()
+        start_time = time.time()
+        writer.write('POST /detect HTTP/1.1\r\nHost: {}\r\nX-Frame-Id: {}-{}\r\nContent-Length: {}\r\n\r\n'.format(
+            configs.host, client_idx, request_idx, len(body)).encode('latin-1') + body)
+        await writer.drain()
+        _, _, _, response = await read_http_request(reader)
+        histogram.update(time.time() - start_time)
+    writer.close()
+
+
+async def load_test(configs):
+    histogram = LatencyHistogram('request')
+    requests_per_client = max(configs.num_requests // configs.concurrency, 1)
+    start_time = time.time()
+    await asyncio.gather(*[load_test_client(configs, client_idx, histogram, requests_per_client)
+                           for client_idx in range(configs.concurrency)])
+    duration = time.time() - start_time
+    print('{} clients, {} requests in {:.2f}s: {:.2f} requests/s'.format(configs.concurrency, histogram.count, duration,
+                                                                         histogram.count / duration))
+    print(histogram)
+
+
+def parse_server_configs():
+    parser = argparse.ArgumentParser(description='Local micro-batching inference server of Complex YOLO')
+    parser.add_argument('-a', '--arch', type=str, default='darknet', metavar='ARCH',
+                        help='The name of the model architecture')
+    parser.add_argument('--cfgfile', type=str, default='./config/cfg/complex_yolov4.cfg', metavar='PATH',
+                        help='The path for cfgfile (only for darknet)')
+    parser.add_argument('--pretrained_path', type=str, default=None, metavar='PATH',
+                        help='the path of the pretrained checkpoint')
+    parser.add_argument('--use_giou_loss', action='store_true',
+                        help='If true, use GIoU loss during training. If false, use MSE loss for training')
+
+    parser.add_argument('--no_cuda', action='store_true',
+                        help='If true, cuda is not used.')
+    parser.add_argument('--gpu_idx', default=None, type=int,
+                        help='GPU index to use.')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The address of the server')
+    parser.add_argument('--port', type=int, default=8008,
+                        help='The port of the server')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='The max number of scans forwarded together')
+    parser.add_argument('--max_wait_ms', type=float, default=10.,
+                        help='The max time a scan waits for its batch to fill up')
+    parser.add_argument('--num_rasterize_workers', type=int, default=4,
+                        help='Number of threads rasterizing the received scans')
+
+    parser.add_argument('--conf_thresh', type=float, default=0.5,
+                        help='the threshold for conf')
+    parser.add_argument('--nms_thresh', type=float, default=0.5,
+                        help='the threshold for nms')
+
+    parser.add_argument('--load_test', action='store_true',
+                        help='If true, run the load generator against a running server instead of serving')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='load test - number of concurrent clients')
+    parser.add_argument('--num_requests', type=int, default=200,
+                        help='load test - total number of requests')
+    parser.add_argument('--num_points', type=int, default=100000,
+                        help='load test - number of points of the synthetic scans')
+    parser.add_argument('--seed', type=int, default=2020,
+                        help='load test - seed of the synthetic scans')
+
+    configs = edict(vars(parser.parse_args()))
+
+    return configs
+
+
+if __name__ == '__main__':
+    configs = parse_server_configs()
+    loop = asyncio.get_event_loop()
+
+    if configs.load_test:
+        loop.run_until_complete(load_test(configs))
+    else:
+        model = create_model(configs)
+        assert os.path.isfile(configs.pretrained_path), "No file at {}".format(configs.pretrained_path)
+        load_model_weights(model, configs.pretrained_path)
+
+        if configs.no_cuda:
+            configs.device = torch.device('cpu')
+        else:
+            configs.device = torch.device('cuda' if configs.gpu_idx is None else 'cuda:{}'.format(configs.gpu_idx))
+        model = model.to(device=configs.device)
+        model.eval()
+
+        try:
+            loop.run_until_complete(serve(model, configs))
+        except KeyboardInterrupt:
+            pass
@@ -17,6 +17,7 @@ sys.path.append('../')
 from models.yolo_layer import YoloLayer
 from models.darknet_utils import parse_cfg, print_cfg, load_fc, load_conv_bn, load_conv
 from utils.torch_utils import to_cpu
+from utils import profiling
 
 
 class Mish(nn.Module):
@@ -142,6 +143,18 @@ class EmptyModule(nn.Module):
         return x
 
 
+def get_route_layers(block, ind):
+    """The absolute indices of the layers concatenated by the route layer `ind`"""
+    layers = [int(i) for i in block['layers'].split(',')]
+    return [i if i > 0 else i + ind for i in layers]
+
+
+def get_shortcut_layer(block, ind):
+    """The absolute index of the layer added by the shortcut layer `ind` (the other one is ind - 1)"""
+    from_layer = int(block['from'])
+    return from_layer if from_layer > 0 else from_layer + ind
+
+
 # support route shortcut and reorg
 class Darknet(nn.Module):
     def __init__(self, cfgfile, use_giou_loss):
@@ -162,73 +175,76 @@ class Darknet(nn.Module):
     def forward(self, x, targets=None):
         # batch_size, c, h, w
         img_size = x.size(2)
-        ind = -2
         self.loss = None
         outputs = dict()
         loss = 0.
         yolo_outputs = []
-        for block in self.blocks:
-            ind = ind + 1
-            # if ind > 0:
-            #    return x
-
-            if block['type'] == 'net':
+        # the index of the first layer (after the [net] block) is 0
+        for ind, block in enumerate(self.blocks, start=-1):
+            if block['type'] in ['net', 'cost']:
                 continue
-            elif block['type'] in ['convolutional', 'maxpool', 'reorg', 'upsample', 'avgpool', 'softmax', 'connected']:
-                x = self.models[ind](x)
-                outputs[ind] = x
-            elif block['type'] == 'route':
-                layers = block['layers'].split(',')
-                layers = [int(i) if int(i) > 0 else int(i) + ind for i in layers]
-                if len(layers) == 1:
-                    if 'groups' not in block.keys() or int(block['groups']) == 1:
-                        x = outputs[layers[0]]
-                        outputs[ind] = x
-                    else:
-                        groups = int(block['groups'])
-                        group_id = int(block['group_id'])
-                        _, b, _, _ = outputs[layers[0]].shape
-                        x = outputs[layers[0]][:, b // groups * group_id:b // groups * (group_id + 1)]
-                        outputs[ind] = x
-                elif len(layers) == 2:
-                    x1 = outputs[layers[0]]
-                    x2 = outputs[layers[1]]
-                    x = torch.cat((x1, x2), 1)
-                    outputs[ind] = x
-                elif len(layers) == 4:
-                    x1 = outputs[layers[0]]
-                    x2 = outputs[layers[1]]
-                    x3 = outputs[layers[2]]
-                    x4 = outputs[layers[3]]
-                    x = torch.cat((x1, x2, x3, x4), 1)
-                    outputs[ind] = x
-                else:
-                    print("rounte number > 2 ,is {}".format(len(layers)))
-
-            elif block['type'] == 'shortcut':
-                from_layer = int(block['from'])
-                activation = block['activation']
-                from_layer = from_layer if from_layer > 0 else from_layer + ind
-                x1 = outputs[from_layer]
-                x2 = outputs[ind - 1]
-                x = x1 + x2
-                if activation == 'leaky':
-                    x = F.leaky_relu(x, 0.1, inplace=True)
-                elif activation == 'relu':
-                    x = F.relu(x, inplace=True)
-                outputs[ind] = x
-            elif block['type'] == 'yolo':
-                x, layer_loss = self.models[ind](x, targets, img_size, self.use_giou_loss)
+            with profiling.span('darknet_{}'.format(block['type'])):
+                x, layer_loss = self.forward_block(ind, block, x, outputs, targets, img_size)
+            if block['type'] == 'yolo':
                 loss += layer_loss
                 yolo_outputs.append(x)
-            elif block['type'] == 'cost':
-                continue
-            else:
-                print('unknown type %s' % (block['type']))
         yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
 
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
+    def forward_block(self, ind, block, x, outputs, targets=None, img_size=608):
+        """Run the layer `ind` of the cfg on x (the output of the previous layer).
+        The output is stored in `outputs` for the route/shortcut layers, except the yolo outputs.
+        Returns the output and the yolo loss of the layer (0. for the other layers).
+        """
+        if block['type'] in ['convolutional', 'maxpool', 'reorg', 'upsample', 'avgpool', 'softmax', 'connected']:
+            x = self.models[ind](x)
+            outputs[ind] = x
+        elif block['type'] == 'route':
+            layers = get_route_layers(block, ind)
+            if len(layers) == 1:
+                if 'groups' not in block.keys() or int(block['groups']) == 1:
+                    x = outputs[layers[0]]
+                    outputs[ind] = x
+                else:
+                    groups = int(block['groups'])
+                    group_id = int(block['group_id'])
+                    _, b, _, _ = outputs[layers[0]].shape
+                    x = outputs[layers[0]][:, b // groups * group_id:b // groups * (group_id + 1)]
+                    outputs[ind] = x
+            elif len(layers) == 2:
+                x1 = outputs[layers[0]]
+                x2 = outputs[layers[1]]
+                x = torch.cat((x1, x2), 1)
+                outputs[ind] = x
+            elif len(layers) == 4:
+                x1 = outputs[layers[0]]
+                x2 = outputs[layers[1]]
+                x3 = outputs[layers[2]]
+                x4 = outputs[layers[3]]
+                x = torch.cat((x1, x2, x3, x4), 1)
+                outputs[ind] = x
+            else:
+                print("rounte number > 2 ,is {}".format(len(layers)))
+
+        elif block['type'] == 'shortcut':
+            from_layer = get_shortcut_layer(block, ind)
+            activation = block['activation']
+            x1 = outputs[from_layer]
+            x2 = outputs[ind - 1]
+            x = x1 + x2
+            if activation == 'leaky':
+                x = F.leaky_relu(x, 0.1, inplace=True)
+            elif activation == 'relu':
+                x = F.relu(x, inplace=True)
+            outputs[ind] = x
+        elif block['type'] == 'yolo':
+            return self.models[ind](x, targets, img_size, self.use_giou_loss)
+        else:
+            print('unknown type %s' % (block['type']))
+
+        return x, 0.
+
     def print_network(self):
         print_cfg(self.blocks)
 
@@ -329,9 +345,8 @@ class Darknet(nn.Module):
                 # models.append(Upsample_interpolate(stride))
 
             elif block['type'] == 'route':
-                layers = block['layers'].split(',')
                 ind = len(models)
-                layers = [int(i) if int(i) > 0 else int(i) + ind for i in layers]
+                layers = get_route_layers(block, ind)
                 if len(layers) == 1:
                     if 'groups' not in block.keys() or int(block['groups']) == 1:
                         prev_filters = out_filters[layers[0]]
@@ -0,0 +1,220 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Per-layer profile of a darknet cfg: wall time, FLOPs, parameters, activation size and memory
+
+The network runs block by block (Darknet.forward_block) on a random input. For every layer of the cfg:
+    time        mean wall time over the timed runs (cuda is synchronized around every layer)
+    GFLOPs      2 x MACs of the convolutions and linear layers, one op per output element for the other layers
+    params      number of parameters of the layer
+    act (MB)    size of the output; a route of a single layer (or a group of it) is a view and allocates nothing
+    live (MB)   the activations alive while the layer runs, if every output were freed after its last reader
+                (the next layer, or the route/shortcut layers reading it; the yolo outputs live until the end)
+The layer at which the live memory peaks is marked with *. Darknet.forward keeps every output until the end of the
+forward pass, the report also gives that total.
+
+Usage:
+    python models/darknet_profiler.py --cfgfile config/cfg/complex_yolov4.cfg --batch_size 1
+    python models/darknet_profiler.py --cfgfile config/cfg/complex_yolov4.cfg config/cfg/complex_yolov4_tiny.cfg
+-----------------------------------------------------------------------------------
+"""
+
+import argparse
+import sys
+import os
+import time
+import json
+
+import torch
+import torch.nn as nn
+
+sys.path.append('../')
+
+from models.darknet2pytorch import Darknet, get_route_layers, get_shortcut_layer
+
+
+def get_layers(model):
+    """The (ind, block) of the layers of the model, as iterated by Darknet.forward"""
+    return [(ind, block) for ind, block in enumerate(model.blocks, start=-1) if block['type'] not in ['net', 'cost']]
+
+
+def get_layer_inputs(ind, block):
+    """The layers whose output is read by the layer `ind` (-1 is the input image)"""
+    if block['type'] == 'route':
+        return get_route_layers(block, ind)
+    elif block['type'] == 'shortcut':
+        return [get_shortcut_layer(block, ind), ind - 1]
+    return [ind - 1]
+
+
+def is_view_layer(block):
+    """A route of a single layer returns the output of that layer (or a channel slice of it) without a copy"""
+    return (block['type'] == 'route') and (len(block['layers'].split(',')) == 1)
+
+
+def count_flops(module, block, output):
+    """FLOPs of a layer for its output (of the whole batch)"""
+    if block['type'] in ['convolutional', 'connected']:
+        flops = 0
+        for layer in module.modules():
+            if isinstance(layer, nn.Conv2d):
+                kh, kw = layer.kernel_size
+                flops += 2 * output.numel() * (layer.in_channels // layer.groups) * kh * kw
+            elif isinstance(layer, nn.Linear):
+                flops += 2 * output.numel() * layer.in_features
+            elif isinstance(layer, (nn.BatchNorm2d, nn.LeakyReLU, nn.ReLU)):
+                flops += output.numel()
+            elif layer.__class__.__name__ == 'Mish':
+                flops += output.numel()
+        return flops
+    elif block['type'] == 'maxpool':
+        size = int(block['size'])
+        return output.numel() * size * size
+    elif block['type'] in ['shortcut', 'yolo', 'avgpool', 'softmax']:
+        return output.numel()
+    # upsample, reorg and route only move data
+    return 0
+
+
+def cuda_sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def profile_darknet(model, batch_size=1, img_size=None, device=torch.device('cpu'), repeats=5):
+    """Return the per-layer profile (a list of dicts) and the summary of the model, see the module docstring"""
+    img_size = model.width if img_size is None else img_size
+    model = model.to(device)
+    model.eval()
+    layers = get_layers(model)
+    imgs = torch.rand(batch_size, 3, img_size, img_size, device=device)
+
+    times = {ind: [] for ind, _ in layers}
+    stats = {}
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    with torch.no_grad():
+        # The first run is not timed (cudnn autotune, allocator warmup)
+        for run_idx in range(repeats + 1):
+            outputs = {}
+            x = imgs
+            for ind, block in layers:
+                cuda_sync(device)
+                start_time = time.perf_counter()
+                x, _ = model.forward_block(ind, block, x, outputs, None, img_size)
+                cuda_sync(device)
+                if run_idx > 0:
+                    times[ind].append(time.perf_counter() - start_time)
+                else:
+                    stats[ind] = {
+                        'shape': list(x.shape),
+                        'numel': x.numel(),
+                        'bytes': 0 if is_view_layer(block) else x.numel() * x.element_size(),
+                        'flops': count_flops(model.models[ind], block, x),
+                        'params': sum(p.numel() for p in model.models[ind].parameters()),
+                    }
+    max_memory_allocated = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+
+    # Activation lifetimes: a view extends the lifetime of the output it reads
+    root = {-1: -1}
+    sizes = {-1: imgs.numel() * imgs.element_size()}
+    last_use = {-1: -1}
+    last_ind = layers[-1][0]
+    for ind, block in layers:
+        inputs = get_layer_inputs(ind, block)
+        root[ind] = root[inputs[0]] if is_view_layer(block) else ind
+        sizes[ind] = stats[ind]['bytes']
+        last_use[ind] = last_ind if block['type'] == 'yolo' else ind
+        for input_ind in inputs:
+            last_use[root[input_ind]] = max(last_use[root[input_ind]], ind)
+    for ind, _ in layers:
+        last_use[root[ind]] = max(last_use[root[ind]], last_use[ind])
+
+    roots = [ind for ind in sizes if root[ind] == ind]
+    profile = []
+    for ind, block in layers:
+        live = sum(sizes[r] for r in roots if (r <= ind) and (last_use[r] >= ind))
+        profile.append(dict(stats[ind], ind=ind, type=block['type'], inputs=get_layer_inputs(ind, block),
+                            last_use=last_use[root[ind]], live_bytes=live,
+                            time_ms=1000. * sum(times[ind]) / max(len(times[ind]), 1)))
+
+    peak = max(profile, key=lambda layer: layer['live_bytes'])
+    summary = {
+        'batch_size': batch_size,
+        'img_size': img_size,
+        'device': str(device),
+        'time_ms': sum(layer['time_ms'] for layer in profile),
+        'gflops': sum(layer['flops'] for layer in profile) / 1e9,
+        'params': sum(layer['params'] for layer in profile),
+        'peak_live_mb': peak['live_bytes'] / 2 ** 20,
+        'peak_layer': peak['ind'],
+        'held_by_forward_mb': (sizes[-1] + sum(layer['bytes'] for layer in profile)) / 2 ** 20,
+        'max_memory_allocated_mb': None if max_memory_allocated is None else max_memory_allocated / 2 ** 20,
+    }
+    return profile, summary
+
+
+def print_profile(profile, summary):
+    total_time = max(summary['time_ms'], 1e-9)
+    print('{:>4s} {:<14s} {:<22s} {:>9s} {:>6s} {:>9s} {:>10s} {:>9s} {:>9s} {:>9s}'.format(
+        'ind', 'type', 'output', 'time(ms)', '%', 'GFLOPs', 'params', 'act(MB)', 'live(MB)', 'last use'))
+    for layer in profile:
+        print('{:>4d} {:<14s} {:<22s} {:>9.3f} {:>6.1f} {:>9.3f} {:>10d} {:>9.2f} {:>9.2f} {:>9d}{}'.format(
+            layer['ind'], layer['type'], 'x'.join(str(d) for d in layer['shape']), layer['time_ms'],
+            100. * layer['time_ms'] / total_time, layer['flops'] / 1e9, layer['params'], layer['bytes'] / 2 ** 20,
+            layer['live_bytes'] / 2 ** 20, layer['last_use'], ' *' if layer['ind'] == summary['peak_layer'] else ''))
+    print_summary(summary)
+
+
+def print_summary(summary):
+    print('batch {batch_size} x {img_size}x{img_size} on {device}: {time_ms:.2f} ms, {gflops:.2f} GFLOPs, '
+          '{params} params'.format(**summary))
+    message = 'activations: peak live {:.1f} MB (layer {}), held by Darknet.forward {:.1f} MB'.format(
+        summary['peak_live_mb'], summary['peak_layer'], summary['held_by_forward_mb'])
+    if summary['max_memory_allocated_mb'] is not None:
+        message += ', cuda max allocated {:.1f} MB'.format(summary['max_memory_allocated_mb'])
+    print(message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-layer profile of darknet cfgs')
+    parser.add_argument('--cfgfile', type=str, nargs='+', default=['./config/cfg/complex_yolov4.cfg'], metavar='PATH',
+                        help='The cfg file(s) to profile')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='The batch size of the input')
+    parser.add_argument('--img_size', type=int, default=None,
+                        help='The size of the input, default: the width of the cfg')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='The number of timed forward passes')
+    parser.add_argument('--no_cuda', action='store_true',
+                        help='If true, cuda is not used.')
+    parser.add_argument('--gpu_idx', default=None, type=int,
+                        help='GPU index to use.')
+    parser.add_argument('--output', type=str, default=None, metavar='PATH',
+                        help='Also write the profiles as JSON to this file')
+    configs = parser.parse_args()
+
+    if configs.no_cuda or (not torch.cuda.is_available()):
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda' if configs.gpu_idx is None else 'cuda:{}'.format(configs.gpu_idx))
+
+    results = {}
+    for cfgfile in configs.cfgfile:
+        print('\n{}'.format(cfgfile))
+        model = Darknet(cfgfile=cfgfile, use_giou_loss=False)
+        profile, summary = profile_darknet(model, batch_size=configs.batch_size, img_size=configs.img_size,
+                                           device=device, repeats=configs.repeats)
+        print_profile(profile, summary)
+        results[os.path.basename(cfgfile)] = {'summary': summary, 'layers': profile}
+        del model
+
+    if len(results) > 1:
+        print('\nSummary:')
+        for cfg_fn, result in results.items():
+            print(cfg_fn)
+            print_summary(result['summary'])
+
+    if configs.output is not None:
+        with open(configs.output, 'w') as f:
+            json.dump(results, f, indent=2)
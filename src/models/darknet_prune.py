@@ -0,0 +1,224 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Channel pruning (network slimming) of a darknet model by the magnitude of the BN gammas
+
+The output channels of the convolutions with batch normalization are ranked by |gamma| over the whole network and
+the smallest ones are removed, except for the layers whose channels are tied to other layers:
+    - the inputs of a shortcut (the added tensors must keep the same channels),
+    - the input of a grouped route (the split of its channels would change),
+    - the inputs of reorg/connected/yolo layers,
+following route concatenations, maxpool and upsample layers back to the convolutions. The inputs of every kept
+convolution are sliced along the channels which survive in the layers it reads (through routes, maxpools, ...).
+
+The slimmed cfg is written with write_cfg() and the weights as a state dict loadable by create_model() with that cfg.
+The removed channels are dropped without compensation, fine-tune the pruned model with train.py
+(--cfgfile <pruned cfg> --pretrained_path <pruned weights>). Training with --bn_sparsity beforehand pushes the
+unimportant gammas towards 0 and makes the pruning much less destructive.
+
+Usage:
+    python models/darknet_prune.py --cfgfile config/cfg/complex_yolov4.cfg --pretrained_path <PATH> \
+        --prune_ratio 0.5 --output_cfg config/cfg/complex_yolov4_pruned.cfg --output_weights <PATH>
+-----------------------------------------------------------------------------------
+"""
+
+import argparse
+import sys
+import copy
+import math
+
+import torch
+import torch.nn as nn
+
+sys.path.append('../')
+
+from models.darknet2pytorch import Darknet
+from models.darknet_utils import write_cfg
+from models.model_utils import load_model_weights
+from models.darknet_profiler import get_layers, get_layer_inputs, profile_darknet, print_summary
+
+# Layers whose output channels are the channels of their input
+PASSTHROUGH_LAYERS = ['maxpool', 'upsample', 'avgpool', 'softmax']
+
+
+def get_conv_bn(module):
+    conv, bn = None, None
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv2d):
+            conv = layer
+        elif isinstance(layer, nn.BatchNorm2d):
+            bn = layer
+    return conv, bn
+
+
+def get_prunable_layers(model):
+    """Return the indices of the convolutions whose output channels can be pruned"""
+    blocks = dict(get_layers(model))
+    protected = set()
+
+    def protect(ind):
+        if (ind < 0) or (ind in protected):
+            return
+        protected.add(ind)
+        block = blocks[ind]
+        if (block['type'] in PASSTHROUGH_LAYERS) or (block['type'] in ['route', 'shortcut']):
+            for input_ind in get_layer_inputs(ind, block):
+                protect(input_ind)
+
+    for ind, block in blocks.items():
+        if block['type'] == 'shortcut':
+            for input_ind in get_layer_inputs(ind, block):
+                protect(input_ind)
+        elif (block['type'] == 'route') and (int(block.get('groups', 1)) > 1):
+            protect(get_layer_inputs(ind, block)[0])
+        elif block['type'] in ['reorg', 'connected', 'yolo']:
+            protect(ind - 1)
+
+    return [ind for ind, block in blocks.items() if (block['type'] == 'convolutional') and
+            int(block['batch_normalize']) and (ind not in protected)]
+
+
+def compute_channel_masks(model, prune_ratio, channel_multiple=1, min_keep_ratio=0.1):
+    """Return {conv ind: bool mask of its kept output channels} for the prunable convolutions.
+    The threshold on |gamma| is global, a layer keeps at least min_keep_ratio of its channels, rounded up to a
+    multiple of channel_multiple (friendlier to the vectorized kernels).
+    """
+    prunable = get_prunable_layers(model)
+    gammas = {ind: get_conv_bn(model.models[ind])[1].weight.data.abs().cpu() for ind in prunable}
+    all_gammas = torch.cat(list(gammas.values())).sort()[0]
+    num_pruned = int(len(all_gammas) * prune_ratio)
+    threshold = all_gammas[num_pruned - 1] if num_pruned > 0 else -1.
+
+    masks = {}
+    for ind in prunable:
+        layer_gammas = gammas[ind]
+        num_channels = len(layer_gammas)
+        num_keep = int((layer_gammas > threshold).sum())
+        num_keep = max(num_keep, int(math.ceil(min_keep_ratio * num_channels)), 1)
+        if channel_multiple > 1:
+            num_keep = min(num_channels, int(math.ceil(num_keep / channel_multiple)) * channel_multiple)
+        mask = torch.zeros(num_channels, dtype=torch.bool)
+        mask[layer_gammas.topk(num_keep)[1]] = True
+        masks[ind] = mask
+
+    return masks
+
+
+def propagate_masks(model, masks):
+    """Return {ind: bool mask over the original output channels of the layer ind} for all the layers, -1 is the
+    input image"""
+    out_masks = {-1: torch.ones(int(model.blocks[0]['channels']), dtype=torch.bool)}
+    for ind, block in get_layers(model):
+        inputs = get_layer_inputs(ind, block)
+        if block['type'] == 'convolutional':
+            out_masks[ind] = masks.get(ind, torch.ones(int(block['filters']), dtype=torch.bool))
+        elif block['type'] == 'route':
+            if len(inputs) == 1:
+                groups = int(block.get('groups', 1))
+                if groups == 1:
+                    out_masks[ind] = out_masks[inputs[0]]
+                else:
+                    # The input of a grouped route is protected
+                    out_masks[ind] = torch.ones(len(out_masks[inputs[0]]) // groups, dtype=torch.bool)
+            else:
+                out_masks[ind] = torch.cat([out_masks[input_ind] for input_ind in inputs])
+        elif block['type'] in PASSTHROUGH_LAYERS + ['shortcut']:
+            out_masks[ind] = out_masks[ind - 1]
+        else:
+            # yolo, reorg, connected: never read by a pruned layer
+            out_masks[ind] = None
+    return out_masks
+
+
+def prune_blocks(blocks, masks):
+    """Return a copy of the cfg blocks with the filters of the pruned convolutions"""
+    pruned_blocks = copy.deepcopy(blocks)
+    for ind, mask in masks.items():
+        # blocks[0] is the [net] block
+        pruned_blocks[ind + 1]['filters'] = str(int(mask.sum()))
+    return pruned_blocks
+
+
+def copy_pruned_weights(model, pruned_model, out_masks):
+    """Copy the kept channels of the model into the pruned model"""
+    for ind, block in get_layers(model):
+        if block['type'] == 'convolutional':
+            conv, bn = get_conv_bn(model.models[ind])
+            pruned_conv, pruned_bn = get_conv_bn(pruned_model.models[ind])
+            out_keep = out_masks[ind].nonzero().view(-1)
+            in_keep = out_masks[ind - 1].nonzero().view(-1)
+            pruned_conv.weight.data.copy_(conv.weight.data[out_keep][:, in_keep])
+            if conv.bias is not None:
+                pruned_conv.bias.data.copy_(conv.bias.data[out_keep])
+            if bn is not None:
+                pruned_bn.weight.data.copy_(bn.weight.data[out_keep])
+                pruned_bn.bias.data.copy_(bn.bias.data[out_keep])
+                pruned_bn.running_mean.copy_(bn.running_mean[out_keep])
+                pruned_bn.running_var.copy_(bn.running_var[out_keep])
+                pruned_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+        elif block['type'] == 'connected':
+            pruned_model.models[ind].load_state_dict(model.models[ind].state_dict())
+
+
+def prune_darknet(model, pruned_cfgfile, prune_ratio, channel_multiple=1, min_keep_ratio=0.1):
+    """Write the slimmed cfg and return the pruned Darknet (built from it) with the kept weights"""
+    model = model.cpu()
+    masks = compute_channel_masks(model, prune_ratio, channel_multiple=channel_multiple,
+                                  min_keep_ratio=min_keep_ratio)
+    out_masks = propagate_masks(model, masks)
+    write_cfg(prune_blocks(model.blocks, masks), pruned_cfgfile)
+    pruned_model = Darknet(cfgfile=pruned_cfgfile, use_giou_loss=model.use_giou_loss)
+    copy_pruned_weights(model, pruned_model, out_masks)
+
+    for ind, mask in masks.items():
+        print('layer {:4d}: {:5d} -> {:5d} channels'.format(ind, len(mask), int(mask.sum())))
+
+    return pruned_model
+
+
+def add_bn_sparsity_grad(model, scale):
+    """L1 penalty on the gammas of the prunable BNs (network slimming), to call after backward()"""
+    darknet = model.module if hasattr(model, 'module') else model
+    if not hasattr(darknet, 'prunable_bns'):
+        darknet.prunable_bns = [get_conv_bn(darknet.models[ind])[1] for ind in get_prunable_layers(darknet)]
+    for bn in darknet.prunable_bns:
+        if bn.weight.grad is not None:
+            bn.weight.grad.data.add_(scale * torch.sign(bn.weight.data))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune the channels of a darknet model by the BN gammas')
+    parser.add_argument('--cfgfile', type=str, default='./config/cfg/complex_yolov4.cfg', metavar='PATH',
+                        help='The cfg of the model to prune')
+    parser.add_argument('--pretrained_path', type=str, required=True, metavar='PATH',
+                        help='The weights of the model to prune')
+    parser.add_argument('--prune_ratio', type=float, default=0.5,
+                        help='The fraction of the prunable channels to remove')
+    parser.add_argument('--channel_multiple', type=int, default=8,
+                        help='Round the number of kept channels of a layer up to a multiple of this')
+    parser.add_argument('--min_keep_ratio', type=float, default=0.1,
+                        help='The min fraction of channels kept in every layer')
+    parser.add_argument('--output_cfg', type=str, required=True, metavar='PATH',
+                        help='The slimmed cfg file')
+    parser.add_argument('--output_weights', type=str, required=True, metavar='PATH',
+                        help='The weights of the slimmed model')
+    parser.add_argument('--profile', action='store_true',
+                        help='If true, compare the cpu forward time of the models before and after pruning')
+    configs = parser.parse_args()
+
+    model = Darknet(cfgfile=configs.cfgfile, use_giou_loss=False)
+    load_model_weights(model, configs.pretrained_path)
+    num_params = sum(p.numel() for p in model.parameters())
+
+    pruned_model = prune_darknet(model, configs.output_cfg, configs.prune_ratio,
+                                 channel_multiple=configs.channel_multiple, min_keep_ratio=configs.min_keep_ratio)
+    torch.save(pruned_model.state_dict(), configs.output_weights)
+    num_pruned_params = sum(p.numel() for p in pruned_model.parameters())
+    print('Parameters: {} -> {} ({:.1f}%)'.format(num_params, num_pruned_params,
+                                                  100. * num_pruned_params / num_params))
+    print('Saved {} and {}'.format(configs.output_cfg, configs.output_weights))
+
+    if configs.profile:
+        for name, darknet in [('original', model), ('pruned', pruned_model)]:
+            print(name)
+            print_summary(profile_darknet(darknet, device=torch.device('cpu'), repeats=3)[1])
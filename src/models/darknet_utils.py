@@ -11,18 +11,21 @@ import torch
 sys.path.append('../')
 from utils.torch_utils import convert2cpu
 
-__all__ = ['parse_cfg', 'print_cfg', 'load_conv', 'load_conv_bn', 'save_conv', 'save_conv_bn', 'load_fc', 'save_fc']
-
+__all__ = ['parse_cfg', 'parse_cfg_lines', 'write_cfg', 'print_cfg', 'load_conv', 'load_conv_bn', 'save_conv',
+           'save_conv_bn', 'load_fc', 'save_fc']
 
 def parse_cfg(cfgfile):
+    """Parse a darknet cfg into its list of blocks, the file is read at once"""
+    with open(cfgfile, 'r') as fp:
+        return parse_cfg_lines(fp.read().splitlines())
+
+
+def parse_cfg_lines(lines):
     blocks = []
-    fp = open(cfgfile, 'r')
     block = None
-    line = fp.readline()
-    while line != '':
+    for line in lines:
         line = line.rstrip()
         if line == '' or line[0] == '#':
-            line = fp.readline()
             continue
         elif line[0] == '[':
             if block:
@@ -39,14 +42,26 @@ def parse_cfg(cfgfile):
                 key = '_type'
             value = value.strip()
             block[key] = value
-        line = fp.readline()
 
     if block:
         blocks.append(block)
-    fp.close()
     return blocks
 
 
+def write_cfg(blocks, cfgfile):
+    """Write the blocks (as returned by parse_cfg) back to a cfg file"""
+    with open(cfgfile, 'w') as fp:
+        for block in blocks:
+            fp.write('[{}]\n'.format(block['type']))
+            for key, value in block.items():
+                if key == 'type':
+                    continue
+                if key == '_type':
+                    key = 'type'
+                fp.write('{}={}\n'.format(key, value))
+            fp.write('\n')
+
+
 def print_cfg(blocks):
     print('layer     filters    size              input                output')
     prev_width = 416
@@ -9,6 +9,9 @@
 """
 
 import sys
+import os
+import inspect
+import hashlib
 
 import torch
 
@@ -28,6 +31,82 @@ def create_model(configs):
     return model
 
 
+def load_checkpoint(path):
+    """Load a checkpoint file on the cpu, whatever the device it was saved from.
+    The tensors are memory-mapped from the file when torch supports it (torch >= 2.1 and the zipfile format), the pages
+    are then only read when the tensors are copied to their device.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # Legacy (non zipfile) serialization, it can not be memory-mapped
+            pass
+    return torch.load(path, map_location='cpu')
+
+
+def get_model_state_dict(checkpoint):
+    """The model weights of a checkpoint: a single-file checkpoint (see utils.train_utils.CheckpointSaver) or the
+    state dict of a legacy Model_*.pth file"""
+    if isinstance(checkpoint, dict) and ('format_version' in checkpoint):
+        return checkpoint['model']
+    return checkpoint
+
+
+def load_model_weights(model, path):
+    """Load the weights of a checkpoint file (of any format) into the model"""
+    model.load_state_dict(get_model_state_dict(load_checkpoint(path)))
+    return model
+
+
+def get_traced_model_path(configs):
+    """The cache file of the traced model, keyed by the cfg content, the weights file, the input and batch sizes and the
+    device"""
+    key = hashlib.sha1()
+    with open(configs.cfgfile, 'rb') as f:
+        key.update(f.read())
+    stat = os.stat(configs.pretrained_path)
+    key.update('{}_{}_{}_{}_{}_{}_{}'.format(os.path.abspath(configs.pretrained_path), stat.st_mtime_ns, stat.st_size,
+                                             configs.img_size, configs.batch_size, configs.device.type,
+                                             torch.__version__).encode('utf-8'))
+    return os.path.join(configs.jit_cache_dir, 'darknet_{}.pt'.format(key.hexdigest()[:16]))
+
+
+def load_inference_model(configs):
+    """Return the model with its pretrained weights on configs.device, in eval mode.
+    With configs.jit_cache_dir, the model is traced once and the next runs load the traced model instead of parsing
+    the cfg, building the module graph and loading the state dict (the traced model only runs inference, on
+    inputs of configs.img_size).
+    """
+    jit_cache_dir = configs.get('jit_cache_dir')
+    if jit_cache_dir is not None:
+        traced_path = get_traced_model_path(configs)
+        if os.path.isfile(traced_path):
+            model = torch.jit.load(traced_path, map_location=configs.device)
+            model.eval()
+            return model
+
+    model = create_model(configs)
+    load_model_weights(model, configs.pretrained_path)
+    model = model.to(device=configs.device)
+    model.eval()
+
+    if jit_cache_dir is not None:
+        sample_input = torch.rand(configs.batch_size, 3, configs.img_size, configs.img_size, device=configs.device)
+        # The last batch of a split may be smaller: the trace is checked on a single image as well
+        check_inputs = [(sample_input,), (sample_input[:1].clone(),)]
+        with torch.no_grad():
+            model = torch.jit.trace(model, sample_input, check_inputs=check_inputs)
+        if not os.path.isdir(jit_cache_dir):
+            os.makedirs(jit_cache_dir)
+        # Concurrent jobs may trace the same model, the last rename wins
+        tmp_path = '{}.tmp{}'.format(traced_path, os.getpid())
+        torch.jit.save(model, tmp_path)
+        os.replace(tmp_path, traced_path)
+
+    return model
+
+
 def get_num_parameters(model):
     """Count number of trained parameters of the model"""
     if hasattr(model, 'module'):
@@ -52,6 +131,11 @@ def make_data_parallel(model, configs):
             configs.batch_size = int(configs.batch_size / configs.ngpus_per_node)
             configs.num_workers = int((configs.num_workers + configs.ngpus_per_node - 1) / configs.ngpus_per_node)
             model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[configs.gpu_idx])
+        elif configs.no_cuda:
+            # cpu processes (gloo backend): the batch and the workers of the node are split between its processes
+            configs.batch_size = int(configs.batch_size / configs.ngpus_per_node)
+            configs.num_workers = int((configs.num_workers + configs.ngpus_per_node - 1) / configs.ngpus_per_node)
+            model = torch.nn.parallel.DistributedDataParallel(model)
         else:
             model.cuda()
             # DistributedDataParallel will divide and allocate batch_size to all
@@ -60,7 +144,7 @@ def make_data_parallel(model, configs):
     elif configs.gpu_idx is not None:
         torch.cuda.set_device(configs.gpu_idx)
         model = model.cuda(configs.gpu_idx)
-    else:
+    elif not configs.no_cuda:
         # DataParallel will divide and allocate batch_size to all available GPUs
         model = torch.nn.DataParallel(model).cuda()
 
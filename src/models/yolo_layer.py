@@ -20,6 +20,7 @@ import torch.nn.functional as F
 sys.path.append('../')
 
 from utils.torch_utils import to_cpu
+from utils import profiling
 from utils.iou_rotated_boxes_utils import iou_pred_vs_target_boxes, iou_rotated_boxes_targets_vs_anchors, \
     get_polygons_areas_fix_xy
 
@@ -66,6 +67,7 @@ class YoloLayer(nn.Module):
         # Pre compute polygons and areas of anchors
         self.scaled_anchors_polygons, self.scaled_anchors_areas = get_polygons_areas_fix_xy(self.scaled_anchors)
 
+    @profiling.profiled('build_targets')
     def build_targets(self, pred_boxes, pred_cls, target, anchors):
         """ Built yolo targets to compute loss
         :param out_boxes: [num_samples or batch, num_anchors, grid_size, grid_size, 6]
@@ -0,0 +1,393 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Long-running inference on live point-cloud frames
+
+Raw scans (x, y, z, intensity arrays) come from a python queue (StreamingDetector.submit), a watched directory or a
+TCP socket and go through three stages running on their own threads, joined by bounded queues:
+    rasterize (adjust_pointcloud, removePoints, makeBVFeature) -> forward pass -> NMS (post_processing_v2)
+so the CPU rasterization of frame N+1 overlaps the model on frame N. The detections are written as JSON lines,
+the per-stage latency histograms are printed on stderr.
+A frame which fails (invalid scan, error in a stage) gets a {"frame_id", "error"} line, the pipeline goes on.
+-----------------------------------------------------------------------------------
+"""
+
+import argparse
+import sys
+import os
+import io
+import time
+import json
+import queue
+import socket
+import struct
+import threading
+
+from easydict import EasyDict as edict
+import numpy as np
+import torch
+
+sys.path.append('./')
+
+import config.kitti_config as cnf
+from data_process import kitti_bev_utils
+from models.model_utils import create_model, load_model_weights
+from utils.evaluation_utils import post_processing_v2, detections_to_dicts
+from utils.misc import LatencyHistogram
+
+# Marks the end of the stream in the stage queues
+STOP = None
+
+# Socket message header: length of the utf-8 frame id, length of the .npy payload
+HEADER = struct.Struct('!II')
+
+STAGES = ['queue_wait', 'rasterize', 'forward', 'nms', 'end_to_end']
+
+
+class Frame(object):
+    """A scan travelling through the pipeline"""
+
+    def __init__(self, frame_id, points):
+        self.frame_id = frame_id
+        self.points = points
+        self.t_received = time.time()
+        self.timings = {}
+        self.bev = None
+        self.pcd_ratio_vars = None
+        self.outputs = None
+
+
+def read_points_file(path):
+    """Read an (N, 4) x, y, z, intensity scan from a .ply, a KITTI .bin or a .npy file"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.ply':
+        import open3d as o3d
+        pcd = o3d.io.read_point_cloud(path)
+        return np.concatenate([np.asarray(pcd.points), np.asarray(pcd.colors)[:, :1]], axis=1)
+    elif ext == '.bin':
+        return np.fromfile(path, dtype=np.float32).reshape(-1, 4)
+    elif ext == '.npy':
+        return np.load(path, allow_pickle=False)
+    else:
+        raise ValueError('Unsupported point cloud file: {}'.format(path))
+
+
+class StreamingDetector(object):
+    """Pipelined detector fed with raw scans, see the module docstring"""
+
+    def __init__(self, model, configs, out_stream=sys.stdout, stats_stream=sys.stderr):
+        self.model = model
+        self.device = configs.device
+        self.conf_thresh = configs.conf_thresh
+        self.nms_thresh = configs.nms_thresh
+        self.max_batch_size = configs.max_batch_size
+        self.drop_frames = configs.drop_frames
+        self.stats_freq = configs.stats_freq
+        self.pin_memory = configs.pin_memory and (self.device.type == 'cuda')
+        # The frames of a batch are stacked into this pinned buffer, so the copy to the device is asynchronous. It is
+        # reused: the forward pass ends with the outputs on the cpu, the previous copy is complete
+        self.pinned_batch = None
+        if self.pin_memory:
+            self.pinned_batch = torch.empty((self.max_batch_size, 3, cnf.BEV_HEIGHT, cnf.BEV_WIDTH)).pin_memory()
+        self.out_stream = out_stream
+        self.stats_stream = stats_stream
+        self.class_names = cnf.class_list
+
+        self.input_queue = queue.Queue(maxsize=configs.queue_size)
+        self.bev_queue = queue.Queue(maxsize=configs.queue_size)
+        self.output_queue = queue.Queue(maxsize=configs.queue_size)
+        self.histograms = {name: LatencyHistogram(name) for name in STAGES}
+        self.num_frames = 0
+        self.num_dropped = 0
+        self.num_errors = 0
+        # The stages and the sources write to out_stream
+        self.write_lock = threading.Lock()
+
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in (self._rasterize_loop, self._forward_loop, self._nms_loop)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, frame_id, points):
+        """Queue an (N, 4) x, y, z, intensity scan. When the pipeline is full, wait for a free slot (back-pressure on
+        the source), or drop the frame and return False if drop_frames is set. An invalid scan gets an error record
+        and is not queued (returns False)"""
+        frame = Frame(frame_id, points)
+        try:
+            kitti_bev_utils.check_scan(points)
+        except ValueError as e:
+            self.write_error(frame, e)
+            return False
+        if self.drop_frames:
+            try:
+                self.input_queue.put_nowait(frame)
+            except queue.Full:
+                self.num_dropped += 1
+                return False
+        else:
+            self.input_queue.put(frame)
+        return True
+
+    def close(self):
+        """Flush the frames in flight and stop the stages"""
+        self.input_queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+        self.out_stream.flush()
+
+    def _rasterize_loop(self):
+        while True:
+            frame = self.input_queue.get()
+            if frame is STOP:
+                self.bev_queue.put(STOP)
+                return
+            start_time = time.time()
+            frame.timings['queue_wait'] = start_time - frame.t_received
+            try:
+                points = np.asarray(frame.points)
+                rgb_map, frame.pcd_ratio_vars = kitti_bev_utils.pointcloud_to_bev(points[:, :3].astype(np.float64),
+                                                                                  points[:, 3])
+                frame.bev = torch.from_numpy(rgb_map).float()
+            except Exception as e:
+                self.write_error(frame, e)
+                continue
+            finally:
+                frame.points = None
+            frame.timings['rasterize'] = time.time() - start_time
+            self.bev_queue.put(frame)
+
+    def _forward_loop(self):
+        stopping = False
+        while not stopping:
+            frames = [self.bev_queue.get()]
+            # Batch the frames which are already rasterized, never wait for more
+            while (len(frames) < self.max_batch_size) and (frames[-1] is not STOP):
+                try:
+                    frames.append(self.bev_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if frames[-1] is STOP:
+                frames.pop()
+                stopping = True
+            if len(frames) == 0:
+                continue
+            start_time = time.time()
+            try:
+                if self.pinned_batch is not None:
+                    imgs = torch.stack([frame.bev for frame in frames], out=self.pinned_batch[:len(frames)])
+                else:
+                    imgs = torch.stack([frame.bev for frame in frames])
+                imgs = imgs.to(self.device, non_blocking=True)
+                with torch.no_grad():
+                    # The darknet outputs are moved to the cpu, which also waits for the device
+                    outputs = self.model(imgs)
+            except Exception as e:
+                for frame in frames:
+                    self.write_error(frame, e)
+                continue
+            forward_time = time.time() - start_time
+            for frame, frame_outputs in zip(frames, outputs):
+                frame.bev = None
+                frame.outputs = frame_outputs
+                frame.timings['forward'] = forward_time
+            self.output_queue.put(frames)
+        self.output_queue.put(STOP)
+
+    def _nms_loop(self):
+        while True:
+            frames = self.output_queue.get()
+            if frames is STOP:
+                return
+            start_time = time.time()
+            try:
+                detections = post_processing_v2(torch.stack([frame.outputs for frame in frames]),
+                                                conf_thresh=self.conf_thresh, nms_thresh=self.nms_thresh)
+            except Exception as e:
+                for frame in frames:
+                    self.write_error(frame, e)
+                continue
+            nms_time = time.time() - start_time
+            for frame, frame_detections in zip(frames, detections):
+                frame.timings['nms'] = nms_time
+                try:
+                    self.write(frame, frame_detections)
+                except Exception as e:
+                    self.write_error(frame, e)
+
+    def write(self, frame, detections):
+        frame.timings['end_to_end'] = time.time() - frame.t_received
+        record = {
+            'frame_id': frame.frame_id,
+            'detections': detections_to_dicts(detections, self.class_names),
+            'pcd_ratio_vars': [float(v) for v in frame.pcd_ratio_vars],
+            'latency_ms': {name: round(1000. * latency, 2) for name, latency in frame.timings.items()},
+        }
+        with self.write_lock:
+            for name, latency in frame.timings.items():
+                self.histograms[name].update(latency)
+            self.out_stream.write(json.dumps(record) + '\n')
+            self.out_stream.flush()
+            self.num_frames += 1
+            if (self.stats_freq > 0) and ((self.num_frames % self.stats_freq) == 0):
+                self.print_stats()
+
+    def write_error(self, frame, error):
+        """Write the error record of a frame which failed, and log it"""
+        with self.write_lock:
+            print('Frame {}: {!r}'.format(frame.frame_id, error), file=self.stats_stream)
+            self.out_stream.write(json.dumps({'frame_id': frame.frame_id, 'error': repr(error)}) + '\n')
+            self.out_stream.flush()
+            self.num_errors += 1
+
+    def print_stats(self):
+        print('Frames: {}, dropped: {}, errors: {}'.format(self.num_frames, self.num_dropped, self.num_errors),
+              file=self.stats_stream)
+        for name in STAGES:
+            print('\t{}'.format(self.histograms[name]), file=self.stats_stream)
+
+
+def watch_directory(detector, watch_dir, poll_interval=0.05, settle_time=0.1):
+    """Feed the scans written into watch_dir, in file name order. A file is read once it has not been modified for
+    settle_time seconds, so partially written files are skipped"""
+    seen = set()
+    while True:
+        now = time.time()
+        for fn in sorted(os.listdir(watch_dir)):
+            if (fn in seen) or (not fn.endswith(('.ply', '.bin', '.npy'))):
+                continue
+            path = os.path.join(watch_dir, fn)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if now - mtime < settle_time:
+                continue
+            seen.add(fn)
+            frame_id = os.path.splitext(fn)[0]
+            try:
+                points = read_points_file(path)
+            except (ValueError, OSError) as e:
+                detector.write_error(Frame(frame_id, None), e)
+                continue
+            detector.submit(frame_id, points)
+        time.sleep(poll_interval)
+
+
+def recv_exactly(conn, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def send_frame(conn, frame_id, points):
+    """Client side of serve_socket(): send one (N, 4) scan"""
+    payload = io.BytesIO()
+    np.save(payload, np.ascontiguousarray(points), allow_pickle=False)
+    frame_id = str(frame_id).encode('utf-8')
+    conn.sendall(HEADER.pack(len(frame_id), payload.getbuffer().nbytes) + frame_id + payload.getvalue())
+
+
+def serve_socket(detector, host, port):
+    """Feed the scans received over TCP, one client at a time. A message is the HEADER, the utf-8 frame id and the
+    scan saved in the .npy format (see send_frame())"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    print('Listening on {}:{}'.format(host, port), file=sys.stderr)
+    while True:
+        conn, addr = server.accept()
+        with conn:
+            while True:
+                header = recv_exactly(conn, HEADER.size)
+                if header is None:
+                    break
+                id_len, payload_len = HEADER.unpack(header)
+                frame_id = recv_exactly(conn, id_len)
+                payload = recv_exactly(conn, payload_len)
+                if (frame_id is None) or (payload is None):
+                    break
+                frame_id = frame_id.decode('utf-8', errors='replace')
+                try:
+                    points = np.load(io.BytesIO(payload), allow_pickle=False)
+                except (ValueError, EOFError, OSError) as e:
+                    detector.write_error(Frame(frame_id, None), e)
+                    continue
+                detector.submit(frame_id, points)
+
+
+def parse_stream_configs():
+    parser = argparse.ArgumentParser(description='Streaming inference of Complex YOLO on live point-cloud frames')
+    parser.add_argument('-a', '--arch', type=str, default='darknet', metavar='ARCH',
+                        help='The name of the model architecture')
+    parser.add_argument('--cfgfile', type=str, default='./config/cfg/complex_yolov4.cfg', metavar='PATH',
+                        help='The path for cfgfile (only for darknet)')
+    parser.add_argument('--pretrained_path', type=str, default=None, metavar='PATH',
+                        help='the path of the pretrained checkpoint')
+    parser.add_argument('--use_giou_loss', action='store_true',
+                        help='If true, use GIoU loss during training. If false, use MSE loss for training')
+
+    parser.add_argument('--no_cuda', action='store_true',
+                        help='If true, cuda is not used.')
+    parser.add_argument('--gpu_idx', default=None, type=int,
+                        help='GPU index to use.')
+
+    parser.add_argument('--watch_dir', type=str, default=None, metavar='PATH',
+                        help='Read the scans (.ply, .bin or .npy) written into this directory')
+    parser.add_argument('--listen', type=str, default=None, metavar='HOST:PORT',
+                        help='Read the scans sent over TCP to this address (see send_frame())')
+    parser.add_argument('--output', type=str, default=None, metavar='PATH',
+                        help='The JSON lines file of the detections, default: stdout')
+
+    parser.add_argument('--queue_size', type=int, default=2,
+                        help='The capacity of the queues between the stages')
+    parser.add_argument('--max_batch_size', type=int, default=1,
+                        help='The max number of rasterized frames forwarded together')
+    parser.add_argument('--drop_frames', action='store_true',
+                        help='If true, drop the incoming frames while the pipeline is full instead of waiting')
+    parser.add_argument('--stats_freq', type=int, default=100,
+                        help='Print the latency histograms every N frames (0: only at exit)')
+
+    parser.add_argument('--conf_thresh', type=float, default=0.5,
+                        help='the threshold for conf')
+    parser.add_argument('--nms_thresh', type=float, default=0.5,
+                        help='the threshold for nms')
+
+    configs = edict(vars(parser.parse_args()))
+    configs.pin_memory = True
+
+    return configs
+
+
+if __name__ == '__main__':
+    configs = parse_stream_configs()
+    assert (configs.watch_dir is None) != (configs.listen is None), 'Set one of --watch_dir and --listen'
+
+    model = create_model(configs)
+    assert os.path.isfile(configs.pretrained_path), "No file at {}".format(configs.pretrained_path)
+    load_model_weights(model, configs.pretrained_path)
+
+    if configs.no_cuda:
+        configs.device = torch.device('cpu')
+    else:
+        configs.device = torch.device('cuda' if configs.gpu_idx is None else 'cuda:{}'.format(configs.gpu_idx))
+    model = model.to(device=configs.device)
+    model.eval()
+
+    out_stream = sys.stdout if configs.output is None else open(configs.output, 'a')
+    detector = StreamingDetector(model, configs, out_stream=out_stream)
+    try:
+        if configs.watch_dir is not None:
+            watch_directory(detector, configs.watch_dir)
+        else:
+            host, port = configs.listen.rsplit(':', 1)
+            serve_socket(detector, host, int(port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        detector.close()
+        detector.print_stats()
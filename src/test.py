@@ -23,10 +23,11 @@ sys.path.append('../')
 import config.kitti_config as cnf
 from data_process import kitti_data_utils, kitti_bev_utils
 from data_process.kitti_dataloader import create_test_dataloader
-from models.model_utils import create_model
+from models.model_utils import load_inference_model
 from utils.misc import make_folder
 from utils.evaluation_utils import post_processing, rescale_boxes, post_processing_v2
 from utils.misc import time_synchronized
+from utils.torch_utils import prepare_bev_input
 from utils.visualization_utils import show_image_with_boxes, merge_rgb_to_bev, predictions_to_kitti_format
 
 
@@ -42,6 +43,8 @@ def parse_test_configs():
                         help='the path of the pretrained checkpoint')
     parser.add_argument('--use_giou_loss', action='store_true',
                         help='If true, use GIoU loss during training. If false, use MSE loss for training')
+    parser.add_argument('--jit_cache_dir', type=str, default=None, metavar='PATH',
+                        help='If set, cache the traced model in this directory, later runs skip building the model')
 
     parser.add_argument('--no_cuda', action='store_true',
                         help='If true, cuda is not used.')
@@ -52,6 +55,19 @@ def parse_test_configs():
                         help='the size of input image')
     parser.add_argument('--num_samples', type=int, default=None,
                         help='Take a subset of the dataset to run and debug')
+    parser.add_argument('--voxel_downsample', action='store_true',
+                        help='If true, merge the points of every BEV voxel before the rasterization (same BEV maps)')
+    parser.add_argument('--bev_store_dir', type=str, default=None, metavar='PATH',
+                        help='If set, the BEV maps are built once into a memory-mapped store in this directory, '
+                             'shared by the processes of the host (see data_process/bev_store.py)')
+    parser.add_argument('--bev_store_dtype', type=str, default='uint8', choices=['uint8', 'float16'],
+                        help='The dtype of the stored BEV maps')
+    parser.add_argument('--bev_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='The dtype of the BEV maps between the dataloader workers and the device, they are '
+                             'converted to float on the device (uint8: 1/255 steps)')
+    parser.add_argument('--sparse_bev', action='store_true',
+                        help='If true, only the occupied cells of the BEV maps (and their features) go through the '
+                             'dataloader, the maps are densified on the device (for mostly empty grids)')
     parser.add_argument('--num_workers', type=int, default=1,
                         help='Number of threads for loading data')
     parser.add_argument('--batch_size', type=int, default=1,
@@ -91,23 +107,20 @@ if __name__ == '__main__':
     configs = parse_test_configs()
     configs.distributed = False  # For testing
 
-    model = create_model(configs)
-    model.print_network()
-    print('\n\n' + '-*=' * 30 + '\n\n')
     assert os.path.isfile(configs.pretrained_path), "No file at {}".format(configs.pretrained_path)
-    model.load_state_dict(torch.load(configs.pretrained_path))
-
     configs.device = torch.device('cpu' if configs.no_cuda else 'cuda:{}'.format(configs.gpu_idx))
-    model = model.to(device=configs.device)
+    model = load_inference_model(configs)
+    if hasattr(model, 'print_network'):
+        # not available on a traced model
+        model.print_network()
+    print('\n\n' + '-*=' * 30 + '\n\n')
 
     out_cap = None
 
-    model.eval()
-
     test_dataloader = create_test_dataloader(configs)
     with torch.no_grad():
         for batch_idx, (img_paths, imgs_bev) in enumerate(test_dataloader):
-            input_imgs = imgs_bev.to(device=configs.device).float()
+            input_imgs = prepare_bev_input(imgs_bev, configs.device)
             t1 = time_synchronized()
             outputs = model(input_imgs)
             t2 = time_synchronized()
@@ -116,7 +129,7 @@ if __name__ == '__main__':
             img_detections = []  # Stores detections for each image index
             img_detections.extend(detections)
 
-            img_bev = imgs_bev.squeeze() * 255
+            img_bev = prepare_bev_input(imgs_bev, torch.device('cpu')).squeeze() * 255
             img_bev = img_bev.permute(1, 2, 0).numpy().astype(np.uint8)
             img_bev = cv2.resize(img_bev, (configs.img_size, configs.img_size))
             for detections in img_detections:
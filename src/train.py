@@ -4,6 +4,7 @@ import sys
 import random
 import os
 import warnings
+import contextlib
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -16,12 +17,16 @@ from tqdm import tqdm
 
 sys.path.append('./')
 
-from data_process.kitti_dataloader import create_train_dataloader, create_val_dataloader
-from models.model_utils import create_model, make_data_parallel, get_num_parameters
-from utils.train_utils import create_optimizer, create_lr_scheduler, get_saved_state, save_checkpoint
-from utils.train_utils import reduce_tensor, to_python_float, get_tensorboard_log
+from data_process.kitti_dataloader import create_train_dataloader, create_val_dataloader, create_train_batch_transforms
+from models.model_utils import create_model, make_data_parallel, get_num_parameters, load_checkpoint, load_model_weights
+from models.darknet_prune import add_bn_sparsity_grad
+from utils.train_utils import create_optimizer, create_lr_scheduler, get_saved_state, CheckpointSaver
+from utils.train_utils import load_training_state, set_rng_state, ModelEMA, EarlyStopping
+from utils.train_utils import reduce_tensor, to_python_float, get_tensorboard_log, iterate_with_last
 from utils.misc import AverageMeter, ProgressMeter
 from utils.logger import Logger
+from utils import profiling
+from utils.torch_utils import prepare_bev_input
 from config.train_config import parse_train_configs
 from evaluate import evaluate_mAP
 
@@ -53,8 +58,13 @@ def main():
 
 
 def main_worker(gpu_idx, configs):
-    configs.gpu_idx = gpu_idx
+    # On cpu, gpu_idx is the index of the process on its node
+    local_rank = gpu_idx
+    configs.gpu_idx = None if configs.no_cuda else gpu_idx
     configs.device = torch.device('cpu' if configs.gpu_idx is None else 'cuda:{}'.format(configs.gpu_idx))
+    if configs.num_threads is not None:
+        # Without a limit, every process of the node would start one thread per core
+        torch.set_num_threads(configs.num_threads)
 
     if configs.distributed:
         if configs.dist_url == "env://" and configs.rank == -1:
@@ -62,13 +72,10 @@ def main_worker(gpu_idx, configs):
         if configs.multiprocessing_distributed:
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
-            configs.rank = configs.rank * configs.ngpus_per_node + gpu_idx
+            configs.rank = configs.rank * configs.ngpus_per_node + local_rank
 
         dist.init_process_group(backend=configs.dist_backend, init_method=configs.dist_url,
                                 world_size=configs.world_size, rank=configs.rank)
-        configs.subdivisions = int(64 / configs.batch_size / configs.ngpus_per_node)
-    else:
-        configs.subdivisions = int(64 / configs.batch_size)
 
     configs.is_master_node = (not configs.distributed) or (
             configs.distributed and (configs.rank % configs.ngpus_per_node == 0))
@@ -82,41 +89,75 @@ def main_worker(gpu_idx, configs):
         logger = None
         tb_writer = None
 
+    if configs.profile:
+        profile_dir = os.path.join(configs.logs_dir, 'profile', 'rank{}'.format(max(configs.rank, 0)))
+        if os.path.isdir(profile_dir):
+            # The spans of a previous run
+            for fn in os.listdir(profile_dir):
+                os.remove(os.path.join(profile_dir, fn))
+        profiling.enable(profile_dir, trace=configs.profile_trace, sync_cuda=configs.profile_sync_cuda)
+
     # Add model the model to the device (caused a problem when running the trainning process with original model)
     model = create_model(configs).to(configs.device)
 
     # load weight from a checkpoint
     if configs.pretrained_path is not None:
         assert os.path.isfile(configs.pretrained_path), "=> no checkpoint found at '{}'".format(configs.pretrained_path)
-        model.load_state_dict(torch.load(configs.pretrained_path))
+        load_model_weights(model, configs.pretrained_path)
         if logger is not None:
             logger.info('loaded pretrained model at {}'.format(configs.pretrained_path))
 
     # resume weights of model from a checkpoint
+    resume_state = None
     if configs.resume_path is not None:
         assert os.path.isfile(configs.resume_path), "=> no checkpoint found at '{}'".format(configs.resume_path)
-        model.load_state_dict(torch.load(configs.resume_path))
+        resume_state = load_training_state(load_checkpoint(configs.resume_path), configs.resume_path)
+        model.load_state_dict(resume_state.get('raw_model', resume_state['model']))
         if logger is not None:
             logger.info('resume training model from checkpoint {}'.format(configs.resume_path))
 
     # Data Parallel
+    model = make_data_parallel(model, configs)
 
+    # configs.batch_size is now the batch of one process: accumulate the gradients of `subdivisions` micro-batches
+    # per optimizer step to reach the effective batch size over all the processes
+    num_processes = configs.world_size if configs.distributed else 1
+    configs.subdivisions = max(1, int(round(configs.accumulate_batch_size / (configs.batch_size * num_processes))))
+    if logger is not None:
+        logger.info('effective batch size: {} x {} micro-batches x {} processes'.format(
+            configs.batch_size, configs.subdivisions, num_processes))
 
-    model = make_data_parallel(model, configs)
-    
     # Make sure to create optimizer after moving the model to cuda
     optimizer = create_optimizer(configs, model)
     lr_scheduler = create_lr_scheduler(optimizer, configs)
     configs.step_lr_in_epoch = True if configs.lr_type in ['multi_step'] else False
 
-    # resume optimizer, lr_scheduler from a checkpoint
-    if configs.resume_path is not None:
-        utils_path = configs.resume_path.replace('Model_', 'Utils_')
-        assert os.path.isfile(utils_path), "=> no checkpoint found at '{}'".format(utils_path)
-        utils_state_dict = torch.load(utils_path, map_location='cuda:{}'.format(configs.gpu_idx))
-        optimizer.load_state_dict(utils_state_dict['optimizer'])
-        lr_scheduler.load_state_dict(utils_state_dict['lr_scheduler'])
-        configs.start_epoch = utils_state_dict['epoch'] + 1
+    # The EMA of the weights is evaluated and checkpointed instead of the raw weights
+    ema = None
+    if configs.ema:
+        ema = ModelEMA(model, decay=configs.ema_decay, tau=configs.ema_tau)
+
+    # The number of optimizer steps so far, the x axis of the training logs
+    global_step = 0
+    early_stopping = EarlyStopping(configs.early_stop_patience, min_delta=configs.early_stop_min_delta)
+    # resume optimizer, lr_scheduler, EMA, the early stopping and the random generators from a checkpoint
+    if resume_state is not None:
+        assert 'optimizer' in resume_state, "=> no optimizer state found for '{}'".format(configs.resume_path)
+        optimizer.load_state_dict(resume_state['optimizer'])
+        lr_scheduler.load_state_dict(resume_state['lr_scheduler'])
+        configs.start_epoch = resume_state['epoch'] + 1
+        global_step = resume_state.get('global_step', 0)
+        early_stopping.history = list(resume_state.get('early_stopping_history', []))
+        if (ema is not None) and ('ema_updates' in resume_state):
+            ema.load_state_dict(resume_state['model'], resume_state['ema_updates'])
+        if 'rng' in resume_state:
+            set_rng_state(resume_state['rng'])
+        del resume_state
+
+    checkpoint_saver = None
+    if configs.is_master_node:
+        checkpoint_saver = CheckpointSaver(configs.checkpoints_dir, configs.saved_fn,
+                                           keep_last=configs.keep_last_checkpoints, logger=logger)
 
     if configs.is_master_node:
         num_parameters = get_num_parameters(model)
@@ -126,17 +167,30 @@ def main_worker(gpu_idx, configs):
         logger.info(">>> Loading dataset & getting dataloader...")
     # Create dataloader
     train_dataloader, train_sampler = create_train_dataloader(configs)
+    batch_transforms = create_train_batch_transforms(configs)
     if logger is not None:
         logger.info('number of batches in training set: {}'.format(len(train_dataloader)))
 
     if configs.evaluate:
         val_dataloader = create_val_dataloader(configs)
-        precision, recall, AP, f1, ap_class = evaluate_mAP(val_dataloader, model, configs, None)
+        eval_model = model if ema is None else ema.ema
+        precision, recall, AP, f1, ap_class = evaluate_mAP(val_dataloader, eval_model, configs, None)
         print('Evaluate - precision: {}, recall: {}, AP: {}, f1: {}, ap_class: {}'.format(precision, recall, AP, f1,
                                                                                           ap_class))
         print('mAP {}'.format(AP.mean()))
         return
 
+    # The val dataloaders are built once: the full val set, and the fixed subset of the proxy validation
+    val_dataloader, proxy_val_dataloader = None, None
+    if not configs.no_val:
+        val_dataloader = create_val_dataloader(configs)
+        if logger is not None:
+            logger.info('number of batches in val_dataloader: {}'.format(len(val_dataloader)))
+        if (configs.proxy_val_samples > 0) and (configs.val_freq > 1):
+            proxy_val_dataloader = create_val_dataloader(configs, subset_size=configs.proxy_val_samples)
+            if logger is not None:
+                logger.info('number of batches in proxy val_dataloader: {}'.format(len(proxy_val_dataloader)))
+
     for epoch in range(configs.start_epoch, configs.num_epochs + 1):
         if logger is not None:
             logger.info('{}'.format('*-' * 40))
@@ -144,14 +198,19 @@ def main_worker(gpu_idx, configs):
             logger.info('{}'.format('*-' * 40))
             logger.info('>>> Epoch: [{}/{}]'.format(epoch, configs.num_epochs))
 
-        if configs.distributed:
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
+        train_dataloader.dataset.set_epoch(epoch)
         # train for one epoch
-        train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, configs, logger, tb_writer)
-        if not configs.no_val:
-            val_dataloader = create_val_dataloader(configs)
-            print('number of batches in val_dataloader: {}'.format(len(val_dataloader)))
-            precision, recall, AP, f1, ap_class = evaluate_mAP(val_dataloader, model, configs, logger)
+        global_step = train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, configs, logger,
+                                      tb_writer, batch_transforms, ema, global_step=global_step)
+        # mAP of the full validation, the only one used for the best checkpoint and the early stopping
+        mAP = None
+        eval_model = model if ema is None else ema.ema
+        full_val = (val_dataloader is not None) and (((epoch % configs.val_freq) == 0) or
+                                                     (epoch == configs.num_epochs))
+        if full_val:
+            precision, recall, AP, f1, ap_class = evaluate_mAP(val_dataloader, eval_model, configs, logger)
             val_metrics_dict = {
                 'precision': precision.mean(),
                 'recall': recall.mean(),
@@ -159,19 +218,48 @@ def main_worker(gpu_idx, configs):
                 'f1': f1.mean(),
                 'ap_class': ap_class.mean()
             }
+            mAP = float(AP.mean())
             if tb_writer is not None:
                 tb_writer.add_scalars('Validation', val_metrics_dict, epoch)
+        elif proxy_val_dataloader is not None:
+            _, _, proxy_AP, _, _ = evaluate_mAP(proxy_val_dataloader, eval_model, configs, logger)
+            if logger is not None:
+                logger.info('proxy validation mAP: {:.4f}'.format(proxy_AP.mean()))
+            if tb_writer is not None:
+                tb_writer.add_scalar('Validation_proxy_mAP', proxy_AP.mean(), epoch)
 
-        # Save checkpoint
-        if configs.is_master_node and ((epoch % configs.checkpoint_freq) == 0):
-            model_state_dict, utils_state_dict = get_saved_state(model, optimizer, lr_scheduler, epoch, configs)
-            save_checkpoint(configs.checkpoints_dir, configs.saved_fn, model_state_dict, utils_state_dict, epoch)
+        # evaluate_mAP returns the same mAP on all the ranks, they stop together. Recorded before the checkpoint, which
+        # holds the history of the early stopping
+        stop = (mAP is not None) and early_stopping.step(mAP)
+
+        # Save checkpoint, also when the mAP is the best so far (kept by the retention)
+        if checkpoint_saver is not None:
+            best = checkpoint_saver.get_best()
+            is_best = (mAP is not None) and ((best is None) or (mAP > best['mAP']))
+            if ((epoch % configs.checkpoint_freq) == 0) or is_best:
+                checkpoint_saver.save(get_saved_state(model, optimizer, lr_scheduler, epoch, configs, mAP=mAP,
+                                                      ema=ema, global_step=global_step,
+                                                      early_stopping=early_stopping))
 
         if not configs.step_lr_in_epoch:
             lr_scheduler.step()
             if tb_writer is not None:
                 tb_writer.add_scalar('LR', lr_scheduler.get_lr()[0], epoch)
 
+        if configs.profile:
+            profiling.report(logger, tb_writer, epoch)
+
+        if stop:
+            if logger is not None:
+                logger.info('Early stopping at epoch {}: the mAP did not improve by more than {} over the last '
+                            '{} full validations'.format(epoch, configs.early_stop_min_delta,
+                                                         configs.early_stop_patience))
+            break
+
+    if checkpoint_saver is not None:
+        checkpoint_saver.close()
+    if configs.profile and configs.profile_trace:
+        profiling.export_chrome_trace(os.path.join(profile_dir, 'trace.json'))
     if tb_writer is not None:
         tb_writer.close()
     if configs.distributed:
@@ -182,7 +270,9 @@ def cleanup():
     dist.destroy_process_group()
 
 
-def train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, configs, logger, tb_writer):
+def train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, configs, logger, tb_writer,
+                    batch_transforms, ema=None, global_step=0):
+    """Train for one epoch, returns the number of optimizer steps since the start of the training"""
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
@@ -190,30 +280,60 @@ def train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, con
     progress = ProgressMeter(len(train_dataloader), [batch_time, data_time, losses],
                              prefix="Train - Epoch: [{}/{}]".format(epoch, configs.num_epochs))
 
-    num_iters_per_epoch = len(train_dataloader)
+    rank = max(configs.rank, 0) if configs.distributed else 0
+
+    torch_profiler = None
+    if (configs.profile_torch_steps > 0) and (epoch == configs.start_epoch):
+        torch_profiler = profiling.TorchProfilerSteps(
+            configs.profile_torch_steps, os.path.join(configs.logs_dir, 'torch_trace_rank{}.json'.format(rank)),
+            use_cuda=(configs.device.type == 'cuda'), logger=logger)
+
+    # The gradients accumulated since the last optimizer step, the last step of the epoch may have fewer micro-batches
+    accumulated_loss, num_accumulated, num_accumulated_samples = 0., 0, 0
 
     # switch to train mode
     model.train()
     start_time = time.time()
-    for batch_idx, batch_data in enumerate(tqdm(train_dataloader)):
+    # The last batch is known one batch ahead: the len() of an iterable dataloader is not its number of batches
+    for batch_idx, (batch_data, is_last_batch) in enumerate(iterate_with_last(tqdm(train_dataloader))):
         data_time.update(time.time() - start_time)
         _, imgs, targets = batch_data
-        global_step = num_iters_per_epoch * (epoch - 1) + batch_idx + 1
 
         batch_size = imgs.size(0)
 
         targets = targets.to(configs.device, non_blocking=True)
-        imgs = imgs.to(configs.device, non_blocking=True)
-        total_loss, outputs = model(imgs, targets)
-
-        # For torch.nn.DataParallel case
-        if (not configs.distributed) and (configs.gpu_idx is None):
-            total_loss = torch.mean(total_loss)
-
-        # compute gradient and perform backpropagation
-        total_loss.backward()
-        if global_step % configs.subdivisions == 0:
-            optimizer.step()
+        imgs = prepare_bev_input(imgs, configs.device)
+        if batch_transforms is not None:
+            # Keyed like the per-sample augmentations so that the batch stream is reproducible as well
+            batch_rng = np.random if configs.seed is None else np.random.RandomState([configs.seed, epoch, rank,
+                                                                                      batch_idx])
+            imgs, targets = batch_transforms(imgs, targets, rng=batch_rng, epoch=epoch, batch_idx=batch_idx)
+
+        is_step = (((batch_idx + 1) % configs.subdivisions) == 0) or is_last_batch
+        # DDP all-reduces the gradients in the backward pass: only for the last micro-batch of an optimizer step
+        sync_context = model.no_sync() if (configs.distributed and not is_step) else contextlib.nullcontext()
+        with sync_context:
+            with profiling.span('train_forward'):
+                total_loss, outputs = model(imgs, targets)
+
+            # For torch.nn.DataParallel case
+            if (not configs.distributed) and (configs.gpu_idx is None):
+                total_loss = torch.mean(total_loss)
+
+            # compute gradient and perform backpropagation
+            with profiling.span('train_backward'):
+                total_loss.backward()
+        if configs.bn_sparsity > 0:
+            add_bn_sparsity_grad(model, configs.bn_sparsity)
+        accumulated_loss += total_loss.detach()
+        num_accumulated += 1
+        num_accumulated_samples += batch_size
+        if is_step:
+            global_step += 1
+            with profiling.span('optimizer_step'):
+                optimizer.step()
+            if ema is not None:
+                ema.update()
             # Adjust learning rate
             if configs.step_lr_in_epoch:
                 lr_scheduler.step()
@@ -222,16 +342,17 @@ def train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, con
             # zero the parameter gradients
             optimizer.zero_grad()
 
-        if configs.distributed:
-            reduced_loss = reduce_tensor(total_loss.data, configs.world_size)
-        else:
-            reduced_loss = total_loss.data
-        losses.update(to_python_float(reduced_loss), batch_size)
+            # The loss is also reduced once per optimizer step
+            mean_loss = accumulated_loss / num_accumulated
+            if configs.distributed:
+                mean_loss = reduce_tensor(mean_loss, configs.world_size)
+            losses.update(to_python_float(mean_loss), num_accumulated_samples)
+            accumulated_loss, num_accumulated, num_accumulated_samples = 0., 0, 0
         # measure elapsed time
         # torch.cuda.synchronize()
         batch_time.update(time.time() - start_time)
 
-        if tb_writer is not None:
+        if (tb_writer is not None) and is_step:
             if (global_step % configs.tensorboard_freq) == 0:
                 tensorboard_log = get_tensorboard_log(model)
                 tb_writer.add_scalar('avg_loss', losses.avg, global_step)
@@ -239,12 +360,19 @@ def train_one_epoch(train_dataloader, model, optimizer, lr_scheduler, epoch, con
                     tb_writer.add_scalars(layer_name, layer_dict, global_step)
 
         # Log message
-        if logger is not None:
+        if (logger is not None) and is_step:
             if (global_step % configs.print_freq) == 0:
                 logger.info(progress.get_message(batch_idx))
 
+        if torch_profiler is not None:
+            torch_profiler.step()
         start_time = time.time()
 
+    if torch_profiler is not None:
+        torch_profiler.stop()
+
+    return global_step
+
 
 if __name__ == '__main__':
     try:
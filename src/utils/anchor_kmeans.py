@@ -0,0 +1,259 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Clustering of the rotated BEV boxes into anchors, with an IoU distance computed as a matrix
+
+The boxes and the anchors are (w, l, yaw) rectangles centered on the origin, as in utils/find_anchors.py. The IoU of
+every (box, anchor) pair is computed at once with fixed-size arrays: by Green's theorem, the intersection area is
+swept by the parts of the edges of each rectangle inside the other one, and every edge is clipped by the 4 half-planes
+of the other rectangle (Cyrus-Beck). When all the boxes and anchors have yaw = 0, the intersection is simply
+min(w) x min(l).
+
+The identical boxes are merged (with a weight), the clustering (k-medians by default, like the former
+Find_Anchors.kmeans(), or k-means) starts from a k-means++ seeding with the 1 - IoU distance, and the restarts run in
+parallel threads (numpy releases the GIL in the array operations).
+-----------------------------------------------------------------------------------
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Relative tolerance of the parallel edges test
+PARALLEL_TOL = 1e-9
+# The number of (box, anchor) pairs processed at once, bounds the memory of the clipping arrays
+CHUNK_PAIRS = 2 ** 16
+
+
+def get_corners_batch(boxes):
+    """Return the (N, 4, 2) corners of the (w, l, yaw) boxes centered on the origin, in the order of
+    kitti_bev_utils.get_corners() (counter-clockwise)"""
+    w, l, yaw = boxes[:, 0:1], boxes[:, 1:2], boxes[:, 2:3]
+    cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+    dx = np.array([[-0.5, -0.5, 0.5, 0.5]]) * w
+    dy = np.array([[0.5, -0.5, -0.5, 0.5]]) * l
+    return np.stack([dx * cos_yaw - dy * sin_yaw, dx * sin_yaw + dy * cos_yaw], axis=2)
+
+
+def cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def inside_edges_area(p, q, strict):
+    """Twice the area swept (from the origin) by the parts of the first two edges of the polygons p inside the polygons q
+
+    :param p, q: (M, 4, 2) counter-clockwise corners of boxes centered on the origin
+    :param strict: if true, an edge of p lying on an edge of q is outside, so that it is only counted once over the
+        two calls of intersection_areas()
+    """
+    # The boxes are centrally symmetric: edges 2 and 3 are edges 0 and 1 mirrored, with the same contribution
+    p_starts = p[:, :2]
+    p_dirs = p[:, 1:3] - p_starts
+    q_dirs = np.roll(q, -1, axis=1) - q
+    # [pair, edge of p, edge of q]: the side of q edge (> 0 inside) along the p edge is sides + t * slopes, t in [0, 1]
+    sides = cross(q_dirs[:, None], p_starts[:, :, None] - q[:, None])
+    slopes = cross(q_dirs[:, None], p_dirs[:, :, None])
+    tolerances = PARALLEL_TOL * np.sqrt((q_dirs ** 2).sum(axis=-1))[:, None, :] * \
+                 np.sqrt((p_dirs ** 2).sum(axis=-1))[:, :, None]
+    parallel = np.abs(slopes) <= tolerances
+    t = -sides / np.where(parallel, 1., slopes)
+    t_start = np.where(slopes > tolerances, t, 0.).max(axis=2).clip(0., None)
+    t_end = np.where(slopes < -tolerances, t, 1.).min(axis=2).clip(None, 1.)
+    outside = (sides <= tolerances) if strict else (sides < -tolerances)
+    excluded = (parallel & outside).any(axis=2) | (t_end <= t_start)
+    segment_starts = p_starts + t_start[..., None] * p_dirs
+    segment_ends = p_starts + t_end[..., None] * p_dirs
+    return 2. * np.where(excluded, 0., cross(segment_starts, segment_ends)).sum(axis=1)
+
+
+def intersection_areas(p, q):
+    """Intersection areas of the pairs of convex boxes centered on the origin (Green's theorem: the boundary of the
+    intersection is made of the parts of the edges of each box inside the other one)"""
+    return 0.5 * (inside_edges_area(p, q, strict=False) + inside_edges_area(q, p, strict=True))
+
+
+def rotated_iou_matrix(boxes, anchors):
+    """Return the (N, K) IoU of the (w, l, yaw) boxes and anchors, all centered on the origin"""
+    box_areas = boxes[:, 0] * boxes[:, 1]
+    anchor_areas = anchors[:, 0] * anchors[:, 1]
+    if (not np.any(boxes[:, 2])) and (not np.any(anchors[:, 2])):
+        intersections = np.minimum(boxes[:, None, 0], anchors[None, :, 0]) * \
+                        np.minimum(boxes[:, None, 1], anchors[None, :, 1])
+        return intersections / (box_areas[:, None] + anchor_areas[None, :] - intersections + 1e-12)
+
+    num_boxes, num_anchors = len(boxes), len(anchors)
+    box_corners = get_corners_batch(boxes)
+    anchor_corners = get_corners_batch(anchors)
+    ious = np.empty((num_boxes, num_anchors), dtype=np.float64)
+    chunk_size = max(1, CHUNK_PAIRS // num_anchors)
+    for start in range(0, num_boxes, chunk_size):
+        end = min(start + chunk_size, num_boxes)
+        intersections = intersection_areas(np.repeat(box_corners[start:end], num_anchors, axis=0),
+                                           np.tile(anchor_corners, (end - start, 1, 1)))
+        intersections = intersections.reshape(end - start, num_anchors)
+        ious[start:end] = intersections / (box_areas[start:end, None] + anchor_areas[None, :] - intersections + 1e-12)
+
+    return ious
+
+
+def merge_duplicate_boxes(boxes, yaw_decimals=2, fold_yaw=False):
+    """Return the unique boxes (the yaws rounded to yaw_decimals) and their number of occurrences as weights
+    :param fold_yaw: map the yaws to [0, pi/2], the IoU with axis-aligned anchors does not change under a half turn
+        (yaw + pi) or a mirror (-yaw) of the box
+    """
+    rounded = boxes.astype(np.float64).copy()
+    if fold_yaw:
+        yaws = np.mod(rounded[:, 2], np.pi)
+        rounded[:, 2] = np.minimum(yaws, np.pi - yaws)
+    rounded[:, 2] = np.round(rounded[:, 2], yaw_decimals)
+    unique_boxes, weights = np.unique(rounded, axis=0, return_counts=True)
+    return unique_boxes, weights.astype(np.float64)
+
+
+def weighted_median(values, weights):
+    order = np.argsort(values)
+    cum_weights = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cum_weights, 0.5 * cum_weights[-1])]
+
+
+def init_anchors(boxes, weights, num_anchors, rng, anchor_yaw=0.):
+    """k-means++ seeding: every new anchor is drawn with a probability proportional to weight x (1 - best IoU) ** 2"""
+    anchors = np.zeros((num_anchors, 3))
+    anchors[:, 2] = anchor_yaw
+    anchors[0, :2] = boxes[rng.choice(len(boxes), p=weights / weights.sum()), :2]
+    best_ious = rotated_iou_matrix(boxes, anchors[:1])[:, 0]
+    for anchor_idx in range(1, num_anchors):
+        probs = weights * (1. - best_ious) ** 2
+        if probs.sum() <= 0:
+            probs = weights
+        anchors[anchor_idx, :2] = boxes[rng.choice(len(boxes), p=probs / probs.sum()), :2]
+        best_ious = np.maximum(best_ious, rotated_iou_matrix(boxes, anchors[anchor_idx:anchor_idx + 1])[:, 0])
+    return anchors
+
+
+def cluster_anchors(boxes, weights, num_anchors, method='median', max_iters=300, seed=0, anchor_yaw=0.):
+    """Cluster the weighted boxes into num_anchors anchors of yaw anchor_yaw with the 1 - IoU distance
+
+    :param method: 'median' (k-medians, robust to the outliers) or 'mean' (k-means)
+    :return: the (K, 3) anchors, the weighted average of the best IoU of every box, the number of iterations
+    """
+    rng = np.random.RandomState(seed)
+    anchors = init_anchors(boxes, weights, num_anchors, rng, anchor_yaw=anchor_yaw)
+    assignment = None
+    num_iters = 0
+    for num_iters in range(1, max_iters + 1):
+        ious = rotated_iou_matrix(boxes, anchors)
+        new_assignment = ious.argmax(axis=1)
+        if (assignment is not None) and (new_assignment == assignment).all():
+            break
+        assignment = new_assignment
+        for anchor_idx in range(num_anchors):
+            members = assignment == anchor_idx
+            if not members.any():
+                # Empty cluster: move it to the worst covered box
+                anchors[anchor_idx, :2] = boxes[np.argmin(ious.max(axis=1)), :2]
+                continue
+            for dim in range(2):
+                if method == 'median':
+                    anchors[anchor_idx, dim] = weighted_median(boxes[members, dim], weights[members])
+                else:
+                    anchors[anchor_idx, dim] = np.average(boxes[members, dim], weights=weights[members])
+
+    avg_iou = np.average(rotated_iou_matrix(boxes, anchors).max(axis=1), weights=weights)
+    return anchors, avg_iou, num_iters
+
+
+def find_anchors(boxes, num_anchors, num_restarts=8, num_threads=None, method='median', max_iters=300, seed=0,
+                 anchor_yaw=0., yaw_decimals=2):
+    """Cluster the (N, 3) (w, l, yaw) boxes with num_restarts differently seeded runs in parallel threads
+
+    :return: the anchors of the best run, rounded to integer sizes and sorted by area, and their average IoU
+    """
+    axis_aligned = np.isclose(np.mod(anchor_yaw + np.pi / 4, np.pi / 2), np.pi / 4)
+    unique_boxes, weights = merge_duplicate_boxes(boxes, yaw_decimals=yaw_decimals, fold_yaw=axis_aligned)
+    print('{} boxes, {} unique'.format(len(boxes), len(unique_boxes)))
+
+    def run(restart_idx):
+        return cluster_anchors(unique_boxes, weights, num_anchors, method=method, max_iters=max_iters,
+                               seed=seed + restart_idx, anchor_yaw=anchor_yaw)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(executor.map(run, range(num_restarts)))
+    for restart_idx, (_, avg_iou, num_iters) in enumerate(results):
+        print('restart {}: avg_iou {:.2f}% after {} iterations'.format(restart_idx, avg_iou * 100, num_iters))
+
+    anchors = max(results, key=lambda result: result[1])[0]
+    anchors[:, :2] = np.maximum(np.round(anchors[:, :2]), 1.)
+    anchors = anchors[np.argsort(anchors[:, 0] * anchors[:, 1], kind='stable')]
+    avg_iou = np.average(rotated_iou_matrix(unique_boxes, anchors).max(axis=1), weights=weights)
+
+    return anchors, avg_iou
+
+
+def format_anchors(anchors):
+    return ', '.join('{:g}, {:g}, {:g}'.format(w, l, yaw) for w, l, yaw in anchors)
+
+
+def write_anchors_to_cfg(cfgfile, anchors, output_cfgfile=None):
+    """Set the anchors of all the [yolo] sections of a cfg (the comments and the layout of the file are kept).
+    If the number of anchors changes, the masks split the anchors (sorted by area) evenly between the [yolo] sections:
+    the sections keep the order of their current masks (the fine stride heads have the smallest anchors, first in the
+    v4 cfgs and last in the v3 ones), and the filters of the [convolutional] layer before every [yolo] section
+    are set to (classes + 7) x its number of anchors.
+    """
+    with open(cfgfile, 'r') as f:
+        lines = f.read().split('\n')
+
+    yolo_sections = []
+    section = None
+    last_conv = None
+    for line_idx, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('['):
+            section = {} if stripped in ['[yolo]', '[convolutional]'] else None
+            if stripped == '[yolo]':
+                # the output of the preceding convolution is read by the yolo layer
+                section['conv'] = last_conv
+                yolo_sections.append(section)
+            elif stripped == '[convolutional]':
+                last_conv = section
+        elif (section is not None) and ('=' in stripped) and (not stripped.startswith('#')):
+            section[stripped.split('=')[0].strip()] = line_idx
+    if len(yolo_sections) == 0:
+        raise ValueError('No [yolo] section in {}'.format(cfgfile))
+
+    num_anchors = len(anchors)
+    num_sections = len(yolo_sections)
+
+    def current_mask_min(section_idx):
+        section = yolo_sections[section_idx]
+        if 'mask' not in section:
+            return float('inf'), section_idx
+        mask = [int(i) for i in lines[section['mask']].split('=')[1].split(',') if i.strip() != '']
+        return min(mask, default=float('inf')), section_idx
+
+    # The rank of every section in the anchor groups, from the smallest anchors
+    section_ranks = {section_idx: rank for rank, section_idx in
+                     enumerate(sorted(range(num_sections), key=current_mask_min))}
+    for section_idx, section in enumerate(yolo_sections):
+        lines[section['anchors']] = 'anchors = {}'.format(format_anchors(anchors))
+        old_num = int(lines[section['num']].split('=')[1]) if 'num' in section else None
+        if old_num != num_anchors:
+            if num_anchors % num_sections != 0:
+                raise ValueError('{} anchors can not be split between {} [yolo] sections'.format(num_anchors,
+                                                                                                num_sections))
+            per_section = num_anchors // num_sections
+            rank = section_ranks[section_idx]
+            mask = range(rank * per_section, (rank + 1) * per_section)
+            lines[section['mask']] = 'mask = {}'.format(','.join(str(i) for i in mask))
+            if 'num' in section:
+                lines[section['num']] = 'num={}'.format(num_anchors)
+            conv = section['conv']
+            if (conv is None) or ('filters' not in conv):
+                raise ValueError('No [convolutional] layer with filters before a [yolo] section of {}'.format(cfgfile))
+            num_classes = int(lines[section['classes']].split('=')[1])
+            lines[conv['filters']] = 'filters={}'.format((num_classes + 7) * per_section)
+
+    output_cfgfile = cfgfile if output_cfgfile is None else output_cfgfile
+    with open(output_cfgfile, 'w') as f:
+        f.write('\n'.join(lines))
@@ -4,11 +4,11 @@ import tqdm
 
 import torch
 import numpy as np
-from shapely.geometry import Polygon
 
 sys.path.append('../')
 
 import data_process.kitti_bev_utils as bev_utils
+from utils import profiling
 
 
 def cvt_box_2_polygon(box):
@@ -16,6 +16,8 @@ def cvt_box_2_polygon(box):
     :param box: an array of shape [4, 2]
     :return: a shapely.geometry.Polygon object
     """
+    from shapely.geometry import Polygon
+
     # use .buffer(0) to fix a line polygon
     # more infor: https://stackoverflow.com/questions/13062334/polygon-intersection-error-in-shapely-shapely-geos-topologicalerror-the-opera
     return Polygon([(box[i, 0], box[i, 1]) for i in range(len(box))]).buffer(0)
@@ -67,6 +69,7 @@ def rescale_boxes(boxes, current_dim, original_shape):
     return boxes
 
 
+@profiling.profiled('ap_per_class')
 def ap_per_class(tp, conf, pred_cls, target_cls):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
@@ -149,6 +152,7 @@ def compute_ap(recall, precision):
     return ap
 
 
+@profiling.profiled('batch_statistics')
 def get_batch_statistics_rotated_bbox(outputs, targets, iou_threshold):
     """ Compute true positives, predicted scores and predicted labels per sample """
     batch_metrics = []
@@ -247,6 +251,7 @@ def get_corners_vectorize(x, y, w, l, yaw):
     return bbox2
 
 
+@profiling.profiled('nms_cpu')
 def nms_cpu(boxes, confs, nms_thresh=0.5):
     """
     :param boxes: [num, 6]
@@ -276,6 +281,7 @@ def nms_cpu(boxes, confs, nms_thresh=0.5):
     return np.array(keep)
 
 
+@profiling.profiled('post_processing')
 def post_processing(outputs, conf_thresh=0.95, nms_thresh=0.4):
     """
         Removes detections with lower object confidence score than 'conf_thres' and performs
@@ -303,7 +309,7 @@ def post_processing(outputs, conf_thresh=0.95, nms_thresh=0.4):
     for i in range(batch_size):
         argwhere = max_conf[i] > conf_thresh
         l_box_array = box_array[i, argwhere, :]
-        l_obj_confs = obj_confs[i, argwhere, :]
+        l_obj_confs = obj_confs[i, argwhere]
         l_max_conf = max_conf[i, argwhere]
         l_max_id = max_id[i, argwhere]
 
@@ -318,6 +324,7 @@ def post_processing(outputs, conf_thresh=0.95, nms_thresh=0.4):
     return bboxes_batch
 
 
+@profiling.profiled('post_processing_v2')
 def post_processing_v2(prediction, conf_thresh=0.95, nms_thresh=0.4):
     """
         Removes detections with lower object confidence score than 'conf_thres' and performs
@@ -355,3 +362,25 @@ def post_processing_v2(prediction, conf_thresh=0.95, nms_thresh=0.4):
             output[image_i] = torch.stack(keep_boxes)
 
     return output
+
+
+def detections_to_dicts(detections, class_names):
+    """Convert the detections of an image (output of post_processing_v2) to JSON serializable dicts.
+    x, y, w, l are in pixels of the BEV map, yaw in radians
+    """
+    if detections is None:
+        return []
+    results = []
+    for x, y, w, l, im, re, conf, cls_conf, cls_pred in detections.tolist():
+        results.append({
+            'class': class_names[int(cls_pred)],
+            'cls_id': int(cls_pred),
+            'x': x,
+            'y': y,
+            'w': w,
+            'l': l,
+            'yaw': float(np.arctan2(im, re)),
+            'conf': conf,
+            'cls_conf': cls_conf,
+        })
+    return results
@@ -1,43 +1,49 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Find the anchors of the BEV boxes of a split
+
+The boxes are the targets the dataset trains on: the labels of the samples of KittiDataset (ply/labelCloud labels, or
+the label index of a packed dataset) go through the ratio variables of adjust_pointcloud(), which come from the
+metadata table of the scans (data_process/pcd_metadata.py). Only the scans which are new or changed since the last
+run are read, so finding the anchors again after a labelling round takes seconds.
+-----------------------------------------------------------------------------------
+"""
+
 import sys
-import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from shapely.geometry import Polygon
 
 sys.path.append('../')
 
-from data_process import transformation, kitti_bev_utils, kitti_data_utils
-import config.kitti_config as cnf
+from data_process import kitti_bev_utils
+from data_process.kitti_dataset import KittiDataset
+from utils import anchor_kmeans
 
 
 class Find_Anchors():
-    def __init__(self, dataset_dir, img_size, use_yaw_label=False):
-        self.dataset_dir = dataset_dir
+    def __init__(self, dataset_dir, img_size, mode='train', shards_dir=None, use_yaw_label=False, num_threads=None):
         self.img_size = img_size
         self.use_yaw_label = use_yaw_label
+        self.num_threads = num_threads
 
-        self.lidar_dir = os.path.join(self.dataset_dir, 'training', "velodyne")
-        self.image_dir = os.path.join(self.dataset_dir, 'training', "image_2")
-        self.calib_dir = os.path.join(self.dataset_dir, 'training', "calib")
-        self.label_dir = os.path.join(self.dataset_dir, 'training', "label_2")
-        split_txt_path = os.path.join(self.dataset_dir, 'ImageSets', 'trainval.txt')
-        self.image_idx_list = [x.strip() for x in open(split_txt_path).readlines()]
-
-        self.sample_id_list = self.remove_invalid_idx(self.image_idx_list)
+        # Same split, valid samples and labels as the training
+        self.dataset = KittiDataset(dataset_dir, mode=mode, shards_dir=shards_dir)
+        self.sample_id_list = self.dataset.sample_id_list
+        self.dataset.build_pcd_metadata(num_threads=num_threads)
         self.boxes_wh = self.load_full_boxes_wh()
         # Take out the total number of boxes
         self.num_boxes = self.boxes_wh.shape[0]
         print("number of sample_id_list: {}, num_boxes: {}".format(len(self.sample_id_list), self.num_boxes))
-        # Calculate the polygons and areas
-        self.boxes_conners = np.array([kitti_bev_utils.get_corners(0, 0, b[0], b[1], b[2]) for b in self.boxes_wh])
-        self.boxes_polygons = [self.cvt_box_2_polygon(b) for b in self.boxes_conners]
-        self.boxes_areas = [b.area for b in self.boxes_polygons]
-        print("Done calculate boxes infor")
 
     def load_full_boxes_wh(self):
+        # The label files are read in parallel threads (I/O bound)
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            targets_list = list(executor.map(self.load_targets, self.sample_id_list))
         boxes_wh = []
-        for sample_id in self.sample_id_list:
-            targets = self.load_targets(sample_id)
+        for targets in targets_list:
             for target in targets:
                 cls, x, y, w, l, im, re = target
                 if self.use_yaw_label:
@@ -45,140 +51,64 @@ class Find_Anchors():
                 else:
                     yaw = 0
                 boxes_wh.append([int(w * self.img_size), int(l * self.img_size), yaw])
-        return np.array(boxes_wh)
-
-    def cvt_box_2_polygon(self, box):
-        return Polygon([(box[i, 0], box[i, 1]) for i in range(4)])
-
-    def compute_iou(self, i):
-        box_polygon, box_area = self.boxes_polygons[i], self.boxes_areas[i]
-        intersections = [box_polygon.intersection(clus_polygon).area for clus_polygon in self.cluster_polygons]
-        iou = [inter / (box_area + area2 - inter + 1e-12) for (area2, inter) in zip(self.cluster_areas, intersections)]
-        # print('done compute_iou')
-        return np.array(iou, dtype=np.float32)
+        return np.array(boxes_wh, dtype=np.float64).reshape(-1, 3)
 
     def avg_iou(self):
-        return np.mean([np.max(self.compute_iou(i)) for i in range(self.num_boxes)])
-
-    def kmeans(self, num_anchors):
-        # The position of each point in each box
-        distance = np.empty((self.num_boxes, num_anchors))
-
-        # Last cluster position
-        last_clu = np.zeros((self.num_boxes,))
-
-        np.random.seed(0)
-
-        # Randomly select k cluster centers
-        self.cluster = self.boxes_wh[np.random.choice(self.num_boxes, num_anchors, replace=False)]
-        self.cluster[:, 2] = 0  # Choose yaw = 0
-
-        # cluster = random.sample(self.num_boxes, k)
-        self.loop_cnt = 0
-        while True:
-            self.loop_cnt += 1
+        return np.mean(anchor_kmeans.rotated_iou_matrix(self.boxes_wh, self.cluster).max(axis=1))
 
-            print('\nThe new cluster of count {} is below:\n'.format(self.loop_cnt))
-            for clus_ in self.cluster:
-                w_, h_, yaw_ = clus_
-                print('[{}, {}, {:.0f}],'.format(int(w_), int(h_), yaw_))
-
-            self.cluster_conners = np.array(
-                [kitti_bev_utils.get_corners(0, 0, clus[0], clus[1], clus[2]) for clus in self.cluster])
-            self.cluster_polygons = [self.cvt_box_2_polygon(clus) for clus in self.cluster_conners]
-            self.cluster_areas = [clus.area for clus in self.cluster_polygons]
-            # Calculate the iou situation at five points from each line.
-            for i in range(self.num_boxes):
-                distance[i] = 1 - self.compute_iou(i)
-
-            # Take out the smallest point
-            near = np.argmin(distance, axis=1)
-
-            if (last_clu == near).all():
-                break
-
-            # Find the median of each class
-            for j in range(num_anchors):
-                self.cluster[j] = np.median(self.boxes_wh[near == j], axis=0)
-            self.cluster[:, 2] = 0  # Choose yaw = 0
-
-            last_clu = near
+    def kmeans(self, num_anchors, num_restarts=8, method='median'):
+        """Cluster the boxes into num_anchors anchors (yaw = 0), the best of num_restarts runs in parallel threads"""
+        self.cluster, _ = anchor_kmeans.find_anchors(self.boxes_wh, num_anchors, num_restarts=num_restarts,
+                                                     num_threads=self.num_threads, method=method)
 
     def load_targets(self, sample_id):
-        """Load images and targets for the training and validation phase"""
-
-        objects = self.get_label(sample_id)
-        labels, noObjectLabels = kitti_bev_utils.read_labels_for_bevbox(objects)
+        """The targets of a sample as built by KittiDataset.load_targets(), without reading the scan"""
+        # The ratio variables of the sample come from the metadata table
+        objects = self.dataset.get_label(sample_id)
+        labels, noObjectLabels = kitti_bev_utils.read_labels_for_bevbox_ply(objects)
+        if noObjectLabels:
+            return []
         # on image space: targets are formatted as (class, x, y, w, l, sin(yaw), cos(yaw))
-        targets = kitti_bev_utils.build_yolo_target(labels)
-
-        return targets
-
-    def remove_invalid_idx(self, image_idx_list):
-        """Discard samples which don't have current training class objects, which will not be used for training."""
-
-        sample_id_list = []
-        for sample_id in image_idx_list:
-            sample_id = int(sample_id)
-            objects = self.get_label(sample_id)
-            calib = self.get_calib(sample_id)
-            labels, noObjectLabels = kitti_bev_utils.read_labels_for_bevbox(objects)
-            if not noObjectLabels:
-                labels[:, 1:] = transformation.camera_to_lidar_box(labels[:, 1:], calib.V2C, calib.R0,
-                                                                   calib.P)  # convert rect cam to velo cord
-
-            valid_list = []
-            for i in range(labels.shape[0]):
-                if int(labels[i, 0]) in cnf.CLASS_NAME_TO_ID.values():
-                    if self.check_point_cloud_range(labels[i, 1:4]):
-                        valid_list.append(labels[i, 0])
-
-            if len(valid_list) > 0:
-                sample_id_list.append(sample_id)
-
-        return sample_id_list
-
-    def check_point_cloud_range(self, xyz):
-        """
-        :param xyz: [x, y, z]
-        :return:
-        """
-        x_range = [cnf.boundary["minX"], cnf.boundary["maxX"]]
-        y_range = [cnf.boundary["minY"], cnf.boundary["maxY"]]
-        z_range = [cnf.boundary["minZ"], cnf.boundary["maxZ"]]
-
-        if (x_range[0] <= xyz[0] <= x_range[1]) and (y_range[0] <= xyz[1] <= y_range[1]) and \
-                (z_range[0] <= xyz[2] <= z_range[1]):
-            return True
-        return False
-
-    def get_calib(self, idx):
-        calib_file = os.path.join(self.calib_dir, '{:06d}.txt'.format(idx))
-        # assert os.path.isfile(calib_file)
-        return kitti_data_utils.Calibration(calib_file)
-
-    def get_label(self, idx):
-        label_file = os.path.join(self.label_dir, '{:06d}.txt'.format(idx))
-        # assert os.path.isfile(label_file)
-        return kitti_data_utils.read_label(label_file)
+        return kitti_bev_utils.build_yolo_target(labels)
 
 
 if __name__ == '__main__':
-    dataset_dir = '../../dataset/kitti'
-    num_anchors = 9
-    img_size = 608
-    use_yaw_label = True
-    anchors_solver = Find_Anchors(dataset_dir, img_size, use_yaw_label=use_yaw_label)
+    parser = argparse.ArgumentParser(description='Find the anchors of the BEV boxes of the dataset')
+    parser.add_argument('--dataset_dir', type=str, default='../../dataset/kitti', metavar='PATH',
+                        help='The dataset directory')
+    parser.add_argument('--shards_dir', type=str, default=None, metavar='PATH',
+                        help='If set, read the packed dataset (labels from its label index)')
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'val'],
+                        help='The split whose boxes are clustered')
+    parser.add_argument('--num_anchors', type=int, default=9,
+                        help='The number of anchors')
+    parser.add_argument('--img_size', type=int, default=608,
+                        help='the size of input image')
+    parser.add_argument('--no_yaw_label', action='store_true',
+                        help='If true, cluster the boxes as if their yaw were 0')
+    parser.add_argument('--method', type=str, default='median', choices=['median', 'mean'],
+                        help='k-medians or k-means')
+    parser.add_argument('--num_restarts', type=int, default=8,
+                        help='The number of differently seeded clusterings, the best one is kept')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='The number of threads of the scan/label reads and of the clusterings')
+    parser.add_argument('--cfgfile', type=str, default=None, metavar='PATH',
+                        help='If set, write the anchors into the [yolo] sections of this cfg')
+    parser.add_argument('--output_cfg', type=str, default=None, metavar='PATH',
+                        help='Write the cfg with the new anchors to this file instead of updating --cfgfile')
+    configs = parser.parse_args()
+
+    anchors_solver = Find_Anchors(configs.dataset_dir, configs.img_size, mode=configs.mode,
+                                  shards_dir=configs.shards_dir, use_yaw_label=not configs.no_yaw_label,
+                                  num_threads=configs.num_threads)
 
     # Use k clustering algorithm
-    anchors_solver.kmeans(num_anchors)
-    areas = anchors_solver.cluster[:, 0] * anchors_solver.cluster[:, 1]
-    anchors_solver.cluster = anchors_solver.cluster[np.argsort(areas)]
-    print('Selected anchors_solver.cluster: ', end='')
-    for clus in anchors_solver.cluster:
-        w_, h_, yaw_ = clus
-        print('{}, {}, {:.0f}'.format(int(w_), int(h_), yaw_), end=', ')
+    anchors_solver.kmeans(configs.num_anchors, num_restarts=configs.num_restarts, method=configs.method)
+    print('Selected anchors_solver.cluster: {}'.format(anchor_kmeans.format_anchors(anchors_solver.cluster)))
     print('avg_iou score: {:.2f}%'.format(anchors_solver.avg_iou() * 100))
+    if configs.cfgfile is not None:
+        anchor_kmeans.write_anchors_to_cfg(configs.cfgfile, anchors_solver.cluster, output_cfgfile=configs.output_cfg)
+        print('anchors written to {}'.format(configs.cfgfile if configs.output_cfg is None else configs.output_cfg))
 
     ############## *************************************************** #############
     #############                RESULTS                               #############
@@ -240,16 +170,4 @@ if __name__ == '__main__':
     # ])
     # IoU Score: 84.24% (use_yaw_label=False), 44.94% (use_yaw_label=True)
 
-    # Common below code should be uncomment if test with use_yaw_label option
-
-    # anchors_solver.cluster_conners = np.array(
-    #     [kitti_bev_utils.get_corners(0, 0, clus[0], clus[1], clus[2]) for clus in anchors_solver.cluster])
-    # anchors_solver.cluster_polygons = [anchors_solver.cvt_box_2_polygon(clus) for clus in anchors_solver.cluster_conners]
-    # anchors_solver.cluster_areas = [clus.area for clus in anchors_solver.cluster_polygons]
-
-    # anchors_solver.cluster = anchors_solver.cluster[np.argsort(anchors_solver.cluster[:, 0])]
-    # print('anchors_solver.cluster: {}'.format(anchors_solver.cluster))
-    # print('acc:{:.2f}%'.format(anchors_solver.avg_iou() * 100))
-
-    # anchors = 11, 14, 0.02,   10, 24, 1.55, 11, 25, 0.48,    22, 46, 1.57,   23, 50, 0.75,  23, 54, 1.57, 24, 54, 0.02,   25, 60, 0.83,   28, 71, 1.56
-    # anchors = 11, 14, 0,   10, 24, 0,   11, 25, 0,    22, 46, 0,   23, 50, 0,  23, 54, 0,   24, 54, 0,   25, 60, 0,   28, 71, 0
+    # To score fixed anchors, set anchors_solver.cluster to them and call anchors_solver.avg_iou()
@@ -13,8 +13,6 @@ from __future__ import division
 import sys
 
 import torch
-from shapely.geometry import Polygon
-from scipy.spatial import ConvexHull
 
 sys.path.append('../')
 
@@ -26,6 +24,8 @@ def cvt_box_2_polygon(box):
     :param array: an array of shape [num_conners, 2]
     :return: a shapely.geometry.Polygon object
     """
+    from shapely.geometry import Polygon
+
     # use .buffer(0) to fix a line polygon
     # more infor: https://stackoverflow.com/questions/13062334/polygon-intersection-error-in-shapely-shapely-geos-topologicalerror-the-opera
     return Polygon([(box[i, 0], box[i, 1]) for i in range(len(box))]).buffer(0)
@@ -96,6 +96,8 @@ def iou_rotated_boxes_targets_vs_anchors(anchors_polygons, anchors_areas, target
 
 
 def iou_pred_vs_target_boxes(pred_boxes, target_boxes, GIoU=False, DIoU=False, CIoU=False):
+    from scipy.spatial import ConvexHull
+
     assert pred_boxes.size() == target_boxes.size(), "Unmatch size of pred_boxes and target_boxes"
     device = pred_boxes.device
     n_boxes = pred_boxes.size(0)
@@ -144,6 +146,7 @@ def iou_pred_vs_target_boxes(pred_boxes, target_boxes, GIoU=False, DIoU=False, C
 
 if __name__ == "__main__":
     import cv2
+    from scipy.spatial import ConvexHull
     import numpy as np
 
 
@@ -1,6 +1,22 @@
 import os
+import bisect
+import importlib
 import torch
 import time
+import numpy as np
+
+class LazyModule(object):
+    """Import a heavy optional module (mayavi, open3d, ...) on its first attribute access instead of at startup"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
 
 def make_folder(folder_name):
     if not os.path.exists(folder_name):
@@ -33,6 +49,55 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class LatencyHistogram(object):
+    """Histogram of latencies (in seconds) over log-spaced buckets, cheap enough to be updated on every frame"""
+
+    def __init__(self, name, min_latency=1e-4, max_latency=10., num_buckets=60):
+        self.name = name
+        self.edges = np.geomspace(min_latency, max_latency, num_buckets).tolist()
+        self.reset()
+
+    def reset(self):
+        # the last bucket holds the latencies above max_latency
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def update(self, latency):
+        self.counts[bisect.bisect_left(self.edges, latency)] += 1
+        self.count += 1
+        self.sum += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-th percentile (q in [0, 100])"""
+        if self.count == 0:
+            return 0.
+        rank = q / 100. * self.count
+        cumulative = 0
+        for bucket_idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count > 0:
+                return self.edges[bucket_idx] if bucket_idx < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        """The statistics in milliseconds"""
+        return {
+            'count': self.count,
+            'mean': 1000. * self.sum / max(self.count, 1),
+            'p50': 1000. * self.percentile(50),
+            'p90': 1000. * self.percentile(90),
+            'p99': 1000. * self.percentile(99),
+            'max': 1000. * self.max,
+        }
+
+    def __str__(self):
+        return '{name}: n={count} mean={mean:.1f}ms p50={p50:.1f}ms p90={p90:.1f}ms p99={p99:.1f}ms ' \
+               'max={max:.1f}ms'.format(name=self.name, **self.summary())
+
+
 class ProgressMeter(object):
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
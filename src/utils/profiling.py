@@ -0,0 +1,273 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Description: Lightweight named-span profiler of the dataset, model and post-processing stages
+
+    with profiling.span('makeBVFeature'):
+        ...
+
+    @profiling.profiled('get_ply')
+    def get_ply(self, idx):
+        ...
+
+Profiling is disabled by default: span() then returns a shared no-op context and a profiled function only checks a
+flag before calling through. Once enable()d, every span adds its duration to a (count, total, max) entry of its name
+and, with trace=True, records a Chrome trace event (chrome://tracing, https://ui.perfetto.dev).
+The dataloader workers (see init_worker()) write their spans to <profile_dir>/spans_<pid>.json, collect() merges them
+with the spans of the current process.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import json
+import glob
+import threading
+import functools
+from multiprocessing import util as mp_util
+
+_enabled = False
+_trace = False
+_sync_cuda = False
+_profile_dir = None
+_is_worker = False
+_stats = {}
+_events = []
+_lock = threading.Lock()
+_last_flush = 0.
+
+MAX_TRACE_EVENTS = 1000000
+# A worker writes its spans at exit and at most every FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 10.
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _sync_cuda:
+            cuda_synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _sync_cuda:
+            cuda_synchronize()
+        record(self.name, self.start, time.perf_counter())
+        return False
+
+
+def cuda_synchronize():
+    # Never initialize cuda here, the spans also run in the dataloader workers
+    import torch
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+def enable(profile_dir=None, trace=False, sync_cuda=False):
+    """Start recording the spans.
+    :param profile_dir: where the dataloader workers write their spans, None to only profile the current process
+    :param trace: also record the Chrome trace events
+    :param sync_cuda: wait for the cuda kernels at the edges of the spans, so the model spans measure the kernels
+    """
+    global _enabled, _trace, _sync_cuda, _profile_dir
+    _enabled = True
+    _trace = trace
+    _sync_cuda = sync_cuda
+    _profile_dir = profile_dir
+    if (profile_dir is not None) and (not os.path.isdir(profile_dir)):
+        os.makedirs(profile_dir)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        del _events[:]
+
+
+def span(name):
+    """Context manager timing the `name` span"""
+    if not _enabled:
+        return NULL_SPAN
+    return _Span(name)
+
+
+def profiled(name=None):
+    """Decorator timing every call of the function as the `name` span (default: the function qualified name)"""
+
+    def decorator(fn):
+        span_name = fn.__qualname__ if name is None else name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(span_name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name, start, end):
+    duration = end - start
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            _stats[name] = [1, duration, duration]
+        else:
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+        if _trace and (len(_events) < MAX_TRACE_EVENTS):
+            # perf_counter is the system-wide monotonic clock on linux, the processes share the time origin
+            _events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': os.getpid(),
+                            'tid': threading.get_ident() % 100000})
+    if _is_worker and (end - _last_flush > FLUSH_INTERVAL):
+        flush()
+
+
+def init_worker(worker_id=None):
+    """worker_init_fn of the dataloaders: the forked worker starts with empty spans and writes them at exit"""
+    global _is_worker
+    if not _enabled:
+        return
+    _is_worker = True
+    reset()
+    if _profile_dir is not None:
+        mp_util.Finalize(None, flush, exitpriority=10)
+
+
+def flush():
+    """Write the spans of the current process into the profile dir"""
+    global _last_flush
+    if _profile_dir is None:
+        return
+    _last_flush = time.perf_counter()
+    with _lock:
+        payload = {'stats': dict(_stats), 'events': list(_events)}
+    path = os.path.join(_profile_dir, 'spans_{}.json'.format(os.getpid()))
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def load_worker_files():
+    """Return the payloads written by the other processes"""
+    if _profile_dir is None:
+        return []
+    payloads = []
+    own_fn = 'spans_{}.json'.format(os.getpid())
+    for path in glob.glob(os.path.join(_profile_dir, 'spans_*.json')):
+        if os.path.basename(path) == own_fn:
+            continue
+        try:
+            with open(path, 'r') as f:
+                payloads.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return payloads
+
+
+def collect():
+    """Return the {name: [count, total, max]} stats of the current process and of its dataloader workers"""
+    with _lock:
+        merged = {name: list(stat) for name, stat in _stats.items()}
+    for payload in load_worker_files():
+        for name, (count, total, max_duration) in payload['stats'].items():
+            if name not in merged:
+                merged[name] = [count, total, max_duration]
+            else:
+                merged[name][0] += count
+                merged[name][1] += total
+                merged[name][2] = max(merged[name][2], max_duration)
+    return merged
+
+
+def get_report(stats=None):
+    """Table of the spans, sorted by total time"""
+    stats = collect() if stats is None else stats
+    lines = ['{:<32s} {:>10s} {:>12s} {:>12s} {:>12s}'.format('span', 'count', 'total (s)', 'mean (ms)', 'max (ms)')]
+    for name, (count, total, max_duration) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        lines.append('{:<32s} {:>10d} {:>12.3f} {:>12.3f} {:>12.3f}'.format(name, count, total,
+                                                                         1000. * total / count, 1000. * max_duration))
+    return '\n'.join(lines)
+
+
+def report(logger=None, tb_writer=None, step=None):
+    """Log the span table and write the mean/total times of the spans to tensorboard"""
+    stats = collect()
+    if len(stats) == 0:
+        return
+    if logger is not None:
+        logger.info('Profiling spans (this process and its dataloader workers):\n{}'.format(get_report(stats)))
+    if tb_writer is not None:
+        tb_writer.add_scalars('Profiling_mean_ms', {name: 1000. * total / count
+                                                    for name, (count, total, _) in stats.items()}, step)
+        tb_writer.add_scalars('Profiling_total_s', {name: total for name, (_, total, _) in stats.items()}, step)
+
+
+def export_chrome_trace(path):
+    """Write the trace events of the current process and of its dataloader workers"""
+    with _lock:
+        events = list(_events)
+    for payload in load_worker_files():
+        events += payload['events']
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class TorchProfilerSteps(object):
+    """Run the torch autograd profiler over the next num_steps training steps, then export its Chrome trace and log
+    the table of its most expensive operators"""
+
+    def __init__(self, num_steps, trace_path, use_cuda=False, logger=None):
+        import torch
+
+        self.num_steps = num_steps
+        self.trace_path = trace_path
+        self.logger = logger
+        self.num_done = 0
+        self.prof = torch.autograd.profiler.profile(use_cuda=use_cuda)
+        self.prof.__enter__()
+
+    def step(self):
+        self.num_done += 1
+        if self.num_done == self.num_steps:
+            self.stop()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        self.prof.export_chrome_trace(self.trace_path)
+        if self.logger is not None:
+            self.logger.info('torch profiler over {} steps (trace: {}):\n{}'.format(
+                self.num_done, self.trace_path, self.prof.key_averages().table(sort_by='self_cpu_time_total',
+                                                                               row_limit=30)))
+        self.prof = None
@@ -12,7 +12,11 @@
 
 import torch
 
-__all__ = ['convert2cpu', 'convert2cpu_long', 'to_cpu']
+__all__ = ['convert2cpu', 'convert2cpu_long', 'to_cpu', 'BEV_DTYPES', 'to_bev_dtype', 'to_sparse_bev', 'SparseBevBatch',
+           'prepare_bev_input']
+
+# Storage/transport dtypes of the BEV maps, whose channels are in [0, 1]
+BEV_DTYPES = ['float32', 'float16', 'uint8']
 
 
 def convert2cpu(gpu_matrix):
@@ -25,3 +29,82 @@ def convert2cpu_long(gpu_matrix):
 
 def to_cpu(tensor):
     return tensor.detach().cpu()
+
+
+def to_bev_dtype(rgb_map, bev_dtype):
+    """Convert [0, 1] float BEV maps to their transport dtype, uint8 maps are quantized to 1/255 steps"""
+    if bev_dtype == 'uint8':
+        return rgb_map.clamp(0., 1.).mul(255.).round_().to(torch.uint8)
+    elif bev_dtype == 'float16':
+        return rgb_map.half()
+    return rgb_map.float()
+
+
+def to_sparse_bev(rgb_map):
+    """The sparse form of a (C, H, W) BEV map: (flat indices (int32) of the cells with a non-zero channel, their
+    (num_cells, C) features, (H, W))"""
+    num_channels, height, width = rgb_map.size()
+    flat_map = rgb_map.reshape(num_channels, height * width)
+    cells = (flat_map != 0).any(dim=0).nonzero().view(-1)
+    return cells.int(), flat_map[:, cells].t().contiguous(), (height, width)
+
+
+class SparseBevBatch(object):
+    """A batch of sparse BEV maps (see to_sparse_bev()): the occupied cells of the whole batch as flat indices into
+    the (batch, H, W) grid, and their features in the transport dtype. The dataloader pins it like a tensor
+    (pin_memory()), prepare_bev_input() densifies it on the device"""
+
+    def __init__(self, cells, features, batch_size, height, width):
+        self.cells = cells
+        self.features = features
+        self.batch_size = batch_size
+        self.height = height
+        self.width = width
+
+    @staticmethod
+    def from_samples(samples):
+        """Collate the sparse maps (to_sparse_bev()) of the samples of a batch, they have the same size"""
+        height, width = samples[0][2]
+        num_cells = height * width
+        cells = torch.cat([sample_cells + i * num_cells for i, (sample_cells, _, _) in enumerate(samples)])
+        features = torch.cat([features for _, features, _ in samples])
+        return SparseBevBatch(cells, features, len(samples), height, width)
+
+    def size(self, dim=None):
+        """The size of the dense batch"""
+        size = torch.Size([self.batch_size, self.features.size(1), self.height, self.width])
+        return size if dim is None else size[dim]
+
+    @property
+    def nbytes(self):
+        return self.cells.numel() * self.cells.element_size() + self.features.numel() * self.features.element_size()
+
+    def pin_memory(self):
+        return SparseBevBatch(self.cells.pin_memory(), self.features.pin_memory(), self.batch_size, self.height,
+                              self.width)
+
+    def densify(self, device, non_blocking=True):
+        """The dense (batch, C, H, W) maps on the device, in the transport dtype: the cells and features are copied to
+        the device and scattered into a zero grid by a single index_put_"""
+        cells = self.cells.to(device, non_blocking=non_blocking).long()
+        features = self.features.to(device, non_blocking=non_blocking)
+        num_channels = features.size(1)
+        dense = torch.zeros(self.batch_size * self.height * self.width, num_channels, dtype=features.dtype,
+                            device=device)
+        dense.index_put_((cells,), features)
+        return dense.view(self.batch_size, self.height, self.width, num_channels).permute(0, 3, 1, 2)
+
+
+def prepare_bev_input(imgs, device, non_blocking=True):
+    """Copy a batch of BEV maps (of any BEV_DTYPES, dense or a SparseBevBatch) to the device, then convert it there to
+    the float32 [0, 1] input of the model, so the host and the host -> device copy only handle the transport dtype"""
+    if isinstance(imgs, SparseBevBatch):
+        imgs = imgs.densify(device, non_blocking=non_blocking)
+    else:
+        imgs = imgs.to(device, non_blocking=non_blocking)
+    is_uint8 = (imgs.dtype == torch.uint8)
+    # contiguous float32, a densified batch is a permuted (NHWC) view
+    imgs = imgs.to(torch.float32, memory_format=torch.contiguous_format)
+    if is_uint8:
+        return imgs.mul_(1. / 255.)
+    return imgs
@@ -11,11 +11,18 @@
 import copy
 import os
 import math
+import json
+import pickle
+import random
+import queue
+import threading
 
+import numpy as np
 import torch
 from torch.optim.lr_scheduler import LambdaLR
 import torch.distributed as dist
-import matplotlib.pyplot as plt
+
+CHECKPOINT_FORMAT_VERSION = 1
 
 
 def create_optimizer(configs, model):
@@ -77,40 +84,312 @@ def create_lr_scheduler(optimizer, configs):
     return lr_scheduler
 
 
-def get_saved_state(model, optimizer, lr_scheduler, epoch, configs):
-    """Get the information to save with checkpoints"""
-    if hasattr(model, 'module'):
-        model_state_dict = model.module.state_dict()
-    else:
-        model_state_dict = model.state_dict()
-    utils_state_dict = {
+def get_module(model):
+    """The model itself, unwrapped from DataParallel/DistributedDataParallel"""
+    return model.module if hasattr(model, 'module') else model
+
+
+class ModelEMA(object):
+    """Exponential moving average of the model weights (parameters and float buffers)
+    Refer from https://github.com/ultralytics/yolov5/blob/master/utils/torch_utils.py (ModelEMA)
+
+    The decay ramps up as decay * (1 - exp(-updates / tau)), so the early, fast changing weights are not averaged over
+    too long. update() is called after every optimizer step; every rank of a distributed training holds the same
+    weights after the step, so every rank updates its own copy and no communication is needed.
+    """
+
+    def __init__(self, model, decay=0.9999, tau=2000, updates=0):
+        self.ema = copy.deepcopy(get_module(model))
+        self.ema.eval()
+        for p in self.ema.parameters():
+            p.requires_grad_(False)
+        self.decay = decay
+        self.tau = tau
+        self.updates = updates
+
+        # The tensors of the state dicts share the storage of the parameters/buffers, they are matched once
+        model_state_dict = get_module(model).state_dict()
+        ema_state_dict = self.ema.state_dict()
+        self.float_pairs = [(ema_state_dict[key], value) for key, value in model_state_dict.items()
+                            if value.dtype.is_floating_point]
+        self.other_pairs = [(ema_state_dict[key], value) for key, value in model_state_dict.items()
+                            if not value.dtype.is_floating_point]
+        self.ema_floats = [ema_value for ema_value, _ in self.float_pairs]
+        self.model_floats = [value for _, value in self.float_pairs]
+
+    def get_decay(self):
+        return self.decay * (1. - math.exp(-self.updates / self.tau))
+
+    def update(self):
+        self.updates += 1
+        decay = self.get_decay()
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_mul_'):
+                # A few fused kernels for the whole model instead of two per tensor
+                torch._foreach_mul_(self.ema_floats, decay)
+                torch._foreach_add_(self.ema_floats, self.model_floats, alpha=1. - decay)
+            else:
+                for ema_value, value in self.float_pairs:
+                    ema_value.mul_(decay).add_(value, alpha=1. - decay)
+            for ema_value, value in self.other_pairs:
+                ema_value.copy_(value)
+
+    def state_dict(self):
+        return self.ema.state_dict()
+
+    def load_state_dict(self, state_dict, updates):
+        self.ema.load_state_dict(state_dict)
+        self.updates = updates
+
+
+def get_rng_state():
+    """The states of the python, numpy, torch and cuda random generators"""
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if ('cuda' in rng_state) and torch.cuda.is_available() and \
+            (len(rng_state['cuda']) == torch.cuda.device_count()):
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+def to_cpu_copy(obj):
+    """Copy the tensors of a (nested) state to the cpu, the copy is not modified by the next training steps"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return obj.__class__((key, to_cpu_copy(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu_copy(value) for value in obj)
+    return obj
+
+
+def get_saved_state(model, optimizer, lr_scheduler, epoch, configs, mAP=None, ema=None, global_step=None,
+                    early_stopping=None):
+    """Get the single-file checkpoint state: model, optimizer, lr_scheduler, epoch, the number of optimizer steps
+    (global_step), the mAP history of the early stopping and the random generators.
+    With an EMA, 'model' holds the EMA weights (the ones evaluated and used for inference) and 'raw_model' the trained
+    weights to resume from.
+    The tensors are copied to the cpu, so the state can be written while the training goes on.
+    """
+    model_state_dict = get_module(model).state_dict()
+    saved_state = {
+        'format_version': CHECKPOINT_FORMAT_VERSION,
         'epoch': epoch,
-        'configs': configs,
-        'optimizer': copy.deepcopy(optimizer.state_dict()),
-        'lr_scheduler': copy.deepcopy(lr_scheduler.state_dict())
+        'mAP': mAP,
+        'configs': {key: value for key, value in configs.items() if key != 'device'},
+        'model': model_state_dict,
+        'optimizer': optimizer.state_dict(),
+        'lr_scheduler': lr_scheduler.state_dict(),
+        'rng': get_rng_state(),
+        'global_step': global_step,
     }
+    if early_stopping is not None:
+        saved_state['early_stopping_history'] = list(early_stopping.history)
+    if ema is not None:
+        saved_state['raw_model'] = model_state_dict
+        saved_state['model'] = ema.state_dict()
+        saved_state['ema_updates'] = ema.updates
+
+    return to_cpu_copy(saved_state)
+
+
+def get_legacy_utils_path(model_path):
+    """The Utils_*.pth file saved next to a legacy Model_*.pth file"""
+    model_dir, model_fn = os.path.split(model_path)
+    return os.path.join(model_dir, model_fn.replace('Model_', 'Utils_', 1))
+
 
-    return model_state_dict, utils_state_dict
+def load_training_state(checkpoint, checkpoint_path):
+    """Return the training state of a loaded checkpoint, a single-file checkpoint or a legacy Model_*.pth file (the
+    optimizer, lr_scheduler and epoch are then read from the Utils_*.pth file next to it, if any)"""
+    if isinstance(checkpoint, dict) and ('format_version' in checkpoint):
+        return checkpoint
 
+    state = {'model': checkpoint}
+    utils_path = get_legacy_utils_path(checkpoint_path)
+    if (utils_path != checkpoint_path) and os.path.isfile(utils_path):
+        utils_state_dict = torch.load(utils_path, map_location='cpu')
+        state.update({key: utils_state_dict[key] for key in ['epoch', 'optimizer', 'lr_scheduler']})
+    return state
 
-def save_checkpoint(checkpoints_dir, saved_fn, model_state_dict, utils_state_dict, epoch):
-    """Save checkpoint every epoch only is best model or after every checkpoint_freq epoch"""
-    model_save_path = os.path.join(checkpoints_dir, 'Model_{}_epoch_{}.pth'.format(saved_fn, epoch))
-    utils_save_path = os.path.join(checkpoints_dir, 'Utils_{}_epoch_{}.pth'.format(saved_fn, epoch))
 
-    torch.save(model_state_dict, model_save_path)
-    torch.save(utils_state_dict, utils_save_path)
+class CheckpointSaver(object):
+    """Write the checkpoints in a background thread, the training loop only waits for the copy of the state to the cpu.
 
-    print('save a checkpoint at {}'.format(model_save_path))
+    Every checkpoint is one file, Checkpoint_<saved_fn>_epoch_<epoch>.pth, written to a temporary file and renamed, so
+    a checkpoint is never seen half-written. With keep_last > 0, only the keep_last latest checkpoints and the one with
+    the best mAP are kept. The epochs and mAPs of the checkpoints are listed in Checkpoint_<saved_fn>.json, which makes
+    the retention survive a resumed training.
+    """
+
+    def __init__(self, checkpoints_dir, saved_fn, keep_last=0, logger=None):
+        self.checkpoints_dir = checkpoints_dir
+        self.saved_fn = saved_fn
+        self.keep_last = keep_last
+        self.logger = logger
+        self.index_path = os.path.join(checkpoints_dir, 'Checkpoint_{}.json'.format(saved_fn))
+        self.index = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='checkpoint_saver', daemon=True)
+        self.thread.start()
+
+    def get_checkpoint_path(self, epoch):
+        return os.path.join(self.checkpoints_dir, 'Checkpoint_{}_epoch_{}.pth'.format(self.saved_fn, epoch))
+
+    def save(self, saved_state):
+        """Queue a state of get_saved_state(), blocks while the previous checkpoint is still being written"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(saved_state)
+
+    def run(self):
+        while True:
+            saved_state = self.queue.get()
+            if saved_state is None:
+                self.queue.task_done()
+                break
+            try:
+                self.write(saved_state)
+            except Exception as error:
+                self.error = error
+            self.queue.task_done()
+
+    def write(self, saved_state):
+        epoch = saved_state['epoch']
+        save_path = self.get_checkpoint_path(epoch)
+        tmp_path = '{}.tmp'.format(save_path)
+        torch.save(saved_state, tmp_path)
+        os.replace(tmp_path, save_path)
+
+        self.index = [record for record in self.index if record['epoch'] != epoch]
+        self.index.append({'epoch': epoch, 'mAP': saved_state['mAP'], 'filename': os.path.basename(save_path)})
+        self.apply_retention()
+        tmp_path = '{}.tmp'.format(self.index_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+        message = 'save a checkpoint at {}'.format(save_path)
+        if self.logger is not None:
+            self.logger.info(message)
+        else:
+            print(message)
+
+    def get_best(self):
+        """The index record of the checkpoint with the best mAP, None if no checkpoint has a mAP"""
+        records = [record for record in self.index if record['mAP'] is not None]
+        if len(records) == 0:
+            return None
+        return max(records, key=lambda record: record['mAP'])
+
+    def apply_retention(self):
+        if self.keep_last <= 0:
+            return
+        best = self.get_best()
+        records = sorted(self.index, key=lambda record: record['epoch'])
+        kept = records[-self.keep_last:]
+        if (best is not None) and (best not in kept):
+            kept.append(best)
+        for record in records:
+            path = os.path.join(self.checkpoints_dir, record['filename'])
+            if (record not in kept) and os.path.isfile(path):
+                os.remove(path)
+        self.index = sorted(kept, key=lambda record: record['epoch'])
+
+    def close(self):
+        """Wait for the queued checkpoints to be written"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class EarlyStopping(object):
+    """Stop the training when the mAP has plateaued: none of the last `patience` validations improved the best mAP of
+    the validations before them by more than min_delta"""
+
+    def __init__(self, patience, min_delta=0.):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.history = []
+
+    def step(self, mAP):
+        """Record the mAP of a validation, return True if the training should stop"""
+        self.history.append(mAP)
+        if (self.patience <= 0) or (len(self.history) <= self.patience):
+            return False
+        best_before = max(self.history[:-self.patience])
+        return max(self.history[-self.patience:]) <= best_before + self.min_delta
+
+
+def iterate_with_last(iterable):
+    """Yield the (item, is_last) of an iterable, one item ahead"""
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for next_item in iterator:
+        yield item, False
+        item = next_item
+    yield item, True
 
 
 def reduce_tensor(tensor, world_size):
     rt = tensor.clone()
-    dist.all_reduce(rt, op=dist.reduce_op.SUM)
+    dist.all_reduce(rt, op=dist.ReduceOp.SUM)
     rt /= world_size
     return rt
 
 
+def all_gather_objects(obj):
+    """Gather a picklable object from every rank, dist.all_gather_object() or its equivalent on torch < 1.8"""
+    world_size = dist.get_world_size()
+    if hasattr(dist, 'all_gather_object'):
+        objects = [None] * world_size
+        dist.all_gather_object(objects, obj)
+        return objects
+
+    # nccl only gathers cuda tensors
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy()).to(device)
+    size = torch.tensor([data.numel()], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(rank_size.item()) for rank_size in sizes]
+    padded = torch.zeros(max(sizes), dtype=torch.uint8, device=device)
+    padded[:data.numel()] = data
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return [pickle.loads(rank_data[:rank_size].cpu().numpy().tobytes())
+            for rank_data, rank_size in zip(gathered, sizes)]
+
+
+def broadcast_object(obj, src=0):
+    """Return the object of the rank src on every rank"""
+    if hasattr(dist, 'broadcast_object_list'):
+        objects = [obj]
+        dist.broadcast_object_list(objects, src=src)
+        return objects[0]
+    return all_gather_objects(obj if dist.get_rank() == src else None)[src]
+
+
 def to_python_float(t):
     if hasattr(t, 'item'):
         return t.item()
@@ -140,6 +419,8 @@ def get_tensorboard_log(model):
 
 
 def plot_lr_scheduler(optimizer, scheduler, num_epochs=300, save_dir=''):
+    import matplotlib.pyplot as plt
+
     # Plot LR simulating training for full num_epochs
     optimizer, scheduler = copy.copy(optimizer), copy.copy(scheduler)  # do not modify originals
     y = []
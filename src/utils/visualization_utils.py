@@ -2,13 +2,16 @@ import sys
 import math
 
 import numpy as np
-import mayavi.mlab as mlab
 import cv2
 
 sys.path.append('../')
 
 from data_process import kitti_data_utils, kitti_bev_utils, transformation
 import config.kitti_config as cnf
+from utils.misc import LazyModule
+
+# Only the 3D point cloud drawings need mayavi
+mlab = LazyModule('mayavi.mlab')
 
 
 def draw_lidar_simple(pc, color=None):